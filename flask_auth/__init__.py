@@ -15,18 +15,61 @@ class ConfigError(Exception):
 class EmailError(Exception):
 	pass
 
+class UniqueConstraintError(Exception):
+	"""Raised by a DbAdapter when a write would duplicate a unique User field."""
+	def __init__(self, field_name, value=None):
+		super(UniqueConstraintError, self).__init__("'%s' is already in use: %r" % (field_name, value))
+		self.field_name = field_name
+		self.value = value
 
-# Export Flask-Login's current user
-from flask_login import current_user # pass through Flask-Login's current_user
 
-from .user_mixin import AuthUserMixin
-from .auth import Auth
-from .email_manager import EmailManager
-from .password_manager import PasswordManager
-from .token_manager import TokenManager
+# The public API is imported on first access (PEP 562) to keep 'import flask_auth' cheap.
+# Public name -> module that defines it
+_lazy_exports = {
+	# Export Flask-Login's current user
+	'current_user': 'flask_login',
+	'AuthUserMixin': '.user_mixin',
+	'Auth': '.auth',
+	'AvailabilityManager': '.availability_manager',
+	'EmailManager': '.email_manager',
+	'GenerationManager': '.generation_manager',
+	'PasswordManager': '.password_manager',
+	'TokenManager': '.token_manager',
+	'UserSnapshot': '.user_snapshot',
+	# Export Flask-User decorators
+	'login_required': '.decorators',
+	'allow_unconfirmed_account': '.decorators',
+	'roles_accepted': '.decorators',
+	'roles_required': '.decorators',
+	# Export Flask-User signals
+	'auth_changed_password': '.signals',
+	'auth_db_operation': '.signals',
+	'auth_changed_username': '.signals',
+	'auth_changed_email': '.signals',
+	'auth_confirmed_account': '.signals',
+	'auth_welcome': '.signals',
+	'auth_forgot_password': '.signals',
+	'auth_logged_in': '.signals',
+	'auth_logged_out': '.signals',
+	'auth_registered': '.signals',
+	'auth_reset_password': '.signals',
+}
 
-# Export Flask-User decorators
-from .decorators import *
+__all__ = ['ConfigError', 'EmailError', 'UniqueConstraintError'] + list(_lazy_exports)
 
-# Export Flask-User signals
-from .signals import *
+def __getattr__(name):
+	if name not in _lazy_exports:
+		raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+	from importlib import import_module
+	value = getattr(import_module(_lazy_exports[name], __name__), name)
+	globals()[name] = value
+	return value
+
+def __dir__():
+	return sorted(set(globals()) | set(_lazy_exports))
+
+# Python < 3.7 has no module __getattr__ (PEP 562): import the public API eagerly
+import sys
+if sys.version_info < (3, 7): # pragma: no cover
+	for _name in _lazy_exports:
+		__getattr__(_name)
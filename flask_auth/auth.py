@@ -10,12 +10,14 @@ from flask_login import LoginManager
 from wtforms import ValidationError
 
 from . import ConfigError
+from .availability_manager import AvailabilityManager
 from .db_manager import DBManager
 from .email_manager import EmailManager
+from .generation_manager import GenerationManager
 from .password_manager import PasswordManager
 from .token_manager import TokenManager
 from .translation_utils import lazy_gettext as _l # map _l() to lazy_gettext()
-from .auth__settings import Auth__Settings
+from .auth__settings import Auth__Settings, load_settings
 from .auth__utils import Auth__Utils
 from .auth__views import Auth__Views
 
@@ -67,15 +69,12 @@ class Auth(Auth__Settings, Auth__Utils, Auth__Views):
 
 		# Load app config settings
 		# ------------------------
-		# For each 'Auth.AUTH_...' property: load settings from the app config.
-		for attrib_name in dir(self):
-			if attrib_name[0:5] == 'AUTH_':
-				default_value = getattr(Auth, attrib_name)
-				setattr(self, attrib_name, app.config.get(attrib_name, default_value))
-
-		# If AUTH_EMAIL_SENDER_NAME is not set, default it to AUTH_APP_NAME
-		if not self.AUTH_EMAIL_SENDER_NAME:
-			self.AUTH_EMAIL_SENDER_NAME = self.AUTH_APP_NAME
+		# Load the 'Auth.AUTH_...' settings from the app config,
+		# validate them (raise ConfigError if not valid) and freeze them.
+		self.settings = load_settings(type(self), app.config)
+		# Settings remain available as 'Auth.AUTH_...' attributes
+		for attrib_name, value in self.settings.items():
+			setattr(self, attrib_name, value)
 
 		# Configure Flask session behavior
 		# --------------------------------
@@ -98,15 +97,31 @@ class Auth(Auth__Settings, Auth__Utils, Auth__Views):
 		# Flask-Login calls this function to retrieve a User record by token.
 		@self.login_manager.user_loader
 		def load_user(id):
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				# The session ID embeds the security generation: 'user_id:generation'
+				id, generation = self.generation_manager.parse_session_id(id)
 			if self.custom_anon and not int(id):
 				return AnonymousUser()
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				# Reject sessions known to be outdated before hitting the DB
+				if not self.generation_manager.is_current(id, generation):
+					return None
+				# A user missing from the in-memory map is read from the database, not from the snapshot cache
+				if self.generation_manager.get_known_generation(id) is None:
+					user = self.db_manager.get_user_by_id(int(id))
+				else:
+					user = self.db_manager.get_user_by_id(int(id), generation)
+				# Check the generation of the loaded user (no extra DB query)
+				if user and not self.generation_manager.verify(user, generation):
+					return None
+				return user
 			return self.db_manager.get_user_by_id(int(id))
 
 		# Configure Flask-BabelEx
 		# -----------------------
 		self.babel = app.extensions.get('babel', None)
 		from .translation_utils import init_translations
-		init_translations(self.babel)
+		init_translations(self.babel, self.AUTH_AVAILABLE_LANGUAGES, self.AUTH_ACCEPT_LANGUAGE_CACHE_SIZE)
 
 		# Configure Jinja2
 		# ----------------
@@ -125,12 +140,6 @@ class Auth(Auth__Settings, Auth__Utils, Auth__Views):
 		# Register context processor with Jinja2
 		app.context_processor(flask_user_context_processor)
 
-		# Create a dummy Blueprint to add the app/templates/auth dir to the template search path
-		self.blueprint = Blueprint('auth', __name__, static_folder='static', template_folder='templates')
-		# Configure URLs to route to their corresponding view method in blueprint.
-		self._add_url_routes()
-		app.register_blueprint(self.blueprint, url_prefix='/auth')
-
 		# Set default form classes
 		# ------------------------
 		with app.app_context():
@@ -157,11 +166,27 @@ class Auth(Auth__Settings, Auth__Utils, Auth__Views):
 		# Setup TokenManager
 		self.token_manager = TokenManager(app)
 
+		# Setup GenerationManager
+		self.generation_manager = GenerationManager(app)
+
+		# Setup AvailabilityManager
+		self.availability_manager = AvailabilityManager(app)
+
+		# Register the 'flask auth' commands
+		from .cli import auth_cli
+		app.cli.add_command(auth_cli)
+
 		# Allow developers to customize Auth
 		self.customize(app)
 
-		# Make sure the settings are valid -- raise ConfigError if not
-		self._check_settings(app)
+		# Validate the settings assigned by customize() -- raise ConfigError if not valid
+		self._reload_customized_settings(app)
+
+		# Create a dummy Blueprint to add the app/templates/auth dir to the template search path
+		self.blueprint = Blueprint('auth', __name__, static_folder='static', template_folder='templates')
+		# Configure URLs to route to their corresponding view method in blueprint.
+		self._add_url_routes()
+		app.register_blueprint(self.blueprint, url_prefix='/auth')
 
 	def customize(self, app):
 		""" Override this method to customize properties.
@@ -177,64 +202,30 @@ class Auth(Auth__Settings, Auth__Utils, Auth__Views):
 					self.email_manager = CustomEmailManager(app)
 					self.password_manager = CustomPasswordManager(app)
 					self.token_manager = CustomTokenManager(app)
+					self.generation_manager = GenerationManager(app, backend=CustomGenerationBackend())
 
 			# Setup Flask-User
 			auth = CustomAuth(app, db, User)
+
+		Settings assigned here (``self.AUTH_... = value``) are validated and frozen once this method returns,
+		and decide which URL routes are enabled.
+		The managers created before this method have already read the settings they need at creation:
+		set those in the app config instead.
 		"""
 
 	# ***** Private methods *****
 
-	def _check_settings(self, app):
-		"""Verify required settings. Produce a helpful error messages for incorrect settings."""
-
-		# Check for invalid settings
-		# --------------------------
-
-		# Check that AUTH_EMAIL_SENDER_EMAIL is set True
-		if not self.AUTH_EMAIL_SENDER_EMAIL:
-			raise ConfigError(
-				'AUTH_EMAIL_SENDER_EMAIL is missing.'\
-				' specify AUTH_EMAIL_SENDER_EMAIL (and AUTH_EMAIL_SENDER_NAME).')
-
-		# Disable settings that rely on a feature setting that's not enabled
-		# ------------------------------------------------------------------
-
-		# AUTH_ENABLE_REGISTER=True must have AUTH_ENABLE_USERNAME=True or AUTH_ENABLE_EMAIL=True.
-		if not self.AUTH_ENABLE_USERNAME and not self.AUTH_ENABLE_EMAIL:
-			self.AUTH_ENABLE_REGISTER = False
-
-		if not self.AUTH_ENABLE_REGISTER:
-			self.AUTH_AUTO_LOGIN_AFTER_REGISTER = False
-
-		# Settings that depend on AUTH_ENABLE_EMAIL=True
-		if not self.AUTH_ENABLE_EMAIL:
-			self.AUTH_ENABLE_LOGIN_BY_EMAIL = False
-			self.AUTH_ENABLE_CHANGE_EMAIL = False
-			self.AUTH_SHOW_EMAIL_DOES_NOT_EXIST = False
-
-		# Settings that depend on AUTH_ENABLE_USERNAME=True
-		if not self.AUTH_ENABLE_USERNAME:
-			self.AUTH_ENABLE_LOGIN_BY_USERNAME = False
-			self.AUTH_ENABLE_CHANGE_USERNAME = False
-			self.AUTH_SHOW_USERNAME_DOES_NOT_EXIST = False
-
-		if not self.AUTH_ENABLE_CHANGE_USERNAME:
-			self.AUTH_SEND_USERNAME_CHANGED_EMAIL = False
-
-		if not self.AUTH_ENABLE_CHANGE_EMAIL:
-			self.AUTH_SEND_EMAIL_CHANGED_EMAIL = False
-
-		if not self.AUTH_ENABLE_CHANGE_PASSWORD:
-			self.AUTH_SEND_PASSWORD_CHANGED_EMAIL = False
-
-		if not self.AUTH_ENABLE_CONFIRM_ACCOUNT:
-			self.AUTH_ALLOW_LOGIN_WITHOUT_CONFIRMED_ACCOUNT = False
-			self.AUTH_AUTO_LOGIN_AFTER_CONFIRM = False
-			
-		if not self.AUTH_ENABLE_FORGOT_PASSWORD:
-			self.AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME = False
-			self.AUTH_ENABLE_FORGOT_PASSWORD_BY_EMAIL = False
-			self.AUTH_AUTO_LOGIN_AFTER_RESET_PASSWORD = False
+	def _reload_customized_settings(self, app):
+		# Load the settings again if customize() assigned any 'Auth.AUTH_...' attribute,
+		# with the assigned values taking precedence over the app config
+		overrides = {name: self.__dict__[name] for name, value in self.settings.items() if self.__dict__.get(name, value) is not value}
+		if not overrides:
+			return
+		config = dict(app.config)
+		config.update(overrides)
+		self.settings = load_settings(type(self), config)
+		for attrib_name, value in self.settings.items():
+			setattr(self, attrib_name, value)
 
 	def _add_url_routes(self):
 		"""
@@ -242,58 +233,62 @@ class Auth(Auth__Settings, Auth__Utils, Auth__Views):
 		# Because methods contain an extra ``self`` parameter, URL routes are mapped
 		# to stub functions, which simply call the corresponding method.
 
-		# For testing purposes, we map all available URLs to stubs, but the stubs
-		# contain config checks to return 404 when a feature is disabled.
+		# For testing purposes, we map all available URLs to stubs.
+		# The feature settings are resolved once, here: the stubs of disabled features
+		# are replaced with a stub that returns 404.
+		settings = self.settings
+		def not_found_stub(**kwargs):
+			abort(404)
+		def stub_if(enabled, stub):
+			return stub if enabled else not_found_stub
 
 		# Define the stubs
 		# ----------------
 		def change_password_stub():
-			if not self.AUTH_ENABLE_CHANGE_PASSWORD: abort(404)
 			return self.change_password()
 		def change_username_stub():
-			if not self.AUTH_ENABLE_CHANGE_USERNAME: abort(404)
 			return self.change_username()
 		def change_email_stub():
-			if not self.AUTH_ENABLE_CHANGE_EMAIL: abort(404)
 			return self.change_email()
 		def forgot_password_stub():
-			if not self.AUTH_ENABLE_FORGOT_PASSWORD: abort(404)
 			return self.forgot_password()
 		def reset_password_stub(token):
-			if not self.AUTH_ENABLE_FORGOT_PASSWORD: abort(404)
 			return self.reset_password(token)
 		def login_stub():
 			return self.login()
 		def logout_stub():
 			return self.logout()
 		def register_stub():
-			if not self.AUTH_ENABLE_REGISTER: abort(404)
 			return self.register()
 		def account_verification_stub():
-			if not self.AUTH_ENABLE_CONFIRM_ACCOUNT: abort(404)
 			return self.account_verification()
 		def resend_account_verification_stub():
-			if not self.AUTH_ENABLE_CONFIRM_ACCOUNT: abort(404)
 			return self.resend_account_verification()
 		def confirm_account_stub(token):
-			if not self.AUTH_ENABLE_CONFIRM_ACCOUNT: abort(404)
 			return self.confirm_account(token)
 		def unauthenticated_stub():
 			return self.unauthenticated()
 		def unauthorized_stub():
 			return self.unauthorized()
+		def availability_stub():
+			return self.availability()
+		# Expose the policies of the protected view methods on their stubs (see list_protected_endpoints())
+		for stub in (change_password_stub, change_username_stub, change_email_stub,
+				account_verification_stub, resend_account_verification_stub):
+			stub.auth_policy = getattr(self, stub.__name__[:-len('_stub')]).auth_policy
 		# Add the URL routes
 		# ------------------
-		self.blueprint.add_url_rule('change_password/', 'change_password', change_password_stub, methods=['GET', 'POST'])
-		self.blueprint.add_url_rule('change_username/', 'change_username', change_username_stub, methods=['GET', 'POST'])
-		self.blueprint.add_url_rule('change_email/', 'change_email', change_email_stub, methods=['GET', 'POST'])
-		self.blueprint.add_url_rule('forgot_password/', 'forgot_password', forgot_password_stub, methods=['GET', 'POST'])
-		self.blueprint.add_url_rule('reset_password/<token>', 'reset_password', reset_password_stub, methods=['GET', 'POST'])
+		self.blueprint.add_url_rule('change_password/', 'change_password', stub_if(settings.AUTH_ENABLE_CHANGE_PASSWORD, change_password_stub), methods=['GET', 'POST'])
+		self.blueprint.add_url_rule('change_username/', 'change_username', stub_if(settings.AUTH_ENABLE_CHANGE_USERNAME, change_username_stub), methods=['GET', 'POST'])
+		self.blueprint.add_url_rule('change_email/', 'change_email', stub_if(settings.AUTH_ENABLE_CHANGE_EMAIL, change_email_stub), methods=['GET', 'POST'])
+		self.blueprint.add_url_rule('forgot_password/', 'forgot_password', stub_if(settings.AUTH_ENABLE_FORGOT_PASSWORD, forgot_password_stub), methods=['GET', 'POST'])
+		self.blueprint.add_url_rule('reset_password/<token>', 'reset_password', stub_if(settings.AUTH_ENABLE_FORGOT_PASSWORD, reset_password_stub), methods=['GET', 'POST'])
 		self.blueprint.add_url_rule('login/', 'login', login_stub, methods=['GET', 'POST'])
 		self.blueprint.add_url_rule('logout/', 'logout', logout_stub, methods=['GET'])
-		self.blueprint.add_url_rule('register', 'register', register_stub, methods=['GET', 'POST'])
-		self.blueprint.add_url_rule('register/account_verification', 'account_verification', account_verification_stub, methods=['GET'])
-		self.blueprint.add_url_rule('register/resend_account_verification', 'resend_account_verification', resend_account_verification_stub, methods=['GET'])
-		self.blueprint.add_url_rule('register/confirm_account/<token>', 'confirm_account', confirm_account_stub, methods=['GET'])
+		self.blueprint.add_url_rule('register', 'register', stub_if(settings.AUTH_ENABLE_REGISTER, register_stub), methods=['GET', 'POST'])
+		self.blueprint.add_url_rule('register/account_verification', 'account_verification', stub_if(settings.AUTH_ENABLE_CONFIRM_ACCOUNT, account_verification_stub), methods=['GET'])
+		self.blueprint.add_url_rule('register/resend_account_verification', 'resend_account_verification', stub_if(settings.AUTH_ENABLE_CONFIRM_ACCOUNT, resend_account_verification_stub), methods=['GET'])
+		self.blueprint.add_url_rule('register/confirm_account/<token>', 'confirm_account', stub_if(settings.AUTH_ENABLE_CONFIRM_ACCOUNT, confirm_account_stub), methods=['GET'])
 		self.blueprint.add_url_rule('unauthenticated/', 'unauthenticated', unauthenticated_stub, methods=['GET'])
-		self.blueprint.add_url_rule('unauthorized/', 'unauthorized', unauthorized_stub, methods=['GET'])
\ No newline at end of file
+		self.blueprint.add_url_rule('unauthorized/', 'unauthorized', unauthorized_stub, methods=['GET'])
+		self.blueprint.add_url_rule('availability', 'availability', stub_if(settings.AUTH_ENABLE_AVAILABILITY_ENDPOINT, availability_stub), methods=['GET'])
@@ -3,6 +3,13 @@
 # Author: Alejandro Alvarez <jandrikus@gmail.com>
 # Copyright (c) 2019 Alejandro Alvarez
 
+import numbers
+import types
+from collections.abc import Mapping
+from functools import lru_cache
+
+from . import ConfigError
+
 # This class mixes into the Auth class.
 # Mixins allow for maintaining code and docs across several files.
 class Auth__Settings(object):
@@ -100,6 +107,28 @@ class Auth__Settings(object):
 	#: | Depends on AUTH_ENABLE_REGISTER=True.
 	AUTH_AUTO_LOGIN_AFTER_REGISTER = True
 
+	#: | Answer as-you-type username and email availability checks of the register page
+	#: | with a JSON endpoint: ``GET /auth/availability?username=<value>`` (or ``?email=<value>``)
+	#: | returns ``{"field": "username", "available": true}``.
+	#: | Values missing from an in-memory Bloom filter of the values in use are available without a DB query.
+	#: | Answers are advisory: the register form still checks the values on submit. Requires blinker.
+	AUTH_ENABLE_AVAILABILITY_ENDPOINT = False
+
+	#: | Expected number of users, to size the Bloom filter (about 1.2 bytes per value at a 1% error rate).
+	#: | Depends on AUTH_ENABLE_AVAILABILITY_ENDPOINT=True.
+	AUTH_AVAILABILITY_FILTER_CAPACITY = 200000
+
+	#: | Rate of the checks of available values that still need a DB query (false positives),
+	#: | with AUTH_AVAILABILITY_FILTER_CAPACITY users.
+	#: | Depends on AUTH_ENABLE_AVAILABILITY_ENDPOINT=True.
+	AUTH_AVAILABILITY_FILTER_ERROR_RATE = 0.01
+
+	#: | Maximum number of availability checks per client (IP address) and minute.
+	#: | Clients are identified by ``request.remote_addr``: behind a reverse proxy, wrap the application
+	#: | in werkzeug's ProxyFix so that it holds the address forwarded by the proxy.
+	#: | Depends on AUTH_ENABLE_AVAILABILITY_ENDPOINT=True.
+	AUTH_AVAILABILITY_RATE_LIMIT = 60
+
 	#: | Allow users to change their username.
 	#: | Depends on AUTH_ENABLE_USERNAME=True.
 	AUTH_ENABLE_CHANGE_USERNAME = True
@@ -157,22 +186,46 @@ class Auth__Settings(object):
 	#: | Default is 1 days (1*24*3600 seconds).
 	AUTH_RESET_PASSWORD_EXPIRATION = 1*24*3600
 
-	#: | Depends on AUTH_ENABLE_FORGOT_PASSWORD=True.
+	#: | Depends on AUTH_ENABLE_FORGOT_PASSWORD=True and AUTH_ENABLE_USERNAME=True.
 	AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME = True
 
-	#: | Depends on AUTH_ENABLE_FORGOT_PASSWORD=True.
+	#: | Depends on AUTH_ENABLE_FORGOT_PASSWORD=True and AUTH_ENABLE_EMAIL=True.
 	AUTH_ENABLE_FORGOT_PASSWORD_BY_EMAIL = True
 
 	#: | Automatic sign-in after a user resets their password.
 	#: | Depends on AUTH_ENABLE_FORGOT_PASSWORD=True.
 	AUTH_AUTO_LOGIN_AFTER_RESET_PASSWORD = True
 
+	#: | Invalidate all other sessions and tokens of a user after a password or email change.
+	#: | Requires an integer security generation column in the User data-model
+	#: | (see AUTH_SECURITY_GENERATION_FIELD).
+	AUTH_ENABLE_SECURITY_GENERATION = False
+
+	#: | Name of the User attribute that holds the security generation number.
+	#: | Depends on AUTH_ENABLE_SECURITY_GENERATION=True.
+	AUTH_SECURITY_GENERATION_FIELD = 'security_generation'
+
+	#: | Seconds between two synchronizations with the shared generation backend (if any).
+	#: | Depends on AUTH_ENABLE_SECURITY_GENERATION=True.
+	AUTH_SECURITY_GENERATION_SYNC_INTERVAL = 5
+
+	#: | Number of users whose latest security generation each process keeps in memory, least recently used first out.
+	#: | The sessions of the other users are checked against the database (not against the user snapshot cache).
+	#: | Depends on AUTH_ENABLE_SECURITY_GENERATION=True.
+	AUTH_SECURITY_GENERATION_CACHE_SIZE = 10000
+
 	#: | If True, the app will look for a custom method to select
 	#: | the desired email address to send the security driven emails
 	#: | Override -> class CustomEmailManager(EmailManager)
 	#: | and use customize() method in Auth
 	AUTH_ENABLE_CUSTOM_SPECIFIC_EMAIL = False
 
+	#: | The DbAdapter to use: 'sql', 'mongo', 'flywheel', 'pynamo', 'sharded' (see AUTH_SHARD_BINDS),
+	#: | the name of a third-party adapter registered in the 'flask_auth.db_adapters' entry point group,
+	#: | or an import path such as 'mypackage.adapters:CustomDbAdapter'.
+	#: | Default is '': detect the DbAdapter from the ``db`` and ``UserClass`` types.
+	AUTH_DB_ADAPTER = ''
+
 	#: | The way Flask-User handles case insensitive searches.
 	#: | Valid options are:
 	#: | - 'ifind' (default): Use the case insensitive ifind_first_object()
@@ -181,6 +234,138 @@ class Auth__Settings(object):
 	#: |     so that a regular find_first_object() can be performed.
 	AUTH_IFIND_MODE = 'ifind'
 
+	#: | Bind keys (see SQLALCHEMY_BINDS) of the read replicas of the primary database (SQL only).
+	#: | User lookups are routed to one replica per request, picked at random,
+	#: | while writes and commits go to the primary database.
+	#: | After the first write of a request, the rest of the request reads from the primary.
+	#: | Default is []: all reads go to the primary.
+	AUTH_SQL_REPLICA_BINDS = []
+
+	#: | Seconds during which a client that has just written (changed a password, logged in...)
+	#: | keeps reading from the primary database, tracked with a cookie. This absorbs the replication lag.
+	#: | Depends on AUTH_SQL_REPLICA_BINDS.
+	AUTH_SQL_REPLICA_STICKINESS = 5
+
+	#: | Spread the users over several SQL databases (shards): list of SQLALCHEMY_BINDS keys, one per shard.
+	#: | Requires AUTH_DB_ADAPTER='sharded'. Users are placed by a hash of their ID, and a directory table
+	#: | (see AUTH_SHARD_DIRECTORY_BIND) maps their usernames and email addresses to their IDs.
+	#: | Run ``flask auth rebalance-shards`` after adding or removing a shard.
+	#: | Default is []: no sharding.
+	AUTH_SHARD_BINDS = []
+
+	#: | SQLALCHEMY_BINDS key of the database holding the shard directory and the user ID sequence.
+	#: | Depends on AUTH_SHARD_BINDS. Default is '': the default database (SQLALCHEMY_DATABASE_URI).
+	AUTH_SHARD_DIRECTORY_BIND = ''
+
+	#: | Maintain canonical shadow fields of the username and email fields:
+	#: | NFKC-normalized, casefolded and trimmed values, updated whenever a user is saved.
+	#: | Users are then found by an exact match on the shadow fields, served by a plain unique index in every database,
+	#: | instead of a case insensitive search. Requires a nullable '<field><AUTH_CANONICAL_FIELD_SUFFIX>' field
+	#: | in the User data-model for each enabled field (indexed: unique index, or Global Secondary Index in DynamoDB).
+	#: | Run ``flask auth backfill-canonical-fields`` for existing users.
+	AUTH_ENABLE_CANONICAL_FIELDS = False
+
+	#: | Suffix of the canonical shadow field names: 'username_canonical' and 'email_canonical' by default.
+	#: | Depends on AUTH_ENABLE_CANONICAL_FIELDS=True.
+	AUTH_CANONICAL_FIELD_SUFFIX = '_canonical'
+
+	#: | Collation of the case insensitive unique indexes that MongoDbAdapter.create_all_tables() creates
+	#: | on the username and email fields, and of the 'nocase_collation' lookups on them.
+	#: | Strength 2 compares base characters and accents, ignoring case.
+	AUTH_MONGO_COLLATION = dict(locale='en', strength=2)
+
+	#: | Batch the writes of each request in a unit of work:
+	#: | the objects saved during the request are written once, when the request completes, followed by a single commit.
+	#: | The request's writes are rolled back if it fails with an exception or a 5xx response.
+	#: | SQL commits become flushes, so that generated IDs and constraint violations still show up during the view.
+	#: | MongoDB and DynamoDB have no transactions to roll back: only the saves still pending are dropped.
+	#: | Their writes made during the request stay: new users (``add_user()``), deletions, and the saves written
+	#: | by ``flush()`` to check unique values (registration, username change and email change).
+	#: | Security generation bumps are published to the other workers after the commit, and not at all on a rollback.
+	#: | Outside requests (commands, jobs), saves and commits are immediate.
+	AUTH_ENABLE_UNIT_OF_WORK = False
+
+	#: | Load users as lightweight snapshots on the authentication paths (``load_user()`` and login),
+	#: | projecting only the fields of AUTH_USER_SNAPSHOT_FIELDS.
+	#: | MongoDB and SQL: a UserSnapshot, which loads the full User object on first access to any other attribute.
+	#: | MongoDB saves the fields assigned on a snapshot with a partial update.
+	#: | SQL snapshots load the full User object on the first assignment.
+	#: | PynamoDB: a UserSnapshot read with ``attributes_to_get``, which loads the full User object on the first assignment.
+	#: | Other databases load full objects, unless snapshots are cached (see AUTH_USER_SNAPSHOT_CACHE_SIZE).
+	AUTH_ENABLE_USER_SNAPSHOTS = False
+
+	#: | User fields projected into snapshots, in addition to 'id',
+	#: | to the security generation field (see AUTH_ENABLE_SECURITY_GENERATION)
+	#: | and to the roles bitmask field (see AUTH_ENABLE_ROLES_BITMASK).
+	#: | SQL relationships (such as ``roles``) are projected as a tuple of read-only rows of the related objects,
+	#: | selected with one more query: change them with ``add_user_role()`` and ``remove_user_role()``.
+	#: | Depends on AUTH_ENABLE_USER_SNAPSHOTS=True.
+	AUTH_USER_SNAPSHOT_FIELDS = ['password', 'verified', 'disabled', 'roles', 'language']
+
+	#: | Number of user snapshots kept in memory by each process for ``load_user()``, keyed by user ID
+	#: | and security generation: a cached user is loaded without any DB query. 0 disables the cache.
+	#: | Saving a user, or changing its roles, drops its snapshot from the cache of the current process.
+	#: | Other processes may serve outdated fields for up to AUTH_USER_SNAPSHOT_CACHE_TTL seconds,
+	#: | including the security generation when no generation backend is shared (see AUTH_ENABLE_SECURITY_GENERATION).
+	#: | Depends on AUTH_ENABLE_USER_SNAPSHOTS=True.
+	AUTH_USER_SNAPSHOT_CACHE_SIZE = 0
+
+	#: | Seconds during which a cached user snapshot is served (see AUTH_USER_SNAPSHOT_CACHE_SIZE).
+	AUTH_USER_SNAPSHOT_CACHE_TTL = 10
+
+	#: | Use strongly consistent reads for PynamoDB GetItem and table Query requests.
+	#: | Global Secondary Index queries are always eventually consistent.
+	AUTH_PYNAMO_CONSISTENT_READ = False
+
+	#: | Number of segments scanned in parallel when a PynamoDB lookup cannot use an index.
+	AUTH_PYNAMO_SCAN_SEGMENTS = 4
+
+	#: | Read capacity units per second that a PynamoDB scan may consume, all segments together.
+	#: | Default is 0: no limit.
+	AUTH_PYNAMO_SCAN_READ_CAPACITY = 0
+
+	#: | DynamoDB table of the uniqueness guard items (PynamoDB and Flywheel only).
+	#: | When set, each username and email address is reserved by a guard item written together with the user,
+	#: | so that availability checks are a single GetItem and concurrent registrations cannot collide.
+	#: | The table is created by ``create_all_tables()``. Default is '': no guard items.
+	AUTH_UNIQUENESS_GUARD_TABLE = ''
+
+	#: | Register users without checking first that their username and email address are available:
+	#: | the User is inserted directly, and a duplicate rejected by the database is reported on the form as usual.
+	#: | Saves the two availability lookups of each registration, and closes the race between the checks and the insert.
+	#: | Requires unique indexes on the username and email fields (or on their canonical shadow fields),
+	#: | or AUTH_UNIQUENESS_GUARD_TABLE with the DynamoDB adapters.
+	AUTH_ENABLE_OPTIMISTIC_REGISTRATION = False
+
+	#: | Role inheritance: a dictionary of role name -> list of the role names it implies.
+	#: | Implied roles are transitive and do not need to be stored in the user roles.
+	#: | May also be declared as a ``role_hierarchy`` dictionary on the RoleClass.
+	#: | Example: ``dict(admin=['editor'], editor=['writer', 'viewer'])``
+	AUTH_ROLE_HIERARCHY = dict()
+
+	#: | Maintain a bitmask of the user role IDs on the user row (SQL only),
+	#: | so that ``has_roles()`` needs no join with the user roles table.
+	#: | Requires an integer column in the User data-model (see AUTH_ROLES_BITMASK_FIELD)
+	#: | and the RoleClass parameter of Auth. Run ``flask auth backfill-roles-mask`` for existing users.
+	AUTH_ENABLE_ROLES_BITMASK = False
+
+	#: | Name of the User attribute that holds the roles bitmask (bit ``role.id`` is set for each role).
+	#: | Use a BigInteger column for role IDs up to 62, or a Numeric column beyond that.
+	#: | Depends on AUTH_ENABLE_ROLES_BITMASK=True.
+	AUTH_ROLES_BITMASK_FIELD = 'roles_mask'
+
+	#: | Seconds during which role names missing from the roles table are not looked up again (SQL only).
+	#: | A role check naming an unknown role reloads the role cache at most once per period,
+	#: | so a role created by another process may be ignored by role checks for up to this period.
+	AUTH_MISSING_ROLES_RECHECK_INTERVAL = 60
+
+	#: | Language codes offered to users who are not logged in.
+	#: | Defaults to the languages shipped in flask_auth/translations (discovered once at startup).
+	AUTH_AVAILABLE_LANGUAGES = []
+
+	#: | Number of distinct Accept-Language headers whose best language match is memoized.
+	AUTH_ACCEPT_LANGUAGE_CACHE_SIZE = 256
+
 	#: | Require users to retype their password.
 	#: | Affects registration, change password and reset password forms.
 	AUTH_REQUIRE_RETYPE_PASSWORD = True
@@ -208,4 +393,151 @@ class Auth__Settings(object):
 	#:
 	#: .. This hack shows a header above the _next_ section
 	#:     URL settings
-	AUTH_PASSLIB_CRYPTCONTEXT_KEYWORDS = dict()
\ No newline at end of file
+	AUTH_PASSLIB_CRYPTCONTEXT_KEYWORDS = dict()
+
+# Declarative settings schema
+# ---------------------------
+# The type of each setting is the type of its default value in Auth__Settings.
+# Settings whose default value is a string or an integer may also be set to None.
+
+#: Settings that must be set (not empty).
+REQUIRED_SETTINGS = ('AUTH_EMAIL_SENDER_EMAIL',)
+
+#: Settings that only accept a fixed set of values.
+SETTING_CHOICES = {
+	'AUTH_IFIND_MODE': ('ifind', 'nocase_collation'),
+}
+
+#: | Settings that rely on a feature setting.
+#: | Each requirement is either a setting name, or a tuple of setting names
+#: | (one of which must be enabled), as in ``has_roles()``.
+#: | A setting whose requirements are not met is disabled (set to False).
+SETTING_DEPENDENCIES = (
+	('AUTH_ENABLE_REGISTER', [('AUTH_ENABLE_USERNAME', 'AUTH_ENABLE_EMAIL')]),
+	('AUTH_AUTO_LOGIN_AFTER_REGISTER', ['AUTH_ENABLE_REGISTER']),
+	('AUTH_ENABLE_LOGIN_BY_EMAIL', ['AUTH_ENABLE_EMAIL']),
+	('AUTH_ENABLE_CHANGE_EMAIL', ['AUTH_ENABLE_EMAIL']),
+	('AUTH_SHOW_EMAIL_DOES_NOT_EXIST', ['AUTH_ENABLE_EMAIL']),
+	('AUTH_ENABLE_LOGIN_BY_USERNAME', ['AUTH_ENABLE_USERNAME']),
+	('AUTH_ENABLE_CHANGE_USERNAME', ['AUTH_ENABLE_USERNAME']),
+	('AUTH_SHOW_USERNAME_DOES_NOT_EXIST', ['AUTH_ENABLE_USERNAME']),
+	('AUTH_SEND_USERNAME_CHANGED_EMAIL', ['AUTH_ENABLE_CHANGE_USERNAME']),
+	('AUTH_SEND_EMAIL_CHANGED_EMAIL', ['AUTH_ENABLE_CHANGE_EMAIL']),
+	('AUTH_SEND_PASSWORD_CHANGED_EMAIL', ['AUTH_ENABLE_CHANGE_PASSWORD']),
+	('AUTH_ALLOW_LOGIN_WITHOUT_CONFIRMED_ACCOUNT', ['AUTH_ENABLE_CONFIRM_ACCOUNT']),
+	('AUTH_AUTO_LOGIN_AFTER_CONFIRM', ['AUTH_ENABLE_CONFIRM_ACCOUNT']),
+	('AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME', ['AUTH_ENABLE_FORGOT_PASSWORD', 'AUTH_ENABLE_USERNAME']),
+	('AUTH_ENABLE_FORGOT_PASSWORD_BY_EMAIL', ['AUTH_ENABLE_FORGOT_PASSWORD', 'AUTH_ENABLE_EMAIL']),
+	('AUTH_AUTO_LOGIN_AFTER_RESET_PASSWORD', ['AUTH_ENABLE_FORGOT_PASSWORD']),
+)
+
+class AuthSettings(object):
+	"""
+	Immutable Flask-Auth settings, created by ``load_settings()``.
+
+	Each 'AUTH_...' setting is a slot of a subclass generated for the settings of an Auth class.
+	List and dict values are frozen as well: they are stored as tuples and read-only mappings.
+	"""
+	__slots__ = ()
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Flask-Auth settings are read-only. Set '%s' in the app config instead." % name)
+
+	def __delattr__(self, name):
+		raise AttributeError("Flask-Auth settings are read-only.")
+
+	def items(self):
+		"""Returns a list of (setting name, value) pairs."""
+		return [(name, getattr(self, name)) for name in self.__slots__]
+
+	def __repr__(self):
+		return '<AuthSettings %s>' % ', '.join('%s=%r' % item for item in self.items())
+
+@lru_cache(maxsize=None)
+def _settings_class(names):
+	# Returns an AuthSettings subclass with one slot per setting name
+	return type('AuthSettings', (AuthSettings,), {'__slots__': names})
+
+def _is_string_like(value):
+	# Strings, and lazy strings (such as the messages of ``lazy_gettext()``), which proxy the str methods
+	if isinstance(value, str):
+		return True
+	return not isinstance(value, (bytes, bytearray)) and hasattr(value, 'format') and hasattr(value, 'encode')
+
+def load_settings(AuthClass, config):
+	"""
+	Load the 'AUTH_...' settings of ``AuthClass`` from ``config``, validate them
+	and return them as an immutable AuthSettings object.
+
+	| All misconfigurations are reported at once in a single ConfigError.
+	"""
+	# Load app config settings, falling back on the AuthClass defaults
+	defaults = {name: getattr(AuthClass, name) for name in dir(AuthClass) if name[0:5] == 'AUTH_'}
+	values = {name: config.get(name, default) for name, default in defaults.items()}
+
+	# If AUTH_EMAIL_SENDER_NAME is not set, default it to AUTH_APP_NAME
+	if not values['AUTH_EMAIL_SENDER_NAME']:
+		values['AUTH_EMAIL_SENDER_NAME'] = values['AUTH_APP_NAME']
+
+	# Check for invalid settings
+	# --------------------------
+	errors = []
+	for name, default in sorted(defaults.items()):
+		value = values[name]
+		if value is None and isinstance(default, (str, int)) and not isinstance(default, bool):
+			continue
+		if default is None:
+			continue
+		if isinstance(default, bool):
+			valid, type_name = isinstance(value, bool), 'bool'
+		elif isinstance(default, (list, tuple)):
+			valid, type_name = isinstance(value, (list, tuple)), 'list'
+		elif isinstance(default, numbers.Real):
+			# Integers and floats are interchangeable
+			valid, type_name = isinstance(value, numbers.Real) and not isinstance(value, bool), 'number'
+		elif isinstance(default, str):
+			valid, type_name = _is_string_like(value), 'str'
+		elif isinstance(default, dict):
+			valid, type_name = isinstance(value, Mapping), 'dict'
+		else:
+			valid, type_name = isinstance(value, type(default)), type(default).__name__
+		if not valid:
+			errors.append('%s must be of type %s, not %s.' % (name, type_name, type(value).__name__))
+	for name in REQUIRED_SETTINGS:
+		if not values.get(name):
+			errors.append('%s is missing.' % name)
+	if values['AUTH_EMAIL_SENDER_EMAIL'] and '@' not in values['AUTH_EMAIL_SENDER_EMAIL']:
+		errors.append('AUTH_EMAIL_SENDER_EMAIL is not a valid email address.')
+	for name, choices in SETTING_CHOICES.items():
+		if values[name] not in choices:
+			errors.append('%s must be one of %s, not %r.' % (name, ', '.join(map(repr, choices)), values[name]))
+	if errors:
+		raise ConfigError('Invalid Flask-Auth settings:\n- ' + '\n- '.join(errors))
+
+	# Disable settings that rely on a feature setting that's not enabled
+	# ------------------------------------------------------------------
+	changed = True
+	while changed:
+		changed = False
+		for name, requirements in SETTING_DEPENDENCIES:
+			if values[name] and not all(
+					any(values[setting] for setting in requirement) if isinstance(requirement, tuple) else values[requirement]
+					for requirement in requirements):
+				values[name] = False
+				changed = True
+
+	# Freeze the settings
+	settings = object.__new__(_settings_class(tuple(sorted(values))))
+	for name, value in values.items():
+		object.__setattr__(settings, name, _freeze(value))
+	return settings
+
+def _freeze(value):
+	# Returns a read-only copy of a setting value: lists become tuples and dicts read-only mappings, recursively
+	if isinstance(value, (list, tuple)):
+		return tuple(_freeze(item) for item in value)
+	if isinstance(value, (set, frozenset)):
+		return frozenset(value)
+	if isinstance(value, Mapping):
+		return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+	return value
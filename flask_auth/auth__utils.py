@@ -7,6 +7,8 @@ from urllib.parse import urlsplit, urlunsplit
 
 from flask_login import current_user
 
+from .translation_utils import domain_translations
+
 # This class mixes into the Auth class.
 # Mixins allow for maintaining code and docs across several files.
 class Auth__Utils(object):
@@ -19,7 +21,7 @@ class Auth__Utils(object):
 		| Returns True if ``new_username`` does not exist.
 		| Return False otherwise.
 		"""
-		return self.db_manager.find_user_by_username(new_username) == None
+		return self.db_manager.is_user_field_available('username', new_username)
 
 	def email_is_available(self, new_email):
 		"""
@@ -28,7 +30,7 @@ class Auth__Utils(object):
 		| Returns True if ``new_email`` does not exist.
 		| Returns False otherwise.
 		"""
-		return self.db_manager.find_user_by_email(new_email) == None
+		return self.db_manager.is_user_field_available('email', new_email)
 
 	def generate_token(self, *args):
 		"""Convenience method that calls self.token_manager.generate_token(\*args)."""
@@ -38,6 +40,18 @@ class Auth__Utils(object):
 		"""Convenience method that calls self.token_manager.verify_token(token, expiration_in_seconds)."""
 		return self.token_manager.verify_token(token, expiration_in_seconds)
 
+	def list_protected_endpoints(self):
+		"""
+		List the endpoints protected by the Flask-Auth view decorators.
+
+		| Returns a list of ``(endpoint, policy)`` tuples sorted by endpoint,
+			where ``policy`` is the ``AccessPolicy`` of the view.
+		"""
+		return sorted(
+			(endpoint, view_function.auth_policy)
+			for endpoint, view_function in self.app.view_functions.items()
+			if hasattr(view_function, 'auth_policy'))
+
 	def make_safe_url(self, url):
 		"""Makes a URL safe by removing optional hostname and port.
 
@@ -60,6 +74,5 @@ class Auth__Utils(object):
 
 	def prepare_domain_translations(self):
 		"""Set domain_translations for current request context."""
-		from .translation_utils import domain_translations
 		if domain_translations:
 			domain_translations.as_default()
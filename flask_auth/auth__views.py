@@ -7,13 +7,12 @@ from datetime import datetime, timedelta
 from urllib.parse import quote, unquote
 import os
 import json
-import requests
 
-from flask import current_app, flash, redirect, render_template, request, url_for, abort
+from flask import current_app, flash, jsonify, redirect, render_template, request, url_for, abort
 from flask_login import current_user, login_user, logout_user
 
 from .decorators import login_required, allow_unconfirmed_account
-from . import signals
+from . import signals, UniqueConstraintError
 from .translation_utils import gettext as _  # map _() to gettext()
 
 # This class mixes into the Auth class.
@@ -30,8 +29,14 @@ class Auth__Views(object):
 			# Update user's password with new password
 			new_password = form.new_password.data
 			self.password_manager.set_password(new_password, current_user)
+			# Invalidate all other sessions and tokens (if enabled)
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				self.generation_manager.bump_generation(current_user)
 			self.db_manager.save_user(current_user)
 			self.db_manager.commit()
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				self._publish_generation(current_user._get_current_object())
+				self._refresh_login(current_user._get_current_object())
 			# Send password_changed email
 			self.email_manager.send_password_changed_email(current_user)
 			# Send changed_password signal
@@ -54,9 +59,17 @@ class Auth__Views(object):
 		if request.method == 'POST' and form.validate():
 			# Change username
 			new_username = form.new_username.data
+			old_username = current_user.username
 			current_user.username=new_username
-			self.db_manager.save_object(current_user)
-			self.db_manager.commit()
+			try:
+				self.db_manager.save_user(current_user)
+				self.db_manager.flush()
+			except UniqueConstraintError as error:
+				# The username was taken in the meantime
+				current_user.username = old_username
+				self._add_unique_constraint_error(error, username=form.new_username)
+				self.prepare_domain_translations()
+				return render_template('auth/change_username.html', form=form)
 			# Send username_changed email
 			self.email_manager.send_username_changed_email(current_user)
 			# Send changed_username signal
@@ -78,8 +91,21 @@ class Auth__Views(object):
 			# Change current user's email
 			old_email = current_user.email
 			current_user.email = form.email.data
-			self.db_manager.save_user(current_user)
-			self.db_manager.commit()
+			# Invalidate all other sessions and tokens (if enabled)
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				self.generation_manager.bump_generation(current_user)
+			try:
+				self.db_manager.save_user(current_user)
+				self.db_manager.flush()
+			except UniqueConstraintError as error:
+				# The email address was taken in the meantime
+				current_user.email = old_email
+				self._add_unique_constraint_error(error, email=form.email)
+				self.prepare_domain_translations()
+				return render_template('auth/change_email.html', form=form)
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				self._publish_generation(current_user._get_current_object())
+				self._refresh_login(current_user._get_current_object())
 			# Send email_changed email (for old and new)
 			self.email_manager.send_email_changed_email(current_user, old_email)
 			# Send changed_email signal
@@ -102,17 +128,17 @@ class Auth__Views(object):
 		# Process valid POST
 		if request.method == 'POST' and form.validate():
 			# Get User by username and/or by email
-			if self.AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME:
-				user_by_username = self.db_manager.find_user_by_username(form.username.data)
-			if self.AUTH_ENABLE_FORGOT_PASSWORD_BY_EMAIL:
-				user_by_email = self.db_manager.find_user_by_email(form.email.data)
-			# Ensure both match the same user
+			user = None
 			if self.AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME and self.AUTH_ENABLE_FORGOT_PASSWORD_BY_EMAIL:
-				user = user_by_username if user_by_username == user_by_email else None
-			elif self.AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME:
-				user = user_by_username
+				# A single query for both, then ensure both match the same user
+				user = self.db_manager.find_user_by_username_or_email(form.username.data, form.email.data)
+				if user and not (self.db_manager.user_field_matches(user, 'username', form.username.data)
+						and self.db_manager.user_field_matches(user, 'email', form.email.data)):
+					user = None
 			elif self.AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME:
-				user = user_by_email
+				user = self.db_manager.find_user_by_username(form.username.data)
+			elif self.AUTH_ENABLE_FORGOT_PASSWORD_BY_EMAIL:
+				user = self.db_manager.find_user_by_email(form.email.data)
 			if user:
 				# Send reset_password email
 				self.email_manager.send_reset_password_email(user)
@@ -156,8 +182,13 @@ class Auth__Views(object):
 			# Update user's password with new password
 			new_password = form.new_password.data
 			self.password_manager.set_password(new_password, user)
+			# Invalidate all other sessions and tokens, including this one (if enabled)
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				self.generation_manager.bump_generation(user)
 			self.db_manager.save_user(user)
 			self.db_manager.commit()
+			if self.AUTH_ENABLE_SECURITY_GENERATION:
+				self._publish_generation(user)
 			# Send 'password_changed' email
 			self.email_manager.send_password_changed_email(user)
 			# Send reset_password signal
@@ -185,17 +216,19 @@ class Auth__Views(object):
 		form = self.LoginFormClass(request.form)
 		# Process valid POST
 		if request.method == 'POST' and form.validate():
-			# Retrieve User
-			user = None
-			if self.AUTH_ENABLE_LOGIN_BY_USERNAME:
-				# Find user record by username
-				user = self.db_manager.find_user_by_username(form.username.data)
-				# Find user record by email (with form.username)
-				if not user and self.AUTH_ENABLE_LOGIN_BY_EMAIL:
-					user = self.db_manager.find_user_by_email(form.username.data)
-			else:
-				# Find user by email (with form.email)
-				user = self.db_manager.find_user_by_email(form.email.data)
+			# Retrieve User: LoginForm has found it while validating the password
+			user = getattr(form, 'user', None)
+			# Custom login forms may not keep it
+			if user is None:
+				if self.AUTH_ENABLE_LOGIN_BY_USERNAME and self.AUTH_ENABLE_LOGIN_BY_EMAIL:
+					# Find user record by username or email (with form.username)
+					user = self.db_manager.find_user_by_username_or_email(form.username.data)
+				elif self.AUTH_ENABLE_LOGIN_BY_USERNAME:
+					# Find user record by username
+					user = self.db_manager.find_user_by_username(form.username.data)
+				else:
+					# Find user by email (with form.email)
+					user = self.db_manager.find_user_by_email(form.email.data)
 			if user:
 				# Check if user has a confirmed account (if required)
 				if self.AUTH_ENABLE_CONFIRM_ACCOUNT and not self.AUTH_ALLOW_LOGIN_WITHOUT_CONFIRMED_ACCOUNT and not user.verified:
@@ -239,8 +272,20 @@ class Auth__Views(object):
 			# Set user's password
 			self.password_manager.set_password(user.password, user)
 			# Create new user
-			self.db_manager.save_user(user)
-			self.db_manager.commit()
+			try:
+				self.db_manager.save_user(user)
+				self.db_manager.flush()
+			except UniqueConstraintError as error:
+				# Another user has the username or email address (AUTH_ENABLE_OPTIMISTIC_REGISTRATION),
+				# or another registration took it in the meantime
+				self.db_manager.rollback()
+				self.db_manager.delete_object(user)
+				self.db_manager.commit()
+				self._add_unique_constraint_error(error, username=getattr(form, 'username', None), email=getattr(form, 'email', None))
+				self.prepare_domain_translations()
+				return render_template('auth/register.html', form=form)
+			# Send registered signal
+			signals.auth_registered.send(current_app._get_current_object(), user=user)
 			# (if required) Send 'confirm_account' email and delete new User object if send fails
 			if self.AUTH_ENABLE_CONFIRM_ACCOUNT:
 				# Send 'confirm email' email
@@ -342,6 +387,27 @@ class Auth__Views(object):
 		else:
 			return redirect(url_for('auth.login', next=quote(safe_next_url))) # redirect to login page
 
+	def availability(self):
+		# Answer a live availability check of the register page: ?username=<value> or ?email=<value>
+		# Behind a reverse proxy, let werkzeug's ProxyFix set the client address
+		client = request.remote_addr
+		retry_after = self.availability_manager.check_rate_limit(client)
+		if retry_after:
+			response = jsonify(error='Too many requests')
+			response.status_code = 429
+			response.headers['Retry-After'] = str(retry_after)
+			return response
+		enabled_fields = [field_name for field_name, enabled in
+			(('username', self.AUTH_ENABLE_USERNAME), ('email', self.AUTH_ENABLE_EMAIL)) if enabled]
+		field_names = [field_name for field_name in enabled_fields if field_name in request.args]
+		if len(field_names) != 1 or not request.args[field_names[0]]:
+			response = jsonify(error='Expected one of the parameters: %s' % ', '.join(enabled_fields))
+			response.status_code = 400
+			return response
+		field_name = field_names[0]
+		available = self.availability_manager.is_available(field_name, request.args[field_name])
+		return jsonify(field=field_name, available=available)
+
 	def unauthenticated(self):
 		# Prepare Flash message
 		flash(_("You must be signed in to access '%(url)s'.", url=request.url), 'error')
@@ -375,6 +441,7 @@ class Auth__Views(object):
 			if self.AUTH_LOGINS_FILE_WITH_IP:
 				request_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
 			if self.AUTH_LOGINS_FILE_WITH_CITY:
+				import requests # imported here: only needed for the optional IPStack lookup
 				ipstack_access_key = self.AUTH_IPSTACK_ACCESS_KEY
 				url = f'http://api.ipstack.com/{request_ip}?access_key={ipstack_access_key}'
 				city = json.loads(requests.get(url).text)['city']
@@ -402,6 +469,26 @@ class Auth__Views(object):
 		# Redirect to 'next' URL
 		return redirect(safe_next_url or url_for(self.AUTH_ENDPOINT_AFTER_LOGIN))
 
+	def _publish_generation(self, user):
+		# Announce the new security generation of ``user`` once it is committed:
+		# with AUTH_ENABLE_UNIT_OF_WORK, after the request, and never if the request rolls back
+		self.db_manager.call_after_commit(lambda: self.generation_manager.publish_generation(user))
+
+	def _refresh_login(self, user):
+		# Store the new security generation in the session (and remember cookie) of the current user
+		remember_cookie_name = current_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token')
+		login_user(user, remember=remember_cookie_name in request.cookies)
+
+	def _add_unique_constraint_error(self, error, **form_fields):
+		# Report a UniqueConstraintError on the form field of the duplicated User field
+		form_field = form_fields.get(error.field_name)
+		if form_field is None:
+			raise error
+		if error.field_name == 'username':
+			form_field.errors.append(_('This Username is already in use. Please try another one.'))
+		else:
+			form_field.errors.append(_('This Email is already in use. Please try another one.'))
+
 	# Returns safe URL from query param ``param_name`` if query param exists.
 	# Returns url_for(default_endpoint) otherwise.
 	def _get_safe_next_url(self, param_name, default_endpoint=''):
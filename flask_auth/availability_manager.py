@@ -0,0 +1,162 @@
+"""
+This module implements the AvailabilityManager for Flask-Auth.
+It answers the live username and email availability checks of the register page
+from an in-memory Bloom filter of the values in use, so that most checks need no DB query.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import math
+from hashlib import blake2b
+from threading import Lock
+from time import monotonic
+
+from . import ConfigError
+from .db_adapters.canonical_fields import canonicalize
+
+class BloomFilter(object):
+	"""
+	A set of strings that may answer "maybe present" for absent ones (false positives),
+	but never "absent" for present ones.
+	"""
+	def __init__(self, capacity, error_rate):
+		"""
+		Args:
+			capacity(int): The expected number of strings.
+			error_rate(float): The rate of false positives once ``capacity`` strings have been added.
+		"""
+		capacity = max(int(capacity), 1)
+		self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+		self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+		self.bits = bytearray((self.size + 7) // 8)
+
+	def _positions(self, value):
+		# Double hashing: the bit positions are h1 + i*h2 for the two halves of a 128-bit digest
+		digest = blake2b(value.encode('utf-8'), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+	def add(self, value):
+		for position in self._positions(value):
+			self.bits[position >> 3] |= 1 << (position & 7)
+
+	def __contains__(self, value):
+		return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+class AvailabilityManager(object):
+	"""Answer username and email availability checks (see AUTH_ENABLE_AVAILABILITY_ENDPOINT)."""
+	def __init__(self, app):
+		"""
+		Args:
+			app(Flask): The Flask application instance.
+		"""
+		self.app = app
+		self.auth = app.auth
+		# Bloom filter of the canonical 'field#value' keys in use, built on first use
+		self.filter = None
+		# Held during a build: one scan at a time
+		self._build_lock = Lock()
+		# Guards the changes of the filter, and the keys taken during a build (None when no build is running),
+		# which the scan may have missed: they are added to the new filter
+		self._filter_lock = Lock()
+		self._pending_keys = None
+		# Rate limiting: number of checks of each client in the current time window
+		self._window = None
+		self._counts = {}
+		self._rate_limit_lock = Lock()
+
+		if self.auth.AUTH_ENABLE_AVAILABILITY_ENDPOINT:
+			from flask.signals import signals_available
+			from . import signals
+			if not signals_available:
+				raise ConfigError('AUTH_ENABLE_AVAILABILITY_ENDPOINT requires blinker: pip install blinker')
+			# Values taken after the filter was built are added when they are taken
+			for signal in (signals.auth_registered, signals.auth_changed_username, signals.auth_changed_email):
+				signal.connect(self._on_user_changed, app, weak=False)
+
+	def is_available(self, field_name, value):
+		"""
+		Check if ``value`` is available for the unique User field ``field_name`` ('username' or 'email').
+
+		| Values that the Bloom filter has never seen are available without a DB query.
+		| The others (taken, or false positives) are checked in the DB.
+		"""
+		if self.filter is None:
+			self._build(rebuild=False)
+		if self._key(field_name, value) not in self.filter:
+			return True
+		return self.auth.db_manager.is_user_field_available(field_name, value)
+
+	def build(self):
+		"""
+		(Re)build the Bloom filter with a streaming scan of all the users.
+		Call it at startup or from a scheduled job: values released since the last build
+		(after a username change) are otherwise checked in the DB.
+		"""
+		self._build(rebuild=True)
+
+	def _build(self, rebuild):
+		# Build the Bloom filter. Unless ``rebuild``, a filter built by a concurrent request is kept.
+		with self._build_lock:
+			if self.filter is not None and not rebuild:
+				return
+			with self._filter_lock:
+				self._pending_keys = []
+			try:
+				db_manager = self.auth.db_manager
+				bloom_filter = BloomFilter(self.auth.AUTH_AVAILABILITY_FILTER_CAPACITY, self.auth.AUTH_AVAILABILITY_FILTER_ERROR_RATE)
+				for users in db_manager.db_adapter.iter_objects_in_batches(db_manager.UserClass):
+					for user in users:
+						for key in self._user_keys(user):
+							bloom_filter.add(key)
+			except BaseException:
+				with self._filter_lock:
+					self._pending_keys = None
+				raise
+			with self._filter_lock:
+				for key in self._pending_keys:
+					bloom_filter.add(key)
+				self._pending_keys = None
+				self.filter = bloom_filter
+
+	def check_rate_limit(self, client):
+		"""
+		Count a check of ``client`` (an IP address) in the current minute.
+
+		| Returns 0 if the check is allowed.
+		| Returns the number of seconds until the next window otherwise.
+		"""
+		now = monotonic()
+		window = int(now // 60)
+		with self._rate_limit_lock:
+			if window != self._window:
+				# Forget the previous window: the counts never hold more than a minute of clients
+				self._window = window
+				self._counts = {}
+			count = self._counts[client] = self._counts.get(client, 0) + 1
+		if count <= self.auth.AUTH_AVAILABILITY_RATE_LIMIT:
+			return 0
+		return int(60 - now % 60) + 1
+
+	def _key(self, field_name, value):
+		# The filter holds canonical values: each DB-level duplicate of a value maps to the same key
+		return '%s#%s' % (field_name, canonicalize(value or ''))
+
+	def _user_keys(self, user):
+		# The filter keys of the values of ``user``
+		return [self._key(field_name, getattr(user, field_name)) for field_name in ('username', 'email')
+			if getattr(user, field_name, None)]
+
+	def _on_user_changed(self, sender, user=None, **extra):
+		if user is None:
+			return
+		keys = self._user_keys(user)
+		with self._filter_lock:
+			if self.filter is not None:
+				for key in keys:
+					self.filter.add(key)
+			if self._pending_keys is not None:
+				# A build is scanning the users: make sure that the new filter has the keys
+				self._pending_keys.extend(keys)
@@ -0,0 +1,52 @@
+"""
+This module defines the Flask-Auth command line interface.
+The commands are registered as the ``flask auth`` command group.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+auth_cli = AppGroup('auth', help='Flask-Auth maintenance commands.')
+
+@auth_cli.command('backfill-roles-mask')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of users updated per transaction.')
+def backfill_roles_mask(batch_size):
+	"""Populate the roles bitmask of existing users (AUTH_ENABLE_ROLES_BITMASK)."""
+	auth = current_app.auth
+	if not auth.AUTH_ENABLE_ROLES_BITMASK:
+		raise click.ClickException('AUTH_ENABLE_ROLES_BITMASK is not enabled.')
+	count = auth.db_manager.backfill_roles_masks(batch_size)
+	click.echo('Updated the roles bitmask of %d users.' % count)
+
+@auth_cli.command('backfill-canonical-fields')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of users updated per transaction.')
+def backfill_canonical_fields(batch_size):
+	"""Populate the canonical username and email fields of existing users (AUTH_ENABLE_CANONICAL_FIELDS)."""
+	auth = current_app.auth
+	if not auth.AUTH_ENABLE_CANONICAL_FIELDS:
+		raise click.ClickException('AUTH_ENABLE_CANONICAL_FIELDS is not enabled.')
+	count = auth.db_manager.backfill_canonical_fields(batch_size)
+	click.echo('Updated the canonical fields of %d users.' % count)
+
+@auth_cli.command('backfill-lower-fields')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of users updated per transaction.')
+def backfill_lower_fields(batch_size):
+	"""Populate the lowercase username_lower and email_lower fields of existing users (DynamoDB)."""
+	auth = current_app.auth
+	count = auth.db_manager.backfill_lower_fields(batch_size)
+	click.echo('Updated the lowercase fields of %d users.' % count)
+
+@auth_cli.command('rebalance-shards')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of users moved per transaction.')
+@click.option('--retired-bind', 'retired_binds', multiple=True, help='Bind key of a removed shard to empty (repeatable).')
+def rebalance_shards(batch_size, retired_binds):
+	"""Move the users to the shard of their ID after a change of AUTH_SHARD_BINDS."""
+	auth = current_app.auth
+	if not auth.AUTH_SHARD_BINDS:
+		raise click.ClickException('AUTH_SHARD_BINDS is not set.')
+	count = auth.db_manager.rebalance_shards(batch_size, retired_binds)
+	click.echo('Moved %d users.' % count)
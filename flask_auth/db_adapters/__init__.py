@@ -1,5 +1,126 @@
+"""This package implements the DbAdapters and the DbAdapter registry.
+
+Adapter modules are imported on first use, and the Object-Database Mapper in use
+is detected from the ``db`` and ``UserClass`` types, so that unrelated ORMs are never imported.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import sys
+from importlib import import_module
+
 from .db_adapter_interface import DbAdapterInterface
-from .sql_db_adapter import SQLDbAdapter
-from .mongo_db_adapter import MongoDbAdapter
-from .dynamo_db_adapter import DynamoDbAdapter
-from .pynamo_db_adapter import PynamoDbAdapter
+
+# Registry of DbAdapters: name -> (import path, top-level packages of the supported ORM).
+# Detection follows registration order.
+_db_adapters = {}
+
+# Entry point group of third-party DbAdapters.
+# The entry point name is the adapter name and its value 'package.module:AdapterClass'.
+# AdapterClass.orm_packages lists the top-level packages of the ORM it supports.
+ENTRY_POINT_GROUP = 'flask_auth.db_adapters'
+_entry_points_loaded = False
+
+def register_db_adapter(name, import_path, orm_packages=()):
+    """
+    Register a DbAdapter.
+
+    Args:
+        name(str): The name used by the AUTH_DB_ADAPTER setting, for example 'sql'.
+        import_path(str): 'package.module:AdapterClass' ('.module:AdapterClass' for built-in adapters).
+        orm_packages: Top-level packages of the ORM, for example ('flask_sqlalchemy',).
+    """
+    _db_adapters[name] = (import_path, tuple(orm_packages))
+
+register_db_adapter('sql', '.sql_db_adapter:SQLDbAdapter', ('flask_sqlalchemy',))
+register_db_adapter('mongo', '.mongo_db_adapter:MongoDbAdapter', ('flask_mongoengine',))
+register_db_adapter('flywheel', '.dynamo_db_adapter:DynamoDbAdapter', ('flask_flywheel',))
+register_db_adapter('pynamo', '.pynamo_db_adapter:PynamoDbAdapter', ('pynamodb',))
+# Never detected: selected with AUTH_DB_ADAPTER='sharded'
+register_db_adapter('sharded', '.sharded_db_adapter:ShardedDbAdapter')
+
+def get_db_adapter_class(name, db, UserClass):
+    """
+    Returns the DbAdapter class named ``name``,
+    or the DbAdapter class detected from the ``db`` and ``UserClass`` types if ``name`` is empty.
+
+    | ``name`` may also be an import path: 'package.module:AdapterClass'.
+    | Returns None if no DbAdapter matches.
+    """
+    if name:
+        if name not in _db_adapters and ':' in name:
+            return _import_object(name)
+        if name not in _db_adapters:
+            _load_entry_points()
+        if name not in _db_adapters:
+            return None
+        return _import_object(_db_adapters[name][0])
+
+    # The ``db`` type identifies session-based ORMs, the ``UserClass`` type identifies model-based ORMs.
+    for packages in (_type_packages(type(db)), _type_packages(UserClass)):
+        DbAdapterClass = _detect(packages)
+        if DbAdapterClass is None and not _entry_points_loaded:
+            _load_entry_points()
+            DbAdapterClass = _detect(packages)
+        if DbAdapterClass is not None:
+            return DbAdapterClass
+    return None
+
+def _detect(packages):
+    # Returns the first registered DbAdapter class supporting one of ``packages``
+    for import_path, orm_packages in list(_db_adapters.values()):
+        if packages.intersection(orm_packages):
+            return _import_object(import_path)
+    return None
+
+def _type_packages(object_type):
+    # Returns the top-level packages of all the classes in the MRO of ``object_type``
+    return {klass.__module__.split('.')[0] for klass in getattr(object_type, '__mro__', ())}
+
+def _import_object(import_path):
+    # Import 'package.module:name'
+    module_name, _, object_name = import_path.partition(':')
+    return getattr(import_module(module_name, __name__), object_name)
+
+def _load_entry_points():
+    # Register the third-party DbAdapters declared in the 'flask_auth.db_adapters' entry point group
+    global _entry_points_loaded
+    _entry_points_loaded = True
+    try:
+        from importlib.metadata import entry_points
+        all_entry_points = entry_points()
+        if hasattr(all_entry_points, 'select'):
+            group_entry_points = all_entry_points.select(group=ENTRY_POINT_GROUP)
+        else:
+            group_entry_points = all_entry_points.get(ENTRY_POINT_GROUP, [])
+    except ImportError: # Python < 3.8
+        from pkg_resources import iter_entry_points
+        group_entry_points = iter_entry_points(ENTRY_POINT_GROUP)
+    for entry_point in group_entry_points:
+        if entry_point.name in _db_adapters:
+            continue
+        DbAdapterClass = entry_point.load()
+        import_path = '%s:%s' % (DbAdapterClass.__module__, DbAdapterClass.__name__)
+        register_db_adapter(entry_point.name, import_path, getattr(DbAdapterClass, 'orm_packages', ()))
+
+# The adapter classes are imported on first access
+_adapter_modules = {
+    'SQLDbAdapter': '.sql_db_adapter',
+    'MongoDbAdapter': '.mongo_db_adapter',
+    'DynamoDbAdapter': '.dynamo_db_adapter',
+    'PynamoDbAdapter': '.pynamo_db_adapter',
+    'ShardedDbAdapter': '.sharded_db_adapter',
+}
+
+def __getattr__(name):
+    if name not in _adapter_modules:
+        raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+    value = getattr(import_module(_adapter_modules[name], __name__), name)
+    globals()[name] = value
+    return value
+
+# Python < 3.7 has no module __getattr__ (PEP 562): import the adapter classes eagerly
+if sys.version_info < (3, 7): # pragma: no cover
+    for _name in _adapter_modules:
+        __getattr__(_name)
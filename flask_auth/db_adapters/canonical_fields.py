@@ -0,0 +1,49 @@
+"""This module implements the canonical shadow fields shared by the DbAdapters.
+
+With AUTH_ENABLE_CANONICAL_FIELDS, each unique User field (username, email) has a shadow field
+'<field><AUTH_CANONICAL_FIELD_SUFFIX>' holding its canonical form: NFKC-normalized, casefolded and trimmed.
+Lookups are exact matches on the shadow fields, which a plain unique index serves in every database.
+
+Without it, the DynamoDB adapters maintain '<field>_lower' shadow fields holding the lowercase values.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import unicodedata
+
+def canonicalize(value):
+    """Returns the canonical form of ``value``: NFKC-normalized, casefolded and trimmed."""
+    # casefold() may produce characters that are not NFKC-normalized: normalize again
+    return unicodedata.normalize('NFKC', unicodedata.normalize('NFKC', value).casefold()).strip()
+
+def lowercase(value):
+    """Returns the lowercase form of ``value``: the '<field>_lower' shadow field values."""
+    return value.lower()
+
+def get_shadow_fields_normalization(auth):
+    """Returns the (shadow field suffix, normalize function) pair of the case insensitive shadow fields."""
+    if auth.AUTH_ENABLE_CANONICAL_FIELDS:
+        return auth.AUTH_CANONICAL_FIELD_SUFFIX, canonicalize
+    return '_lower', lowercase
+
+def canonical_fields(auth):
+    """Returns the User fields that have a canonical shadow field with the current settings."""
+    fields = []
+    if auth.AUTH_ENABLE_CANONICAL_FIELDS:
+        if auth.AUTH_ENABLE_USERNAME:
+            fields.append('username')
+        if auth.AUTH_ENABLE_EMAIL:
+            fields.append('email')
+    return fields
+
+def canonical_value(value):
+    """Returns the shadow field value of ``value``. Empty values have no canonical form (None),
+    so that users without a username or email address do not collide in the unique indexes."""
+    return canonicalize(value) if value else None
+
+def set_canonical_fields(auth, object):
+    """Update the canonical shadow fields of ``object`` from its unique fields."""
+    suffix = auth.AUTH_CANONICAL_FIELD_SUFFIX
+    for field_name in canonical_fields(auth):
+        setattr(object, field_name + suffix, canonical_value(getattr(object, field_name, None)))
@@ -6,6 +6,13 @@
 
 from __future__ import print_function
 
+from contextlib import contextmanager
+from itertools import islice
+from time import perf_counter
+
+from .canonical_fields import get_shadow_fields_normalization
+from . import uniqueness_guards
+
 class DbAdapterInterface(object):
     """ Define the DbAdapter interface to manage objects in various databases.
 
@@ -22,6 +29,8 @@ class DbAdapterInterface(object):
         self.app = app
         self.db = db
         self.auth = self.app.auth
+        # Case insensitive shadow fields: suffix of their names, and normalization of their values
+        self.shadow_suffix, self.normalize = get_shadow_fields_normalization(self.auth)
 
     def add_object(self, object):
         """ Add a new object to the database.
@@ -39,6 +48,22 @@ class DbAdapterInterface(object):
         """
         raise NotImplementedError
 
+    def flush(self):
+        """Write the pending changes of the session objects to the database, without committing them.
+
+        | Session-based ODMs would call something like ``db.session.flush()``.
+        | Object-based ODMs would do nothing: their objects are written by ``save_object()``.
+        """
+        pass
+
+    def rollback(self):
+        """Discard the changes of the session objects that were not committed.
+
+        | Session-based ODMs would call something like ``db.session.rollback()``.
+        | Object-based ODMs would do nothing.
+        """
+        pass
+
     def delete_object(self, object):
         """ Delete object from database.
         """
@@ -65,6 +90,29 @@ class DbAdapterInterface(object):
         """
         raise NotImplementedError
 
+    def find_first_object_by_any(self, ObjectClass, filters, case_insensitive=False, snapshot_fields=None):
+        """ Retrieve the object of type ``ObjectClass`` matching the first of the ``filters``
+        (a list of (field name, value) pairs) that any object matches
+        -- case insensitive if ``case_insensitive`` is True (see ``ifind_first_object()``).
+
+        | Returns a UserSnapshot hydrated from ``snapshot_fields`` if given and the adapter supports snapshots.
+        | Returns None if no object matches any filter.
+        | Adapters override this method to run a single query: this one runs one per filter.
+        """
+        for field_name, field_value in filters:
+            kwargs = {field_name: field_value}
+            if snapshot_fields and case_insensitive:
+                object = self.ifind_first_object_snapshot(ObjectClass, snapshot_fields, **kwargs)
+            elif snapshot_fields:
+                object = self.find_first_object_snapshot(ObjectClass, snapshot_fields, **kwargs)
+            elif case_insensitive:
+                object = self.ifind_first_object(ObjectClass, **kwargs)
+            else:
+                object = self.find_first_object(ObjectClass, **kwargs)
+            if object is not None:
+                return object
+        return None
+
     def get_object(self, ObjectClass, id):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
 
@@ -73,6 +121,97 @@ class DbAdapterInterface(object):
         """
         raise NotImplementedError
 
+    def get_object_snapshot(self, ObjectClass, id, field_names):
+        """ Retrieve a UserSnapshot of the object of type ``ObjectClass`` by ``id``,
+        hydrated from the fields of ``field_names`` only.
+
+        | Returns the snapshot on success.
+        | Returns None otherwise.
+        | Adapters without a fast path return the full object, which has the same attributes.
+        """
+        return self.get_object(ObjectClass, id)
+
+    def find_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case sensitive --
+        hydrated from the fields of ``field_names`` only.
+
+        | Adapters without a fast path return the full object, which has the same attributes.
+        """
+        return self.find_first_object(ObjectClass, **kwargs)
+
+    def ifind_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive --
+        hydrated from the fields of ``field_names`` only.
+
+        | Adapters without a fast path return the full object, which has the same attributes.
+        """
+        return self.ifind_first_object(ObjectClass, **kwargs)
+
+    def make_snapshot(self, ObjectClass, data):
+        """ Returns a UserSnapshot of the object of type ``ObjectClass`` hydrated from ``data``
+        (field name -> value, including 'id'), which loads the full object with ``get_object()``
+        on first access to any other attribute.
+
+        | Assignments load the full object and are made on it.
+        | Adapters that save snapshots with a partial update record the assignments instead.
+        """
+        from ..user_snapshot import UserSnapshot
+
+        id = data['id']
+        return UserSnapshot.for_class(ObjectClass)(data, lambda: self.get_object(ObjectClass, id), records_changes=False)
+
+    def bulk_add_user_roles(self, UserClass, user_ids, roles):
+        """ Associate ``roles`` with all the users of ``user_ids``, with as few database round trips as possible.
+
+        | ``roles`` is a list of Role objects for ODMs with a roles table,
+            and a list of role names otherwise.
+        | Existing associations are left untouched.
+        """
+        raise NotImplementedError
+
+    def get_objects(self, ObjectClass, ids):
+        """ Retrieve the objects of type ``ObjectClass`` whose ID is in ``ids``.
+
+        | Returns a list of the objects found, in no particular order.
+        | Adapters override this method to fetch all objects in a single round trip.
+        """
+        objects = (self.get_object(ObjectClass, id) for id in ids)
+        return [object for object in objects if object is not None]
+
+    def is_available(self, ObjectClass, field_name, value):
+        """ Check if no object of type ``ObjectClass`` has ``value`` in its unique field ``field_name``
+        -- case insensitive.
+
+        | Returns True if ``value`` is available.
+        | Returns False otherwise.
+        """
+        return self.ifind_first_object(ObjectClass, **{field_name: value}) is None
+
+    def iter_objects_in_batches(self, ObjectClass, batch_size=1000):
+        """ Iterate over all objects of type ``ObjectClass``, in lists of at most ``batch_size`` objects.
+
+        | Meant for maintenance tasks (backfills) on large tables:
+        | the objects of a batch may be modified before moving to the next one.
+        | Adapters override this method when ``find_objects()`` results are not streamed.
+        """
+        objects = iter(self.find_objects(ObjectClass))
+        while True:
+            batch = list(islice(objects, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def update_lower_fields(self, object):
+        """ Update the 'field_lower' shadow fields of ``object`` that are outdated,
+        for the adapters that maintain them (DynamoDB: see their ``ifind_first_object()``).
+
+        | Returns True if any was.
+        | Returns False for the adapters without shadow fields.
+        """
+        return False
+
     def save_object(self, object):
         """ Save object to database.
 
@@ -81,6 +220,57 @@ class DbAdapterInterface(object):
         """
         raise NotImplementedError
 
+    def get_unique_values(self, object):
+        """ Returns the (ObjectClass, id, {field name: value}) of the unique User fields (username, email)
+        of ``object``, or None if it is not a User object.
+
+        Taken before a write, to tell which field a unique index rejected (see ``get_unique_constraint_error()``).
+        """
+        if not isinstance(object, self.auth.db_manager.UserClass):
+            return None
+        values = {field_name: getattr(object, field_name, None) for field_name in uniqueness_guards.guarded_fields(self.auth)}
+        return type(object), object.id, values
+
+    def get_unique_constraint_error(self, unique_values):
+        """ Returns a UniqueConstraintError for the first of the unique values (see ``get_unique_values()``)
+        that another object holds -- case insensitive -- or None.
+
+        Called after a write failed on a unique index, whose error does not tell the field portably.
+        """
+        from .. import UniqueConstraintError
+
+        for ObjectClass, id, values in unique_values:
+            for field_name, value in values.items():
+                if not value:
+                    continue
+                other = self.ifind_first_object(ObjectClass, **{field_name: value})
+                if other is not None and other.id != id:
+                    return UniqueConstraintError(field_name, value)
+        return None
+
+    # Instrumentation
+    # ---------------
+
+    @contextmanager
+    def timed_operation(self, operation, ObjectClass=None, **extra):
+        """ Time the database operation run in the ``with`` block
+        and send the ``auth_db_operation`` signal with its duration,
+        and with the ``extra`` keyword arguments (such as the ``bind`` that served a SQL read).
+
+        Nothing is timed when the signal has no receivers.
+        """
+        from ..signals import auth_db_operation
+
+        if not getattr(auth_db_operation, 'receivers', None):
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            auth_db_operation.send(
+                self.app, adapter=self, operation=operation, model=ObjectClass,
+                duration=perf_counter() - start, **extra)
 
     # Database management methods
     # ---------------------------
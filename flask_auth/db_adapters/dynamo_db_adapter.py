@@ -5,11 +5,11 @@
 # Copyright (c) 2019 Alejandro Alvarez
 
 from __future__ import print_function
-import pdb
 
 # Non-system imports are moved into the methods to make them an optional requirement
 
 from .db_adapter_interface import DbAdapterInterface
+from . import uniqueness_guards
 
 
 class DynamoDbAdapter(DbAdapterInterface):
@@ -27,14 +27,16 @@ class DynamoDbAdapter(DbAdapterInterface):
         |    db = Flywheel()
         |    db_adapter = DynamoDbAdapter(app, db)
         """
-        # This no-op method is defined to show it in Sphinx docs in order 'bysource'
         super(DynamoDbAdapter, self).__init__(app, db)
+        # Model of the uniqueness guard items (see AUTH_UNIQUENESS_GUARD_TABLE), registered on first use
+        self._GuardClass = None
 
     def add_object(self, object):
         """Add object to db session. Only for session-centric object-database mappers."""
         if object.id is None:
             object.get_id()
-        self.db.engine.save(object)
+        with self.timed_operation('add_object', type(object)):
+            self._save(object, self.db.engine.save)
 
     def get_object(self, ObjectClass, id):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
@@ -42,57 +44,56 @@ class DynamoDbAdapter(DbAdapterInterface):
         | Returns object on success.
         | Returns None otherwise.
         """
-        print('dynamo.get(%s, %s)' % (ObjectClass, str(id)))
-        resp = self.db.engine.get(ObjectClass, [id])
+        with self.timed_operation('get_object', ObjectClass):
+            resp = self.db.engine.get(ObjectClass, [id])
         if resp:
-            return resp[0]
+            return self._remember_guard_keys(resp[0])
         else:
             return None
 
-    def find_objects(self, ObjectClass, **kwargs):
-        """ Retrieve all objects of type ``ObjectClass``,
-        matching the filters specified in ``**kwargs`` -- case sensitive.
-        """
+    def get_objects(self, ObjectClass, ids):
+        """ Retrieve the objects of type ``ObjectClass`` whose ID is in ``ids``.
 
-        print('dynamo.find_objects(%s, %s)' % (ObjectClass, str(kwargs)))
+        Flywheel splits the IDs into BatchGetItem requests of the allowed size.
+        """
+        with self.timed_operation('get_objects', ObjectClass):
+            objects = self.db.engine.get(ObjectClass, list(ids))
+        return [self._remember_guard_keys(object) for object in objects]
 
-        query = self.db.engine.query(ObjectClass)
-        for field_name, field_value in kwargs.items():
+    def is_available(self, ObjectClass, field_name, value):
+        """ Check if no object of type ``ObjectClass`` has ``value`` in its unique field ``field_name``
+        -- case insensitive.
 
-            # Make sure that ObjectClass has a 'field_name' property
-            field = getattr(ObjectClass, field_name, None)
-            if field is None:
-                raise KeyError("DynamoDBAdapter.find_objects(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
+        Uses a single GetItem on the guard table if the field is guarded (see AUTH_UNIQUENESS_GUARD_TABLE).
+        """
+        if not self._is_guarded(ObjectClass) or field_name not in uniqueness_guards.guarded_fields(self.auth):
+            return super(DynamoDbAdapter, self).is_available(ObjectClass, field_name, value)
+        key = uniqueness_guards.guard_key(field_name, value)
+        with self.timed_operation('is_available', ObjectClass):
+            return self.db.engine.get(self._get_guard_class(), pk=key, consistent=True) is None
 
-            # Add a case sensitive filter to the query
-            query = query.filter(field == field_value)
+    def find_objects(self, ObjectClass, **kwargs):
+        """ Retrieve all objects of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case sensitive.
 
-        # Execute query
-        return query.all(desc=True)
+        Uses a Query when one of the filters is the hash key of the table or of a global index,
+        and a Scan otherwise.
+        """
+        with self.timed_operation('find_objects', ObjectClass):
+            objects = self._build_query(ObjectClass, kwargs, 'find_objects').all()
+        return [self._remember_guard_keys(object) for object in objects]
 
     def find_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the filters specified in ``**kwargs`` -- case sensitive.
 
         ``find_first_object(User, username='myname')`` translates to
-        ``User.query.filter(User.username=='myname').first()``.
+        ``engine.query(User).filter(User.username=='myname').first()``
+        (or to a Scan if ``username`` is not the hash key of an index).
         """
-
-        print('dynamo.find_first_object(%s, %s)' % (ObjectClass, str(kwargs)))
-        query = self.db.engine.query(ObjectClass)
-        for field_name, field_value in kwargs.items():
-
-            # Make sure that ObjectClass has a 'field_name' property
-            field = getattr(ObjectClass, field_name, None)
-            if field is None:
-                raise KeyError("DynamoDBAdapter.find_first_object(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
-
-            # Add a case sensitive filter to the query
-            query = query.filter(field == field_value)
-
-        # Execute query
-        out = query.first(desc=True)#, attributes=['password'])
-        return out
+        with self.timed_operation('find_first_object', ObjectClass):
+            out = self._build_query(ObjectClass, kwargs, 'find_first_object').first()
+        return self._remember_guard_keys(out) if out is not None else None
 
     def ifind_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
@@ -100,38 +101,204 @@ class DynamoDbAdapter(DbAdapterInterface):
 
         | If AUTH_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
         | If AUTH_IFIND_MODE is 'ifind' this method performs a case insensitive find.
+
+        DynamoDB has no case insensitive search. For each ``field`` filter, a ``field_lower``
+        normalized field holding the lowercase value, maintained by this adapter, is used when the model has one
+        (the ``field`` canonical shadow field if AUTH_ENABLE_CANONICAL_FIELDS is True).
+        Make it the hash key of a global index to turn the lookup into a single Query.
+        Run ``flask auth backfill-lower-fields`` after adding normalized fields to a table with existing users.
         """
         # Call regular find() if AUTH_IFIND_MODE is nocase_collation
         if self.auth.AUTH_IFIND_MODE=='nocase_collation':
             return self.find_first_object(ObjectClass, **kwargs)
 
-        raise NotImplementedError
+        fields = ObjectClass.meta_.fields
+        filters = {}
+        python_filters = {}
+        for field_name, field_value in kwargs.items():
+            if not isinstance(field_value, str):
+                filters[field_name] = field_value
+            elif field_name + self.shadow_suffix in fields:
+                filters[field_name + self.shadow_suffix] = self.normalize(field_value)
+            else:
+                python_filters[field_name] = self.normalize(field_value)
+
+        with self.timed_operation('ifind_first_object', ObjectClass):
+            query = self._build_query(ObjectClass, filters, 'ifind_first_object')
+            if not python_filters:
+                out = query.first()
+            else:
+                # Without a normalized field, we have to scan and normalize in Python
+                out = None
+                for object in query.gen():
+                    if all(self.normalize(getattr(object, k, None) or '') == v for k, v in python_filters.items()):
+                        out = object
+                        break
+        return self._remember_guard_keys(out) if out is not None else None
+
+    def bulk_add_user_roles(self, UserClass, user_ids, roles):
+        """ Associate ``roles`` (role names) with all the users of ``user_ids``.
+
+        Users are read with a BatchGetItem and written back with BatchWriteItem requests.
+        """
+        users = self.db.engine.get(UserClass, list(user_ids))
+        changed_users = []
+        for user in users:
+            missing_roles = [role for role in roles if role not in user.roles]
+            if missing_roles:
+                user.roles = list(user.roles) + missing_roles
+                changed_users.append(user)
+        if changed_users:
+            self.db.engine.save(changed_users, overwrite=True)
+
+    def update_lower_fields(self, object):
+        """ Update the 'field_lower' (or canonical) normalized fields of ``object`` that are outdated
+        (see ``ifind_first_object()``).
+
+        Returns True if any was.
+        """
+        return self._set_lower_fields(object)
 
     def save_object(self, object, **kwargs):
         """ Save object. Only for non-session centric Object-Database Mappers."""
-        self.db.engine.sync(object)
+        from ..user_snapshot import unwrap_snapshot
+
+        # A UserSnapshot (see AUTH_USER_SNAPSHOT_CACHE_SIZE) is saved through its full User object
+        object = unwrap_snapshot(object)
+        with self.timed_operation('save_object', type(object)):
+            self._save(object, self.db.engine.sync)
 
     def delete_object(self, object):
         """ Delete object specified by ``object``. """
-        #pdb.set_trace()
-        self.db.engine.delete_key(object)#, userid='abc123', id='1')
-        print('dynamo.delete_object(%s)' % object)
-        #self.db.session.delete(object)
+        from ..user_snapshot import unwrap_snapshot
+
+        object = unwrap_snapshot(object)
+        with self.timed_operation('delete_object', type(object)):
+            self.db.engine.delete(object)
+            if self._is_guarded(object):
+                # Release the unique values of the user
+                # NB: only the values reserved by this object, as deletes cannot check the guard owner here
+                for key in uniqueness_guards.remembered_guard_keys(object).values():
+                    self.db.engine.delete_key(self._get_guard_class(), pk=key)
 
     def commit(self):
         """This method does nothing for DynamoDbAdapter.
         """
-        # pdb.set_trace()
-        print('dynamo.commit()')
-        #self.db.engine.sync()
-        # self.db.session.commit()
+        pass
+
+    # Queries
+    # -------
+
+    def _build_query(self, ObjectClass, kwargs, method_name):
+        # Returns a Flywheel Query if one of the filters is the hash key of the table or of a global index
+        # (Flywheel picks the index), and a Scan otherwise
+        hash_keys = set([ObjectClass.meta_.hash_key.name])
+        hash_keys.update(index.hash_key for index in ObjectClass.meta_.global_indexes)
+        if hash_keys.intersection(kwargs):
+            query = self.db.engine.query(ObjectClass)
+        else:
+            query = self.db.engine.scan(ObjectClass)
+        for field_name, field_value in kwargs.items():
+
+            # Make sure that ObjectClass has a 'field_name' property
+            field = getattr(ObjectClass, field_name, None)
+            if field is None:
+                raise KeyError("DynamoDBAdapter.%s(): Class '%s' has no field '%s'." % (method_name, ObjectClass, field_name))
 
+            # Add a case sensitive filter to the query
+            query = query.filter(field == field_value)
+        return query
+
+    def _set_lower_fields(self, object):
+        # Maintain the 'field_lower' (or canonical) normalized fields used by ifind_first_object()
+        # Empty values are not stored: they cannot be global index keys
+        # Returns True if any field was outdated.
+        fields = type(object).meta_.fields
+        suffix = self.shadow_suffix
+        outdated = False
+        for name in fields:
+            if name.endswith(suffix) and name[:-len(suffix)] in fields:
+                value = getattr(object, name[:-len(suffix)], None)
+                value = self.normalize(value) if value else None
+                if getattr(object, name, None) != value:
+                    setattr(object, name, value)
+                    outdated = True
+        return outdated
+
+    # Uniqueness guards
+    # -----------------
+
+    def _is_guarded(self, object_or_class):
+        # User objects are guarded if AUTH_UNIQUENESS_GUARD_TABLE is set
+        ObjectClass = object_or_class if isinstance(object_or_class, type) else type(object_or_class)
+        return bool(self.auth.AUTH_UNIQUENESS_GUARD_TABLE) and issubclass(ObjectClass, self.auth.db_manager.UserClass)
+
+    def _remember_guard_keys(self, object):
+        if self._is_guarded(object):
+            uniqueness_guards.remember_guard_keys(self.auth, object)
+        return object
+
+    def _get_guard_class(self):
+        # Returns the Model of the guard items, registered with the engine
+        if self._GuardClass is None:
+            from flywheel import Field, Model
+
+            class UniquenessGuard(Model):
+                __metadata__ = {'_name': self.auth.AUTH_UNIQUENESS_GUARD_TABLE}
+                pk = Field(hash_key=True)
+                owner = Field()
+            self.db.engine.register(UniquenessGuard)
+            self._GuardClass = UniquenessGuard
+        return self._GuardClass
+
+    def _save(self, object, write):
+        # Write ``object`` with ``write``; for a User object, first reserve its new unique values
+        # with conditional puts, and release its old ones once the User is written.
+        # Flywheel has no transactions: the reserved values are released again if the write fails.
+        from ..user_snapshot import unwrap_snapshot
+
+        object = unwrap_snapshot(object)
+        self._set_lower_fields(object)
+        if not self._is_guarded(object):
+            write(object)
+            return
+        from dynamo3 import CheckFailed
+        from .. import UniqueConstraintError
+
+        GuardClass = self._get_guard_class()
+        owner = str(object.id)
+        old_keys = uniqueness_guards.remembered_guard_keys(object)
+        new_keys = uniqueness_guards.current_guard_keys(self.auth, object)
+        reserved_keys = []
+        try:
+            for field_name, key in new_keys.items():
+                if key == old_keys.get(field_name):
+                    continue
+                try:
+                    self.db.engine.save(GuardClass(pk=key, owner=owner), overwrite=False)
+                except CheckFailed:
+                    guard = self.db.engine.get(GuardClass, pk=key, consistent=True)
+                    if guard is None or guard.owner != owner:
+                        raise UniqueConstraintError(field_name, getattr(object, field_name, None))
+                else:
+                    reserved_keys.append(key)
+            write(object)
+        except Exception:
+            for key in reserved_keys:
+                self.db.engine.delete_key(GuardClass, pk=key)
+            raise
+        for field_name, key in old_keys.items():
+            if new_keys.get(field_name) != key:
+                self.db.engine.delete_key(GuardClass, pk=key)
+        uniqueness_guards.remember_guard_keys(self.auth, object)
 
     # Database management methods
     # ---------------------------
 
     def create_all_tables(self):
-        """This method does nothing for DynamoDbAdapter."""
+        """Create the tables of all the models registered with the engine."""
+        if self.auth.AUTH_UNIQUENESS_GUARD_TABLE:
+            self._get_guard_class()
         self.db.engine.create_schema()
 
     def drop_all_tables(self):
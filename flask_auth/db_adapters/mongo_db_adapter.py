@@ -8,7 +8,11 @@ from __future__ import print_function
 
 # Non-system imports are moved into the methods to make them an optional requirement
 
+from contextlib import contextmanager
+
+from .canonical_fields import canonical_fields
 from .db_adapter_interface import DbAdapterInterface
+from . import uniqueness_guards
 
 
 class MongoDbAdapter(DbAdapterInterface):
@@ -35,7 +39,8 @@ class MongoDbAdapter(DbAdapterInterface):
         | Session-based ODMs would call something like ``db.session.add(object)``.
         | Object-based ODMs would call something like ``object.save()``.
         """
-        object.save()
+        with self._unique_constraint_errors(self.get_unique_values(object)):
+            object.save()
 
     def get_object(self, ObjectClass, id):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
@@ -67,32 +72,174 @@ class MongoDbAdapter(DbAdapterInterface):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case insensitive.
 
-        | If AUTH_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
-        | If AUTH_IFIND_MODE is 'ifind' this method performs a case insensitive find.
+        | If AUTH_IFIND_MODE is 'nocase_collation' this method performs a find with the AUTH_MONGO_COLLATION collation,
+            which uses the case insensitive unique indexes created by ``create_all_tables()``.
+        | If AUTH_IFIND_MODE is 'ifind' this method performs a case insensitive find
+            (a case insensitive regex, which cannot use an index).
+        """
+        # Retrieve first object -- case insensitive
+        return self._ifind_queryset(ObjectClass, kwargs).first()
+
+    def get_object_snapshot(self, ObjectClass, id, field_names):
+        """ Retrieve a UserSnapshot of the object of type ``ObjectClass`` by ``id``,
+        hydrated from the fields of ``field_names`` only.
+
+        | The fields are projected by the query and returned as a raw PyMongo document:
+            no Document instance is built and no reference is dereferenced.
+        | Returns None if no object has this ``id``.
+        """
+        field_names = self._get_snapshot_field_names(ObjectClass, field_names)
+        document = ObjectClass.objects(id=id).only(*field_names).as_pymongo().first()
+        return self._make_snapshot(ObjectClass, field_names, document)
+
+    def find_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case sensitive --
+        hydrated from the fields of ``field_names`` only (see ``get_object_snapshot()``).
+        """
+        field_names = self._get_snapshot_field_names(ObjectClass, field_names)
+        document = ObjectClass.objects(**kwargs).only(*field_names).as_pymongo().first()
+        return self._make_snapshot(ObjectClass, field_names, document)
+
+    def ifind_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive --
+        hydrated from the fields of ``field_names`` only (see ``get_object_snapshot()``).
         """
-        # Call regular find() if AUTH_IFIND_MODE is nocase_collation
+        field_names = self._get_snapshot_field_names(ObjectClass, field_names)
+        document = self._ifind_queryset(ObjectClass, kwargs).only(*field_names).as_pymongo().first()
+        return self._make_snapshot(ObjectClass, field_names, document)
+
+    def find_first_object_by_any(self, ObjectClass, filters, case_insensitive=False, snapshot_fields=None):
+        """ Retrieve the object of type ``ObjectClass`` matching the first of the ``filters``
+        (a list of (field name, value) pairs) that any object matches.
+
+        | Translates to a single ``$or`` query on the unique fields of the filters,
+            returning at most one document per filter. The preferred one is picked in Python.
+        | Returns a UserSnapshot hydrated from ``snapshot_fields`` if given (see ``get_object_snapshot()``).
+        """
+        from mongoengine.queryset.visitor import Q
+
+        collation = case_insensitive and self.auth.AUTH_IFIND_MODE == 'nocase_collation'
+        suffix = '__iexact' if case_insensitive and not collation else ''
+        query = None
+        for field_name, field_value in filters:
+            condition = Q(**{field_name + suffix: field_value})
+            query = condition if query is None else query | condition
+        queryset = ObjectClass.objects(query).limit(len(filters))
+        if collation:
+            queryset = queryset.collation(dict(self.auth.AUTH_MONGO_COLLATION))
+        if snapshot_fields:
+            # The filter fields are projected as well, to pick the preferred snapshot
+            field_names = self._get_snapshot_field_names(
+                ObjectClass, list(snapshot_fields) + [field_name for field_name, field_value in filters])
+            candidates = [self._make_snapshot(ObjectClass, field_names, document)
+                for document in queryset.only(*field_names).as_pymongo()]
+        else:
+            candidates = list(queryset)
+
+        # Prefer the object matching the first filters
+        for field_name, field_value in filters:
+            for candidate in candidates:
+                candidate_value = getattr(candidate, field_name, None)
+                if candidate_value == field_value or (case_insensitive and isinstance(candidate_value, str)
+                        and candidate_value.lower() == field_value.lower()):
+                    return candidate
+        return candidates[0] if candidates else None
+
+    def _ifind_queryset(self, ObjectClass, kwargs):
+        # Query with the collation of the case insensitive indexes if AUTH_IFIND_MODE is nocase_collation
         if self.auth.AUTH_IFIND_MODE=='nocase_collation':
-            return self.find_first_object(ObjectClass, **kwargs)
+            return ObjectClass.objects(**kwargs).collation(dict(self.auth.AUTH_MONGO_COLLATION))
 
         # Convert ...(email=value) to ...(email__iexact=value)
         iexact_kwargs = {}
         for key, value in kwargs.items():
             iexact_kwargs[key+'__iexact'] = value
-        # Retrieve first object -- case insensitive
-        return ObjectClass.objects(**iexact_kwargs).first()
+        return ObjectClass.objects(**iexact_kwargs)
+
+    def _get_snapshot_field_names(self, ObjectClass, field_names):
+        # The fields of ``field_names`` that ``ObjectClass`` has: projecting an unknown field is an error
+        return [field_name for field_name in field_names if field_name in ObjectClass._fields]
+
+    def make_snapshot(self, ObjectClass, data):
+        """ Returns a UserSnapshot of the object of type ``ObjectClass`` hydrated from ``data``
+        (see ``DbAdapterInterface.make_snapshot()``).
+
+        Assignments are recorded, and saved with a partial update (see ``save_object()``).
+        """
+        from ..user_snapshot import UserSnapshot
+
+        id = data['id']
+        return UserSnapshot.for_class(ObjectClass)(data, lambda: self.get_object(ObjectClass, id))
+
+    def _make_snapshot(self, ObjectClass, field_names, document):
+        # Hydrate a UserSnapshot from a raw PyMongo document (keyed by db_field)
+        if document is None:
+            return None
+        data = {}
+        for field_name in field_names:
+            field = ObjectClass._fields[field_name]
+            value = document.get(field.db_field)
+            if value is None:
+                # Fields missing from the document take their default value, as in a Document
+                value = field.default() if callable(field.default) else field.default
+            else:
+                value = field.to_python(value)
+            data[field_name] = value
+        return self.make_snapshot(ObjectClass, data)
+
+    def bulk_add_user_roles(self, UserClass, user_ids, roles):
+        """ Associate ``roles`` (role names) with all the users of ``user_ids``.
+
+        Translates to a single ``update_many()`` with ``$addToSet``.
+        """
+        UserClass.objects(id__in=list(user_ids)).update(add_to_set__roles=list(roles))
 
     def save_object(self, object, **kwargs):
         """ Save object to database.
 
         | Session-based ODMs would do nothing.
         | Object-based ODMs would do something like object.save().
+        | A UserSnapshot whose full object has not been loaded is saved with a partial update
+            of its assigned fields (``$set``).
         """
-        object.save()
+        from ..user_snapshot import UserSnapshot
+
+        if isinstance(object, UserSnapshot) and not object.is_loaded():
+            changes = object.pop_changes()
+            if changes:
+                update_kwargs = {'set__' + field_name: value for field_name, value in changes.items()}
+                unique_fields = uniqueness_guards.guarded_fields(self.auth)
+                unique_values = (object._snapshot_of, object.id, {k: v for k, v in changes.items() if k in unique_fields})
+                with self._unique_constraint_errors(unique_values):
+                    object._snapshot_of.objects(id=object.id).update_one(**update_kwargs)
+            return
+        if isinstance(object, UserSnapshot):
+            object = object.get_object()
+        with self._unique_constraint_errors(self.get_unique_values(object)):
+            object.save()
+
+    @contextmanager
+    def _unique_constraint_errors(self, unique_values):
+        # Turn a NotUniqueError (DuplicateKeyError on a unique index) raised by the write in the ``with`` block
+        # into a UniqueConstraintError, when the written User holds a username or email address that another user has.
+        from mongoengine.errors import NotUniqueError
+
+        try:
+            yield
+        except NotUniqueError:
+            error = self.get_unique_constraint_error([unique_values]) if unique_values else None
+            if error is None:
+                raise
+            raise error
 
     def delete_object(self, object):
         """ Delete object from database.
         """
-        object.delete()
+        from ..user_snapshot import unwrap_snapshot
+
+        unwrap_snapshot(object).delete()
 
     def commit(self):
         """Save all modified session objects to the database.
@@ -107,8 +254,37 @@ class MongoDbAdapter(DbAdapterInterface):
     # ---------------------------
 
     def create_all_tables(self):
-        """This method does nothing for MongoDbAdapter."""
-        pass
+        """Create the case insensitive unique indexes on the username and email fields of the User collection.
+
+        | The indexes use the AUTH_MONGO_COLLATION collation (strength 2: case insensitive),
+            so that 'nocase_collation' lookups are index scans.
+        | If AUTH_ENABLE_CANONICAL_FIELDS is True, plain unique indexes are created on the canonical shadow fields.
+        | MongoEngine creates the collections and their declared indexes on first use.
+        """
+        from pymongo import ASCENDING
+        from pymongo.collation import Collation
+
+        UserClass = self.auth.db_manager.UserClass
+        collection = UserClass._get_collection()
+        field_names = []
+        if self.auth.AUTH_ENABLE_USERNAME:
+            field_names.append('username')
+        if self.auth.AUTH_ENABLE_EMAIL:
+            field_names.append('email')
+        for field_name in field_names:
+            field = UserClass._fields.get(field_name)
+            if field is None:
+                continue
+            collection.create_index(
+                [(field.db_field, ASCENDING)], name=field.db_field + '_nocase', unique=True,
+                # Users without a username or email address do not collide
+                sparse=True,
+                collation=Collation(**self.auth.AUTH_MONGO_COLLATION))
+        for field_name in canonical_fields(self.auth):
+            field = UserClass._fields.get(field_name + self.auth.AUTH_CANONICAL_FIELD_SUFFIX)
+            if field is None:
+                continue
+            collection.create_index([(field.db_field, ASCENDING)], name=field.db_field + '_unique', unique=True, sparse=True)
 
     def drop_all_tables(self):
         """Drop all document collections of the database.
@@ -2,9 +2,103 @@
 
 from __future__ import print_function
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+
 # Non-system imports are moved into the methods to make them an optional requirement
 
 from .db_adapter_interface import DbAdapterInterface
+from . import uniqueness_guards
+
+
+class ParallelScan(object):
+    """ Iterate over a Scan split into ``total_segments`` segments, scanned in parallel by a thread pool.
+
+    | Objects are yielded as soon as any segment returns them, in no particular order.
+    | ``last_evaluated_keys`` maps each segment to the key of its last object handed to the caller
+        (None once the segment is complete). Pass it back to resume an interrupted scan:
+        objects are yielded at least once.
+    """
+
+    # Objects buffered between the segment threads and the caller
+    queue_size = 1000
+
+    def __init__(self, ObjectClass, filter_condition=None, total_segments=4, rate_limit=None,
+            last_evaluated_keys=None, **scan_kwargs):
+        """Args:
+            ObjectClass: The PynamoDB Model class.
+            filter_condition: Optional PynamoDB condition.
+            total_segments(int): Number of segments, scanned by as many threads.
+            rate_limit(float): Optional cap on the read capacity units consumed per second, by all segments together.
+                Each running segment is throttled by PynamoDB to its share of it.
+            last_evaluated_keys(dict): The ``last_evaluated_keys`` of a previous scan, to resume it.
+            scan_kwargs: Other ``Model.scan()`` arguments, such as ``page_size`` or ``attributes_to_get``.
+        """
+        self.ObjectClass = ObjectClass
+        self.filter_condition = filter_condition
+        self.total_segments = total_segments
+        self.scan_kwargs = scan_kwargs
+        self.last_evaluated_keys = dict(last_evaluated_keys or {})
+        self.rate_limit = rate_limit
+
+    def __iter__(self):
+        segments = [segment for segment in range(self.total_segments)
+            if segment not in self.last_evaluated_keys or self.last_evaluated_keys[segment] is not None]
+        if not segments:
+            return
+        queue = Queue(self.queue_size)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            for segment in segments:
+                executor.submit(self._scan_segment, segment, len(segments), queue, stop)
+            try:
+                running = len(segments)
+                while running:
+                    segment, object, key, error = queue.get()
+                    if error is not None:
+                        raise error
+                    if object is None:
+                        # The segment is complete
+                        running -= 1
+                        self.last_evaluated_keys[segment] = None
+                        continue
+                    yield object
+                    self.last_evaluated_keys[segment] = key
+            finally:
+                # The caller may stop early: let the segment threads exit
+                stop.set()
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        break
+
+    def _scan_segment(self, segment, running_segments, queue, stop):
+        # Scan one segment and feed its objects to ``queue``, until done or stopped
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        try:
+            scan_kwargs = dict(self.scan_kwargs)
+            if self.rate_limit:
+                # The capacity is split evenly between the segments of this scan (fewer when resuming)
+                scan_kwargs['rate_limit'] = float(self.rate_limit) / running_segments
+            results = self.ObjectClass.scan(
+                self.filter_condition, segment=segment, total_segments=self.total_segments,
+                last_evaluated_key=self.last_evaluated_keys.get(segment), **scan_kwargs)
+            for object in results:
+                if not put((segment, object, results.last_evaluated_key, None)):
+                    return
+            put((segment, None, None, None))
+        except Exception as error:
+            put((segment, None, None, error))
 
 
 class PynamoDbAdapter(DbAdapterInterface):
@@ -21,8 +115,11 @@ class PynamoDbAdapter(DbAdapterInterface):
         |    db = ignored
         |    db_adapter = PynamoDbAdapter(app, db)
         """
-        # This no-op method is defined to show it in Sphinx docs in order 'bysource'
         super(PynamoDbAdapter, self).__init__(app, db)
+        # ObjectClass -> {attribute name: ObjectClass or Global Secondary Index}, discovered on first use
+        self._indexes = {}
+        # Model of the uniqueness guard items (see AUTH_UNIQUENESS_GUARD_TABLE), created on first use
+        self._GuardClass = None
 
     def add_object(self, object):
         """ Add a new object to the database.
@@ -30,7 +127,7 @@ class PynamoDbAdapter(DbAdapterInterface):
         | Session-based ODMs would call something like ``db.session.add(object)``.
         | Object-based ODMs would call something like ``object.save()``.
         """
-        object.save()
+        self._save(object)
 
     def commit(self):
         """Save all modified session objects to the database.
@@ -42,30 +139,47 @@ class PynamoDbAdapter(DbAdapterInterface):
 
     def delete_object(self, object):
         """ Delete object from database.
+
+        The uniqueness guard items of a User object are deleted in the same transaction.
         """
-        object.delete()
+        from ..user_snapshot import unwrap_snapshot
+
+        object = unwrap_snapshot(object)
+        if not self._is_guarded(object):
+            object.delete()
+            return
+        from pynamodb.transactions import TransactWrite
+
+        GuardClass = self._get_guard_class()
+        owner = str(object.id)
+        guard_keys = uniqueness_guards.remembered_guard_keys(object) or uniqueness_guards.current_guard_keys(self.auth, object)
+        with TransactWrite(connection=self._get_guard_connection()) as transaction:
+            transaction.delete(object)
+            for key in guard_keys.values():
+                transaction.delete(GuardClass(key), condition=GuardClass.pk.does_not_exist() | (GuardClass.owner == owner))
 
     def find_objects(self, ObjectClass, **kwargs):
         """ Retrieve all objects of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
-        """
-        filter = None
-        for k, v in kwargs.items():
-            cond = ObjectClass.getattr(k) == v
-            filter = cond if filter is None else filter & cond
 
-        return ObjectClass.scan(filter)
+        Uses a Query on the table or on a Global Secondary Index when one of the filters is a hash key,
+        and a Scan otherwise.
+        """
+        if not self._is_guarded(ObjectClass):
+            return self._find(ObjectClass, kwargs)
+        return (uniqueness_guards.remember_guard_keys(self.auth, object) for object in self._find(ObjectClass, kwargs))
 
     def find_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
-        """
-        filter = None
-        for k, v in kwargs.items():
-            cond = getattr(ObjectClass, k) == v
-            filter = cond if filter is None else filter & cond
 
-        return list(ObjectClass.scan(filter, limit=1))[0]
+        Uses a Query on the table or on a Global Secondary Index when one of the filters is a hash key,
+        and a Scan otherwise.
+        """
+        # NB: limit=1 would apply before the filters: stop at the first match instead
+        for object in self.find_objects(ObjectClass, **kwargs):
+            return object
+        return None
 
     def ifind_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
@@ -73,33 +187,71 @@ class PynamoDbAdapter(DbAdapterInterface):
 
         | If AUTH_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
         | If AUTH_IFIND_MODE is 'ifind' this method performs a case insensitive find.
-        """
-        from pynamodb.attributes import UnicodeAttribute
 
+        DynamoDB has no case insensitive search. For each ``field`` filter, a ``field_lower``
+        shadow attribute holding the lowercase value, maintained by this adapter, is used when the model has one
+        (the ``field`` canonical shadow attribute if AUTH_ENABLE_CANONICAL_FIELDS is True).
+        Index it with a Global Secondary Index to turn the lookup into a single Query.
+        Run ``flask auth backfill-lower-fields`` after adding shadow attributes to a table with existing users.
+        """
         if self.auth.AUTH_IFIND_MODE == 'nocase_collation':
             return self.find_first_object(ObjectClass, **kwargs)
+        for object in self._ifind(ObjectClass, kwargs):
+            if self._is_guarded(ObjectClass):
+                uniqueness_guards.remember_guard_keys(self.auth, object)
+            return object
+        return None
 
-        # The below is horrendously slow on a large user database, but DynamoDB
-        # has no support for case insensitive search, so we have to scan.
-        # We try and be a little smart and use any non-unicode filters in the scan, thought.
-
-        tfilters = {k: v.lower() for k, v in kwargs.items() if type(getattr(ObjectClass, k)) == UnicodeAttribute}
+    def get_object_snapshot(self, ObjectClass, id, field_names):
+        """ Retrieve a UserSnapshot of the object of type ``ObjectClass`` by ``id``,
+        hydrated from the attributes of ``field_names`` only.
 
-        ntfilter = None
-        for k in [k for k in kwargs if k not in tfilters]:
-            cond = getattr(ObjectClass, k) == kwargs[k]
-            ntfilter = cond if ntfilter is None else ntfilter & cond
+        | The GetItem request reads these attributes only (``attributes_to_get``).
+        | Returns None if no object has this ``id``.
+        """
+        field_names = self._get_snapshot_field_names(ObjectClass, field_names)
+        try:
+            object = ObjectClass.get(id, consistent_read=self.auth.AUTH_PYNAMO_CONSISTENT_READ,
+                attributes_to_get=self._get_projection(ObjectClass, field_names))
+        except ObjectClass.DoesNotExist:
+            return None
+        return self._make_snapshot(ObjectClass, field_names, object)
 
-        for o in ObjectClass.scan(ntfilter):
-            for k in tfilters:
-                if getattr(o, k, None).lower() != kwargs[k]:
-                    break
-            else:
-                # all match
-                return o
+    def find_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case sensitive --
+        hydrated from the attributes of ``field_names`` only (see ``get_object_snapshot()``).
+        """
+        field_names = self._get_snapshot_field_names(ObjectClass, field_names)
+        for object in self._find(ObjectClass, kwargs, field_names):
+            return self._make_snapshot(ObjectClass, field_names, object)
+        return None
 
+    def ifind_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive --
+        hydrated from the attributes of ``field_names`` only (see ``get_object_snapshot()``).
+        """
+        if self.auth.AUTH_IFIND_MODE == 'nocase_collation':
+            return self.find_first_object_snapshot(ObjectClass, field_names, **kwargs)
+        field_names = self._get_snapshot_field_names(ObjectClass, field_names)
+        for object in self._ifind(ObjectClass, kwargs, field_names):
+            return self._make_snapshot(ObjectClass, field_names, object)
         return None
 
+    def bulk_add_user_roles(self, UserClass, user_ids, roles):
+        """ Associate ``roles`` (role names) with all the users of ``user_ids``.
+
+        Users are read with BatchGetItem and written back with BatchWriteItem requests
+        (PynamoDB splits both into requests of the allowed size).
+        """
+        with UserClass.batch_write() as batch:
+            for user in UserClass.batch_get(list(user_ids)):
+                missing_roles = [role for role in roles if role not in (user.roles or [])]
+                if missing_roles:
+                    user.roles = list(user.roles or []) + missing_roles
+                    batch.save(user)
+
     def get_object(self, ObjectClass, id):
         """ Retrieve object of type ``ObjectClass`` by ``id``.
 
@@ -107,9 +259,35 @@ class PynamoDbAdapter(DbAdapterInterface):
         | Returns None otherwise.
         """
         try:
-            return ObjectClass.get(id)
+            object = ObjectClass.get(id, consistent_read=self.auth.AUTH_PYNAMO_CONSISTENT_READ)
         except ObjectClass.DoesNotExist:
             return None
+        if self._is_guarded(ObjectClass):
+            uniqueness_guards.remember_guard_keys(self.auth, object)
+        return object
+
+    def is_available(self, ObjectClass, field_name, value):
+        """ Check if no object of type ``ObjectClass`` has ``value`` in its unique field ``field_name``
+        -- case insensitive.
+
+        Uses a single GetItem on the guard table if the field is guarded (see AUTH_UNIQUENESS_GUARD_TABLE).
+        """
+        if not self._is_guarded(ObjectClass) or field_name not in uniqueness_guards.guarded_fields(self.auth):
+            return super(PynamoDbAdapter, self).is_available(ObjectClass, field_name, value)
+        GuardClass = self._get_guard_class()
+        try:
+            GuardClass.get(uniqueness_guards.guard_key(field_name, value), consistent_read=True, attributes_to_get=['pk'])
+        except GuardClass.DoesNotExist:
+            return True
+        return False
+
+    def update_lower_fields(self, object):
+        """ Update the 'field_lower' (or canonical) shadow attributes of ``object`` that are outdated
+        (see ``ifind_first_object()``).
+
+        Returns True if any was.
+        """
+        return self._set_lower_attributes(object)
 
     def save_object(self, object):
         """ Save object to database.
@@ -117,7 +295,254 @@ class PynamoDbAdapter(DbAdapterInterface):
         | Session-based ODMs would do nothing.
         | Object-based ODMs would do something like object.save().
         """
-        object.save()
+        self._save(object)
+
+    def scan_objects(self, ObjectClass, filter_condition=None, last_evaluated_keys=None, **scan_kwargs):
+        """ Returns a ParallelScan over the objects of type ``ObjectClass`` matching ``filter_condition``.
+
+        | The scan is split into AUTH_PYNAMO_SCAN_SEGMENTS segments
+            and capped at AUTH_PYNAMO_SCAN_READ_CAPACITY read capacity units per second (if set).
+        | Use its ``last_evaluated_keys`` to resume an interrupted scan.
+        """
+        return ParallelScan(
+            ObjectClass, filter_condition,
+            total_segments=self.auth.AUTH_PYNAMO_SCAN_SEGMENTS,
+            rate_limit=self.auth.AUTH_PYNAMO_SCAN_READ_CAPACITY or None,
+            last_evaluated_keys=last_evaluated_keys, **scan_kwargs)
+
+    # Index-backed lookups
+    # --------------------
+
+    def _find(self, ObjectClass, kwargs, field_names=None):
+        # Returns an iterator over the objects matching ``kwargs``,
+        # querying the table or a Global Secondary Index whose hash key is one of the filters.
+        # Reads the attributes of ``field_names`` (and of the filters) only, if given.
+        key_name, key_value, index = None, None, None
+        indexes = self._get_indexes(ObjectClass)
+        for name, value in kwargs.items():
+            if name in indexes:
+                key_name, key_value, index = name, value, indexes[name]
+                break
+        else:
+            # A case sensitive filter can narrow down a query on the 'field_lower' shadow attribute
+            for name, value in kwargs.items():
+                if name + self.shadow_suffix in indexes and isinstance(value, str):
+                    key_name, key_value, index = name + self.shadow_suffix, self.normalize(value), indexes[name + self.shadow_suffix]
+                    break
+
+        filter = None
+        for k, v in kwargs.items():
+            if k != key_name:
+                cond = getattr(ObjectClass, k) == v
+                filter = cond if filter is None else filter & cond
+
+        attributes_to_get = self._get_projection(ObjectClass, None if field_names is None else list(field_names) + list(kwargs))
+        if key_name is None:
+            return self.scan_objects(ObjectClass, filter, attributes_to_get=attributes_to_get)
+        if index is ObjectClass:
+            return ObjectClass.query(key_value, filter_condition=filter,
+                consistent_read=self.auth.AUTH_PYNAMO_CONSISTENT_READ, attributes_to_get=attributes_to_get)
+        if self._projects_all_attributes(index):
+            # NB: Global Secondary Indexes only support eventually consistent reads
+            return index.query(key_value, filter_condition=filter, attributes_to_get=attributes_to_get)
+        # The index does not hold whole objects: read them from the table by their keys.
+        # The filters may involve attributes that are not projected into the index: apply them to the objects.
+        key_objects = index.query(key_value, attributes_to_get=self._key_attribute_names(ObjectClass))
+        return (object for object in self._get_from_keys(ObjectClass, key_objects, attributes_to_get)
+            if all(getattr(object, k) == v for k, v in kwargs.items() if k != key_name))
+
+    def _ifind(self, ObjectClass, kwargs, field_names=None):
+        # Returns an iterator over the objects matching ``kwargs`` -- case insensitive --
+        # reading the attributes of ``field_names`` only, if given
+        from pynamodb.attributes import UnicodeAttribute
+
+        attributes = ObjectClass.get_attributes()
+        filters = {}
+        python_filters = {}
+        for k, v in kwargs.items():
+            if not isinstance(attributes.get(k), UnicodeAttribute):
+                filters[k] = v
+            elif k + self.shadow_suffix in attributes:
+                filters[k + self.shadow_suffix] = self.normalize(v)
+            else:
+                python_filters[k] = self.normalize(v)
+
+        # Without a shadow attribute, we have to scan (in parallel) and normalize in Python.
+        # The attributes normalized in Python must be read.
+        if field_names is not None:
+            field_names = list(field_names) + list(python_filters)
+        for o in self._find(ObjectClass, filters, field_names):
+            if all(self.normalize(getattr(o, k, None) or '') == v for k, v in python_filters.items()):
+                yield o
+
+    def _get_projection(self, ObjectClass, field_names):
+        # Returns the DynamoDB names of the attributes of ``field_names`` and of the table key attributes,
+        # for ``attributes_to_get``. None (all attributes) if ``field_names`` is None.
+        if field_names is None:
+            return None
+        attributes = ObjectClass.get_attributes()
+        names = self._key_attribute_names(ObjectClass)
+        for field_name in field_names:
+            if attributes[field_name].attr_name not in names:
+                names.append(attributes[field_name].attr_name)
+        return names
+
+    def _get_snapshot_field_names(self, ObjectClass, field_names):
+        # The attributes of ``field_names`` that ``ObjectClass`` has
+        attributes = ObjectClass.get_attributes()
+        return [field_name for field_name in field_names if field_name in attributes]
+
+    def _make_snapshot(self, ObjectClass, field_names, object):
+        # Hydrate a UserSnapshot from an object read with a projection of ``field_names``
+        return self.make_snapshot(ObjectClass, {field_name: getattr(object, field_name, None) for field_name in field_names})
+
+    def _get_indexes(self, ObjectClass):
+        # Returns a cached {attribute name: ObjectClass or Global Secondary Index} map
+        # of the attributes that can be queried by hash key
+        indexes = self._indexes.get(ObjectClass)
+        if indexes is None:
+            from pynamodb.indexes import GlobalSecondaryIndex
+
+            # Attribute names in DynamoDB -> attribute names in Python
+            attribute_names = {attribute.attr_name: name for name, attribute in ObjectClass.get_attributes().items()}
+            indexes = {}
+            for klass in reversed(ObjectClass.__mro__):
+                for value in vars(klass).values():
+                    if isinstance(value, GlobalSecondaryIndex):
+                        hash_key_name = attribute_names.get(value._hash_key_attribute().attr_name)
+                        if hash_key_name:
+                            indexes[hash_key_name] = value
+            # The table hash key beats any index
+            indexes[attribute_names[ObjectClass._hash_key_attribute().attr_name]] = ObjectClass
+            self._indexes[ObjectClass] = indexes
+        return indexes
+
+    def _projects_all_attributes(self, index):
+        from pynamodb.constants import ALL
+        return index.Meta.projection.projection_type == ALL
+
+    def _key_attribute_names(self, ObjectClass):
+        # Returns the DynamoDB names of the table key attributes
+        names = [ObjectClass._hash_key_attribute().attr_name]
+        if ObjectClass._range_key_attribute():
+            names.append(ObjectClass._range_key_attribute().attr_name)
+        return names
+
+    def _get_from_keys(self, ObjectClass, key_objects, attributes_to_get=None):
+        # Read objects from the table (whole, or the ``attributes_to_get`` only), given objects holding their keys
+        hash_key_name = ObjectClass._hash_key_attribute().attr_name
+        range_key = ObjectClass._range_key_attribute()
+        attribute_names = {attribute.attr_name: name for name, attribute in ObjectClass.get_attributes().items()}
+        for key_object in key_objects:
+            hash_key = getattr(key_object, attribute_names[hash_key_name])
+            range_key_value = getattr(key_object, attribute_names[range_key.attr_name]) if range_key else None
+            try:
+                yield ObjectClass.get(hash_key, range_key_value, consistent_read=self.auth.AUTH_PYNAMO_CONSISTENT_READ,
+                    attributes_to_get=attributes_to_get)
+            except ObjectClass.DoesNotExist:
+                pass
+
+    def _set_lower_attributes(self, object):
+        # Maintain the 'field_lower' (or canonical) shadow attributes used by ifind_first_object()
+        # Empty values are not stored: they cannot be Global Secondary Index keys
+        # Returns True if any attribute was outdated.
+        attributes = object.get_attributes()
+        suffix = self.shadow_suffix
+        outdated = False
+        for name in attributes:
+            if name.endswith(suffix) and name[:-len(suffix)] in attributes:
+                value = getattr(object, name[:-len(suffix)], None)
+                value = self.normalize(value) if value else None
+                if getattr(object, name, None) != value:
+                    setattr(object, name, value)
+                    outdated = True
+        return outdated
+
+    # Uniqueness guards
+    # -----------------
+
+    def _is_guarded(self, object_or_class):
+        # User objects are guarded if AUTH_UNIQUENESS_GUARD_TABLE is set
+        ObjectClass = object_or_class if isinstance(object_or_class, type) else type(object_or_class)
+        return bool(self.auth.AUTH_UNIQUENESS_GUARD_TABLE) and issubclass(ObjectClass, self.auth.db_manager.UserClass)
+
+    def _get_guard_class(self):
+        # Returns the Model of the guard items, stored in the same region as the User table
+        if self._GuardClass is None:
+            from pynamodb.attributes import UnicodeAttribute
+            from pynamodb.models import Model
+
+            UserMeta = self.auth.db_manager.UserClass.Meta
+            meta_attributes = {'table_name': self.auth.AUTH_UNIQUENESS_GUARD_TABLE}
+            for name in ('region', 'host', 'aws_access_key_id', 'aws_secret_access_key', 'aws_session_token'):
+                if getattr(UserMeta, name, None) is not None:
+                    meta_attributes[name] = getattr(UserMeta, name)
+
+            class UniquenessGuard(Model):
+                Meta = type('Meta', (), meta_attributes)
+                pk = UnicodeAttribute(hash_key=True)
+                owner = UnicodeAttribute()
+            self._GuardClass = UniquenessGuard
+        return self._GuardClass
+
+    def _get_guard_connection(self):
+        # Returns a connection for transactions on the guard table
+        from pynamodb.connection import Connection
+
+        Meta = self._get_guard_class().Meta
+        return Connection(region=getattr(Meta, 'region', None), host=getattr(Meta, 'host', None),
+            aws_access_key_id=getattr(Meta, 'aws_access_key_id', None),
+            aws_secret_access_key=getattr(Meta, 'aws_secret_access_key', None),
+            aws_session_token=getattr(Meta, 'aws_session_token', None))
+
+    def _save(self, object):
+        # Save ``object``; for a User object, reserve its new unique values
+        # and release its old ones in the same transaction
+        from ..user_snapshot import unwrap_snapshot
+
+        object = unwrap_snapshot(object)
+        self._set_lower_attributes(object)
+        if not self._is_guarded(object):
+            object.save()
+            return
+        old_keys = uniqueness_guards.remembered_guard_keys(object)
+        new_keys = uniqueness_guards.current_guard_keys(self.auth, object)
+        if new_keys == old_keys:
+            object.save()
+            return
+
+        from pynamodb.exceptions import TransactWriteError
+        from pynamodb.transactions import TransactWrite
+        from .. import UniqueConstraintError
+
+        GuardClass = self._get_guard_class()
+        owner = str(object.id)
+        # Field name of each transaction item, to find which one failed
+        item_fields = []
+        try:
+            with TransactWrite(connection=self._get_guard_connection()) as transaction:
+                for field_name, key in new_keys.items():
+                    if key == old_keys.get(field_name):
+                        continue
+                    transaction.save(GuardClass(key, owner=owner),
+                        condition=GuardClass.pk.does_not_exist() | (GuardClass.owner == owner))
+                    item_fields.append(field_name)
+                    if old_keys.get(field_name):
+                        transaction.delete(GuardClass(old_keys[field_name]), condition=GuardClass.pk.does_not_exist() | (GuardClass.owner == owner))
+                        item_fields.append(field_name)
+                for field_name, key in old_keys.items():
+                    if field_name not in new_keys:
+                        transaction.delete(GuardClass(key), condition=GuardClass.pk.does_not_exist() | (GuardClass.owner == owner))
+                        item_fields.append(field_name)
+                transaction.save(object)
+                item_fields.append(None)
+        except TransactWriteError as error:
+            reasons = getattr(error, 'cancellation_reasons', None) or []
+            for field_name, reason in zip(item_fields, reasons):
+                if field_name and reason is not None and reason.code == 'ConditionalCheckFailed':
+                    raise UniqueConstraintError(field_name, getattr(object, field_name, None))
+            raise
+        uniqueness_guards.remember_guard_keys(self.auth, object)
 
     # Database management methods
     # ---------------------------
@@ -129,6 +554,8 @@ class PynamoDbAdapter(DbAdapterInterface):
             klass = getattr(self.auth.db_manager, a, None)
             if klass is not None:
                 klasses.append(klass)
+        if self.auth.AUTH_UNIQUENESS_GUARD_TABLE:
+            klasses.append(self._get_guard_class())
         return klasses
 
     def create_all_tables(self):
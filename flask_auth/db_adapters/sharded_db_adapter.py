@@ -0,0 +1,477 @@
+"""This module implements the DbAdapter interface for users spread over several SQL databases (shards).
+
+Each shard is served by a SQLDbAdapter bound to one of the AUTH_SHARD_BINDS databases.
+Users are placed by a hash of their ID, and the shard directory maps their unique values
+('<FIELD>#<normalized value>', as the uniqueness guard keys) to their IDs,
+so that lookups by ID, username or email address each reach a single shard.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+from __future__ import print_function
+
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
+
+# Non-system imports are moved into the methods to make them an optional requirement
+
+from .. import ConfigError
+from ..user_snapshot import UserSnapshot
+from .db_adapter_interface import DbAdapterInterface
+from .sql_db_adapter import SQLDbAdapter
+from . import uniqueness_guards
+
+# Lookups that cannot be routed through the shard directory are sent to all the shards
+ALL_SHARDS = object()
+
+
+class SQLAlchemyShard(object):
+    """ The part of the Flask-SQLAlchemy API that SQLDbAdapter uses, bound to the database of one bind key.
+
+    A SQLDbAdapter over a SQLAlchemyShard reads and writes all the tables in that database only.
+    """
+
+    def __init__(self, app, db, bind_key):
+        """Args:
+            app(Flask): The Flask appliation instance.
+            db(SQLAlchemy): The SQLAlchemy object-database mapper instance.
+            bind_key(str): The SQLALCHEMY_BINDS key of the shard database.
+        """
+        self.db = db
+        self.bind_key = bind_key
+        self.engine = db.get_engine(app, bind=bind_key)
+        # A session of its own, scoped to the application context as ``db.session``
+        self.session = db.create_scoped_session(options=dict(bind=self.engine, binds={}))
+
+    def get_engine(self, app=None, bind=None):
+        return self.db.get_engine(app, bind)
+
+    def create_all(self):
+        self.db.Model.metadata.create_all(bind=self.engine)
+
+    def drop_all(self):
+        self.db.Model.metadata.drop_all(bind=self.engine)
+
+
+class ShardedDbAdapter(DbAdapterInterface):
+    """ Implements the DbAdapter interface to find, add, update and delete
+    database objects spread over several SQL databases (see AUTH_SHARD_BINDS).
+
+    | User objects live on the shard picked by a hash of their ID,
+        and their IDs are allocated from a sequence table next to the shard directory.
+    | Lookups by username or email address read the user ID from the shard directory,
+        which is kept up to date whenever the shard sessions are flushed.
+    | Other lookups and listings run on all the shards in parallel.
+    | Objects of the other classes live on the first shard.
+
+    Relationships cannot span shards: the users hold the names of their roles, in a list column
+    that tracks in-place changes (such as ``MutableList.as_mutable(JSON)``), as with the document databases.
+    """
+
+    def __init__(self, app, db):
+        """Args:
+            app(Flask): The Flask appliation instance.
+            db(SQLAlchemy): The SQLAlchemy object-database mapper instance.
+
+        | Example:
+        |     app.config['AUTH_DB_ADAPTER'] = 'sharded'
+        |     app.config['AUTH_SHARD_BINDS'] = ['users0', 'users1', 'users2']
+        |     db = SQLAlchemy(app)
+        |     auth = Auth(app, db, User)
+        """
+        super(ShardedDbAdapter, self).__init__(app, db)
+        if not self.auth.AUTH_SHARD_BINDS:
+            raise ConfigError("AUTH_DB_ADAPTER 'sharded' requires AUTH_SHARD_BINDS.")
+        if self.auth.AUTH_SQL_REPLICA_BINDS:
+            raise ConfigError('AUTH_SQL_REPLICA_BINDS is not supported with AUTH_SHARD_BINDS.')
+        binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        for bind_key in list(self.auth.AUTH_SHARD_BINDS) + [self.auth.AUTH_SHARD_DIRECTORY_BIND]:
+            if bind_key and bind_key not in binds:
+                raise ConfigError("AUTH_SHARD_BINDS: '%s' is not a key of SQLALCHEMY_BINDS." % bind_key)
+
+        # One SQLDbAdapter per shard, in AUTH_SHARD_BINDS order
+        self.shards = [self._make_shard(bind_key) for bind_key in self.auth.AUTH_SHARD_BINDS]
+        self.directory_engine = db.get_engine(app, bind=self.auth.AUTH_SHARD_DIRECTORY_BIND or None)
+        self._directory_metadata, self._directory_table, self._ids_table = self._define_directory_tables()
+        # The directory is not updated while users are moved between shards
+        self._maintain_directory = True
+
+        # Fan-out queries run in these threads, one per shard
+        self._executor = ThreadPoolExecutor(len(self.shards))
+        app.teardown_appcontext(self._remove_sessions)
+
+    def get_shard(self, id):
+        """Returns the SQLDbAdapter of the shard of the user ``id``."""
+        return self.shards[zlib.crc32(str(id).encode('utf-8')) % len(self.shards)]
+
+    def add_object(self, object):
+        """ Add a new object to the session of its shard.
+
+        User objects get their ID from the user ID sequence, so that the ID picks the shard.
+        """
+        if not self._is_sharded(object):
+            self.shards[0].add_object(object)
+            return
+        if object.id is None:
+            with self.directory_engine.begin() as connection:
+                object.id = connection.execute(self._ids_table.insert()).inserted_primary_key[0]
+        self.get_shard(object.id).add_object(object)
+
+    def get_object(self, ObjectClass, id):
+        """ Retrieve object of type ``ObjectClass`` by ``id``, from its shard.
+
+        | Returns object on success.
+        | Returns None otherwise.
+        """
+        return self._get_shard_of(ObjectClass, id).get_object(ObjectClass, id)
+
+    def get_object_snapshot(self, ObjectClass, id, field_names):
+        """ Retrieve a UserSnapshot of the object of type ``ObjectClass`` by ``id``, from its shard
+        (see ``SQLDbAdapter.get_object_snapshot()``).
+        """
+        return self._get_shard_of(ObjectClass, id).get_object_snapshot(ObjectClass, id, field_names)
+
+    def get_objects(self, ObjectClass, ids):
+        """ Retrieve the objects of type ``ObjectClass`` whose ID is in ``ids``,
+        with one query per shard, run in parallel.
+        """
+        shard_ids = {}
+        for id in ids:
+            shard_ids.setdefault(self._get_shard_of(ObjectClass, id), []).append(id)
+        results = self._fan_out(shard_ids, lambda shard: shard.get_objects(ObjectClass, shard_ids[shard]))
+        return list(chain.from_iterable(results))
+
+    def find_objects(self, ObjectClass, **kwargs):
+        """ Retrieve all objects of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case sensitive.
+
+        Without an ``id``, ``username`` or ``email`` filter, all the shards are queried in parallel,
+        and the objects are returned as the shards answer.
+        """
+        shard = self._route(ObjectClass, kwargs)
+        if shard is None:
+            return []
+        if shard is not ALL_SHARDS:
+            return shard.find_objects(ObjectClass, **kwargs)
+        results = self._fan_out(self.shards, lambda shard: shard.find_objects(ObjectClass, **kwargs))
+        return list(chain.from_iterable(results))
+
+    def find_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the filters specified in ``**kwargs`` -- case sensitive.
+        """
+        return self._find_first('find_first_object', ObjectClass, (), kwargs)
+
+    def ifind_first_object(self, ObjectClass, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive.
+
+        | If AUTH_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
+        | If AUTH_IFIND_MODE is 'ifind' this method performs a case insensitive find.
+        """
+        return self._find_first('ifind_first_object', ObjectClass, (), kwargs)
+
+    def find_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case sensitive.
+        """
+        return self._find_first('find_first_object_snapshot', ObjectClass, (field_names,), kwargs)
+
+    def ifind_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve a UserSnapshot of the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive.
+        """
+        return self._find_first('ifind_first_object_snapshot', ObjectClass, (field_names,), kwargs)
+
+    def bulk_add_user_roles(self, UserClass, user_ids, roles):
+        """ Associate ``roles`` (role names) with all the users of ``user_ids``.
+
+        The users are read with one query per shard, and written back by the next commit.
+        """
+        for user in self.get_objects(UserClass, user_ids):
+            missing_roles = [role for role in roles if role not in user.roles]
+            if missing_roles:
+                user.roles = list(user.roles) + missing_roles
+
+    def iter_objects_in_batches(self, ObjectClass, batch_size=1000):
+        """ Iterate over all objects of type ``ObjectClass``, in lists of at most ``batch_size`` objects,
+        one shard after the other.
+        """
+        if not self._is_sharded(ObjectClass):
+            return self.shards[0].iter_objects_in_batches(ObjectClass, batch_size)
+        return chain.from_iterable(shard.iter_objects_in_batches(ObjectClass, batch_size) for shard in self.shards)
+
+    def save_object(self, object):
+        """ Save object to database.
+
+        | Session-based ODMs would do nothing.
+        | Object-based ODMs would do something like object.save().
+        """
+        self._get_shard_of(object, object.id).save_object(object)
+
+    def delete_object(self, object):
+        """ Delete object from database.
+        """
+        self._get_shard_of(object, object.id).delete_object(object)
+
+    def commit(self):
+        """ Commit the sessions of the shards used in the current context, one after the other.
+
+        Shards are committed independently: a failed commit does not roll back the shards committed before it.
+        """
+        for shard in self.shards:
+            if shard.db.session.registry.has():
+                shard.commit()
+
+    def flush(self):
+        """Write the pending changes of the sessions of the shards used in the current context, without committing them."""
+        for shard in self.shards:
+            if shard.db.session.registry.has():
+                shard.flush()
+
+    def rollback(self):
+        """Discard the changes of the sessions of the shards used in the current context that were not committed."""
+        for shard in self.shards:
+            if shard.db.session.registry.has():
+                shard.rollback()
+
+    def make_cacheable_object(self, object):
+        """ Returns a detached copy of ``object`` (see ``SQLDbAdapter.make_cacheable_object()``)."""
+        return self.shards[0].make_cacheable_object(object)
+
+    def get_or_add_object(self, ObjectClass, **kwargs):
+        """ Returns the object of type ``ObjectClass`` matching ``**kwargs``, adding it if there is none,
+        on the first shard (see ``SQLDbAdapter.get_or_add_object()``). User objects are not supported.
+        """
+        if self._is_sharded(ObjectClass):
+            raise NotImplementedError('ShardedDbAdapter.get_or_add_object() does not support User objects.')
+        return self.shards[0].get_or_add_object(ObjectClass, **kwargs)
+
+    def merge_cached_object(self, object):
+        """ Returns the instance of the current session of its shard for an object returned by ``make_cacheable_object()``."""
+        return self._get_shard_of(object, object.id).merge_cached_object(object)
+
+    # Rebalancing
+    # -----------
+
+    def rebalance(self, UserClass, batch_size=1000, retired_binds=()):
+        """ Move the users that are not on the shard of their ID, ``batch_size`` users at a time,
+        after shards were added to (or removed from) AUTH_SHARD_BINDS.
+
+        | ``retired_binds`` lists the bind keys of removed shards, whose users are all moved.
+        | The users are copied to their new shard, committed, then deleted from their old shard.
+            Their IDs do not change: the shard directory stays valid.
+        | Returns the number of moved users.
+        """
+        from sqlalchemy.orm import make_transient
+
+        sources = self.shards + [self._make_shard(bind_key) for bind_key in retired_binds]
+        count = 0
+        self._maintain_directory = False
+        try:
+            for source in sources:
+                for batch in source.iter_objects_in_batches(UserClass, batch_size):
+                    targets = set()
+                    for user in batch:
+                        target = self.get_shard(user.id)
+                        if target is source:
+                            continue
+                        copy = source.make_cacheable_object(user)
+                        make_transient(copy)
+                        target.add_object(copy)
+                        source.delete_object(user)
+                        targets.add(target)
+                        count += 1
+                    # Commit the copies before the deletes: an interrupted run leaves duplicates, not lost users
+                    for target in targets:
+                        target.commit()
+                    source.commit()
+        finally:
+            self._maintain_directory = True
+        return count
+
+    # Routing
+    # -------
+
+    def _make_shard(self, bind_key):
+        from sqlalchemy import event
+
+        shard = SQLAlchemyShard(self.app, self.db, bind_key)
+        # Keep the shard directory up to date with the changes flushed by the sessions of this shard.
+        # The listener is registered on the session factory of the shard: other sessions are not affected.
+        event.listen(shard.session, 'before_flush', self._before_flush)
+        return SQLDbAdapter(self.app, shard)
+
+    def _is_sharded(self, object_or_class):
+        # User objects are sharded, the objects of the other classes live on the first shard
+        ObjectClass = object_or_class if isinstance(object_or_class, type) else type(object_or_class)
+        # UserSnapshot classes are sharded as the User class they stand in for
+        ObjectClass = getattr(ObjectClass, '_snapshot_of', None) or ObjectClass
+        return issubclass(ObjectClass, self.auth.db_manager.UserClass)
+
+    def _get_shard_of(self, object_or_class, id):
+        return self.get_shard(id) if self._is_sharded(object_or_class) else self.shards[0]
+
+    def _route(self, ObjectClass, kwargs):
+        # Returns the shard of the objects matching the filters in ``kwargs``,
+        # None if the shard directory tells that there is none, or ALL_SHARDS
+        if not self._is_sharded(ObjectClass):
+            return self.shards[0]
+        if kwargs.get('id') is not None:
+            return self.get_shard(kwargs['id'])
+        suffix = self.shadow_suffix
+        guarded_fields = uniqueness_guards.guarded_fields(self.auth)
+        for name, value in kwargs.items():
+            # Filters on the canonical shadow fields are routed as filters on their source fields
+            field_name = name[:-len(suffix)] if name.endswith(suffix) else name
+            if field_name in guarded_fields and value and isinstance(value, str):
+                id = self._lookup_directory(self._directory_key(field_name, value))
+                return self.get_shard(id) if id is not None else None
+        return ALL_SHARDS
+
+    def _find_first(self, method_name, ObjectClass, args, kwargs):
+        # Run the SQLDbAdapter lookup ``method_name`` on the shard of the object, or on all the shards
+        shard = self._route(ObjectClass, kwargs)
+        if shard is None:
+            return None
+        if shard is not ALL_SHARDS:
+            return getattr(shard, method_name)(ObjectClass, *args, **kwargs)
+        results = self._fan_out(self.shards, lambda shard: [getattr(shard, method_name)(ObjectClass, *args, **kwargs)])
+        for objects in results:
+            if objects[0] is not None:
+                return objects[0]
+        return None
+
+    def _fan_out(self, shards, query):
+        # Run ``query(shard)`` on each of ``shards`` in parallel, in threads with an application context of their own.
+        # Yields the lists of objects returned by ``query()`` as the shards answer,
+        # merged into the shard sessions of the current context. UserSnapshots hold plain values: they are not merged.
+        def run(shard):
+            with self.app.app_context():
+                return shard, list(query(shard))
+
+        shards = list(shards)
+        if len(shards) == 1:
+            yield list(query(shards[0]))
+            return
+        for future in as_completed([self._executor.submit(run, shard) for shard in shards]):
+            shard, objects = future.result()
+            yield [object if object is None or isinstance(object, UserSnapshot) else shard.merge_cached_object(object)
+                for object in objects]
+
+    def _remove_sessions(self, exception=None):
+        for shard in self.shards:
+            shard.db.session.remove()
+
+    # Shard directory
+    # ---------------
+
+    def _define_directory_tables(self):
+        from sqlalchemy import BigInteger, Column, Integer, MetaData, String, Table
+
+        metadata = MetaData()
+        # '<FIELD>#<normalized value>' -> ID of the user holding the value
+        directory_table = Table(
+            'auth_shard_directory', metadata,
+            Column('key', String(255), primary_key=True),
+            Column('user_id', BigInteger, nullable=False))
+        # User ID sequence: one row per allocated ID
+        ids_table = Table(
+            'auth_shard_ids', metadata,
+            Column('id', BigInteger().with_variant(Integer, 'sqlite'), primary_key=True),
+            sqlite_autoincrement=True)
+        return metadata, directory_table, ids_table
+
+    def _directory_key(self, field_name, value):
+        return '%s#%s' % (field_name.upper(), self.normalize(value))
+
+    def _lookup_directory(self, key):
+        # Returns the ID of the user holding the value of ``key``, or None
+        from sqlalchemy import select
+
+        table = self._directory_table
+        with self.timed_operation('lookup_directory', bind=self.auth.AUTH_SHARD_DIRECTORY_BIND or None):
+            with self.directory_engine.connect() as connection:
+                return connection.execute(select([table.c.user_id]).where(table.c.key == key)).scalar()
+
+    def _before_flush(self, session, flush_context, instances):
+        # Claim the new unique values of the flushed users and release their old ones
+        if not self._maintain_directory:
+            return
+        from sqlalchemy import inspect
+
+        UserClass = self.auth.db_manager.UserClass
+        guarded_fields = uniqueness_guards.guarded_fields(self.auth)
+        for object in list(session.new) + list(session.dirty):
+            if not isinstance(object, UserClass):
+                continue
+            attributes = inspect(object).attrs
+            for field_name in guarded_fields:
+                added, unchanged, deleted = attributes[field_name].history
+                for value in deleted:
+                    if value:
+                        self._release(field_name, value, object.id)
+                for value in added:
+                    if value:
+                        self._claim(field_name, value, object)
+        for object in session.deleted:
+            if isinstance(object, UserClass):
+                for field_name in guarded_fields:
+                    value = getattr(object, field_name, None)
+                    if value:
+                        self._release(field_name, value, object.id)
+
+    def _claim(self, field_name, value, object):
+        # Point the directory entry of ``value`` to ``object``.
+        # An entry left by a failed commit or by a change of a value that was not loaded
+        # is taken over, once its user is found not to hold the value any more.
+        from sqlalchemy import select
+        from sqlalchemy.exc import IntegrityError
+        from .. import UniqueConstraintError
+
+        table = self._directory_table
+        key = self._directory_key(field_name, value)
+        try:
+            with self.directory_engine.begin() as connection:
+                connection.execute(table.insert().values(key=key, user_id=object.id))
+            return
+        except IntegrityError:
+            pass
+        with self.directory_engine.connect() as connection:
+            owner_id = connection.execute(select([table.c.user_id]).where(table.c.key == key)).scalar()
+        if owner_id is None or owner_id == object.id:
+            owner = None
+        else:
+            owner = self.get_shard(owner_id).get_object(type(object), owner_id)
+        if owner is not None and self._directory_key(field_name, getattr(owner, field_name, None) or '') == key:
+            raise UniqueConstraintError(field_name, value)
+        with self.directory_engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.key == key))
+            connection.execute(table.insert().values(key=key, user_id=object.id))
+
+    def _release(self, field_name, value, id):
+        # Delete the directory entry of ``value``, if it still points to the user ``id``
+        table = self._directory_table
+        key = self._directory_key(field_name, value)
+        with self.directory_engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.key == key).where(table.c.user_id == id))
+
+    # Database management methods
+    # ---------------------------
+
+    def create_all_tables(self):
+        """Create the tables of all the data-models in every shard, and the shard directory tables."""
+        self._directory_metadata.create_all(bind=self.directory_engine)
+        for shard in self.shards:
+            shard.create_all_tables()
+
+    def drop_all_tables(self):
+        """Drop all tables of the shards and the shard directory tables.
+
+        .. warning:: ALL DATA WILL BE LOST. Use only for automated testing.
+        """
+        for shard in self.shards:
+            shard.drop_all_tables()
+        self._directory_metadata.drop_all(bind=self.directory_engine)
@@ -8,7 +8,16 @@ from __future__ import print_function
 
 # Non-system imports are moved into the methods to make them an optional requirement
 
+import random
+from contextlib import contextmanager
+from itertools import chain
+from time import time
+
+from flask import g, has_request_context, request
+
+from .. import ConfigError
 from .db_adapter_interface import DbAdapterInterface
+from . import uniqueness_guards
 
 
 class SQLDbAdapter(DbAdapterInterface):
@@ -18,6 +27,9 @@ class SQLDbAdapter(DbAdapterInterface):
 
     # Almost all methods are defined in the DbAdapter base class.
 
+    #: Name of the cookie that keeps a client reading from the primary database after a write
+    sticky_cookie_name = 'auth_read_primary_until'
+
     def __init__(self, app, db):
         """Args:
             app(Flask): The Flask appliation instance.
@@ -28,8 +40,26 @@ class SQLDbAdapter(DbAdapterInterface):
         |     db = SQLAlchemy()
         |     db_adapter = SQLDbAdapter(app, db)
         """
-        # This no-op method is defined to show it in Sphinx docs in order 'bysource'
+        from sqlalchemy.ext import baked
+
         super(SQLDbAdapter, self).__init__(app, db)
+        # (ObjectClass, field names) -> (the column attributes, the relationship attributes) loaded by projected queries
+        self._projections = {}
+        # Baked queries of the lookups, built once per (class, fields, mode).
+        # SQLAlchemy caches their compiled SQL: lookups only bind the parameter values.
+        self._bakery = baked.bakery()
+        self._baked_lookups = {}
+
+        # Read replicas: bind key -> engine, created on first use
+        self.replica_binds = list(self.auth.AUTH_SQL_REPLICA_BINDS)
+        self._replica_engines = {}
+        if self.replica_binds:
+            binds = app.config.get('SQLALCHEMY_BINDS') or {}
+            for bind_key in self.replica_binds:
+                if bind_key not in binds:
+                    raise ConfigError("AUTH_SQL_REPLICA_BINDS: '%s' is not a key of SQLALCHEMY_BINDS." % bind_key)
+            # Keep clients that have just written on the primary database
+            app.after_request(self._set_sticky_cookie)
 
     def add_object(self, object):
         """ Add a new object to the database.
@@ -37,6 +67,7 @@ class SQLDbAdapter(DbAdapterInterface):
         | Session-based ODMs would call something like ``db.session.add(object)``.
         | Object-based ODMs would call something like ``object.save()``.
         """
+        self._read_from_primary()
         self.db.session.add(object)
 
     def get_object(self, ObjectClass, id):
@@ -45,7 +76,11 @@ class SQLDbAdapter(DbAdapterInterface):
         | Returns object on success.
         | Returns None otherwise.
         """
-        return ObjectClass.query.get(id)
+        if self._get_read_replica() is not None:
+            return self._lookup(ObjectClass, [('id', id)], False, None, 'get_object')
+        # Query.get() returns the objects of the session without querying the database
+        with self.timed_operation('get_object', ObjectClass, bind='primary'):
+            return self.db.session.query(ObjectClass).get(id)
 
     def find_objects(self, ObjectClass, **kwargs):
         """ Retrieve all objects of type ``ObjectClass``,
@@ -53,7 +88,7 @@ class SQLDbAdapter(DbAdapterInterface):
         """
 
         # Convert each name/value pair in '**kwargs' into a filter
-        query = ObjectClass.query
+        query = self.db.session.query(ObjectClass)
         for field_name, field_value in kwargs.items():
 
             # Make sure that ObjectClass has a 'field_name' property
@@ -65,28 +100,18 @@ class SQLDbAdapter(DbAdapterInterface):
             query = query.filter(field==field_value)
 
         # Execute query
-        return query.all()
+        replica = self._get_read_replica()
+        with self.timed_operation('find_objects', ObjectClass, bind=replica[0] if replica else 'primary'):
+            if replica is not None:
+                return self._read_from_replica(replica[1], query, {})
+            return query.all()
 
 
     def find_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
         matching the specified filters in ``**kwargs`` -- case sensitive.
         """
-
-        # Convert each name/value pair in 'kwargs' into a filter
-        query = ObjectClass.query
-        for field_name, field_value in kwargs.items():
-
-            # Make sure that ObjectClass has a 'field_name' property
-            field = getattr(ObjectClass, field_name, None)
-            if field is None:
-                raise KeyError("BaseAlchemyAdapter.find_first_object(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
-
-            # Add a case sensitive filter to the query
-            query = query.filter(field==field_value)  # case sensitive!!
-
-        # Execute query
-        return query.first()
+        return self._lookup(ObjectClass, kwargs, False, None, 'find_first_object')
 
     def ifind_first_object(self, ObjectClass, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
@@ -94,49 +119,316 @@ class SQLDbAdapter(DbAdapterInterface):
 
         | If AUTH_IFIND_MODE is 'nocase_collation' this method maps to find_first_object().
         | If AUTH_IFIND_MODE is 'ifind' this method performs a case insensitive find.
+
+        ``ifind_first_object(User, email='myname@example.com')`` translates to
+        ``User.query.filter(User.email.ilike('myname@example.com')).first()``.
         """
 
-        # Call regular find() if AUTH_IFIND_MODE is nocase_collation
-        if self.auth.AUTH_IFIND_MODE=='nocase_collation':
-            return self.find_first_object(ObjectClass, **kwargs)
+        # A regular find() if AUTH_IFIND_MODE is nocase_collation
+        ilike = self.auth.AUTH_IFIND_MODE != 'nocase_collation'
+        return self._lookup(ObjectClass, kwargs, ilike, None, 'ifind_first_object')
 
-        # Convert each name/value pair in 'kwargs' into a filter
-        query = ObjectClass.query
-        for field_name, field_value in kwargs.items():
-
-            # Make sure that ObjectClass has a 'field_name' property
-            field = getattr(ObjectClass, field_name, None)
-            if field is None:
-                raise KeyError("BaseAlchemyAdapter.find_first_object(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
+    def get_object_snapshot(self, ObjectClass, id, field_names):
+        """ Retrieve a UserSnapshot of the object of type ``ObjectClass`` by ``id``,
+        hydrated from the columns of ``field_names`` only.
 
-            # Add a case sensitive filter to the query
-            query = query.filter(field.ifind(field_value))  # case insensitive!!
-
-        # Execute query
-        return query.first()
+        | The columns are selected as plain rows: no object is mapped nor added to the session.
+        | A relationship of ``field_names`` (such as ``roles``) becomes a tuple of the rows of the related objects,
+            selected with one more query.
+        | The snapshot loads the full object on first access to any other attribute,
+            or on the first assignment (see ``make_snapshot()``).
+        | Returns None if no object has this ``id``.
+        """
+        return self._lookup(ObjectClass, [('id', id)], False, tuple(field_names), 'get_object_snapshot')
 
-    def ifind_first_object(self, ObjectClass, **kwargs):
+    def find_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
         """ Retrieve the first object of type ``ObjectClass``,
-        matching the filters specified in ``**kwargs`` -- case insensitive.
+        matching the specified filters in ``**kwargs`` -- case sensitive --
+        as a UserSnapshot hydrated from the columns of ``field_names`` (see ``get_object_snapshot()``).
+        """
+        return self._lookup(ObjectClass, kwargs, False, tuple(field_names), 'find_first_object_snapshot')
 
-        ``ifind_first_object(User, email='myname@example.com')`` translates to
-        ``User.query.filter(User.email.ilike('myname@example.com')).first()``.
+    def ifind_first_object_snapshot(self, ObjectClass, field_names, **kwargs):
+        """ Retrieve the first object of type ``ObjectClass``,
+        matching the specified filters in ``**kwargs`` -- case insensitive --
+        as a UserSnapshot hydrated from the columns of ``field_names`` (see ``get_object_snapshot()``).
         """
+        ilike = self.auth.AUTH_IFIND_MODE != 'nocase_collation'
+        return self._lookup(ObjectClass, kwargs, ilike, tuple(field_names), 'ifind_first_object_snapshot')
 
-        # Convert each name/value pair in 'kwargs' into a filter
-        query = ObjectClass.query
-        for field_name, field_value in kwargs.items():
+    def find_first_object_by_any(self, ObjectClass, filters, case_insensitive=False, snapshot_fields=None):
+        """ Retrieve the object of type ``ObjectClass`` matching the first of the ``filters``
+        (a list of (field name, value) pairs) that any object matches.
+
+        ``find_first_object_by_any(User, [('username', 'myname'), ('email', 'myname')])`` translates to
+        ``User.query.filter(or_(User.username == 'myname', User.email == 'myname'))``
+        ``.order_by(case([(User.username == 'myname', 0), (User.email == 'myname', 1)])).first()``:
+        a single query, which the database serves with one index probe per filter.
+        """
+        ilike = case_insensitive and self.auth.AUTH_IFIND_MODE != 'nocase_collation'
+        snapshot_fields = tuple(snapshot_fields) if snapshot_fields else None
+        return self._lookup(ObjectClass, filters, ilike, snapshot_fields, 'find_first_object_by_any', any_of=True)
+
+    # Baked lookups
+    # -------------
+
+    def _lookup(self, ObjectClass, filters, ilike, snapshot_fields, method_name, any_of=False):
+        # Returns the first object of the baked lookup of ``filters`` (a dict, or a list of (field name, value) pairs),
+        # read from a replica or from the primary database (see AUTH_SQL_REPLICA_BINDS).
+        # With ``snapshot_fields``, returns a UserSnapshot hydrated from the selected row.
+        filters = list(filters.items()) if isinstance(filters, dict) else list(filters)
+        field_names = tuple(field_name for field_name, field_value in filters)
+        baked_query = self._get_baked_query((ObjectClass, field_names, ilike, snapshot_fields, any_of), method_name)
+        params = {'value%d' % i: field_value for i, (field_name, field_value) in enumerate(filters)}
+        replica = self._get_read_replica()
+        with self.timed_operation(method_name, ObjectClass, bind=replica[0] if replica else 'primary'):
+            if replica is not None:
+                objects = self._read_from_replica(replica[1], baked_query.to_query(self.db.session()).limit(1), params)
+                object = objects[0] if objects else None
+            else:
+                object = baked_query(self.db.session()).params(**params).first()
+        if snapshot_fields and object is not None:
+            data = object._asdict()
+            relationships = self._get_projection(ObjectClass, snapshot_fields)[1]
+            if relationships:
+                data.update(self._load_related_rows(ObjectClass, data['id'], relationships, replica, method_name))
+            return self.make_snapshot(ObjectClass, data)
+        return object
+
+    def _load_related_rows(self, ObjectClass, id, relationships, replica, method_name):
+        # Returns relationship name -> tuple of the rows of the related objects (such as ``roles``),
+        # selected with one baked query per relationship: read-only rows with the column attributes of the objects
+        rows_by_name = {}
+        for relationship in relationships:
+            key = (ObjectClass, relationship.key, 'related_rows')
+            baked_query = self._baked_lookups.get(key)
+            if baked_query is None:
+                baked_query = self._baked_lookups[key] = self._bake_related_rows(ObjectClass, relationship, key)
+            with self.timed_operation(method_name, relationship.mapper.class_, bind=replica[0] if replica else 'primary'):
+                if replica is not None:
+                    rows = self._read_from_replica(replica[1], baked_query.to_query(self.db.session()), {'id': id})
+                else:
+                    rows = baked_query(self.db.session()).params(id=id).all()
+            rows_by_name[relationship.key] = tuple(rows)
+        return rows_by_name
+
+    def _bake_related_rows(self, ObjectClass, relationship, key):
+        # Build the baked query of the related objects of an object: the object ID is the bound parameter 'id'
+        from sqlalchemy import bindparam, inspect
+
+        RelatedClass = relationship.mapper.class_
+        columns = [getattr(RelatedClass, column_attribute.key) for column_attribute in inspect(RelatedClass).column_attrs]
+        related_objects = getattr(ObjectClass, relationship.key)
+        return self._bakery(lambda session: session.query(*columns).select_from(ObjectClass)
+            .join(related_objects).filter(ObjectClass.id == bindparam('id')), key)
+
+    def _get_baked_query(self, key, method_name):
+        # Returns the baked query of the lookup of ``key``: (ObjectClass, field names, ilike, snapshot fields, any_of)
+        baked_query = self._baked_lookups.get(key)
+        if baked_query is None:
+            baked_query = self._baked_lookups[key] = self._bake_lookup(key, method_name)
+        return baked_query
+
+    def _bake_lookup(self, key, method_name):
+        # Build the baked query of a lookup. The filter values are the bound parameters 'value0', 'value1'...
+        from sqlalchemy import bindparam, case, or_
+
+        ObjectClass, field_names, ilike, snapshot_fields, any_of = key
+        conditions = []
+        for i, field_name in enumerate(field_names):
 
             # Make sure that ObjectClass has a 'field_name' property
             field = getattr(ObjectClass, field_name, None)
             if field is None:
-                raise KeyError("BaseAlchemyAdapter.find_first_object(): Class '%s' has no field '%s'." % (ObjectClass, field_name))
+                raise KeyError("BaseAlchemyAdapter.%s(): Class '%s' has no field '%s'." % (method_name, ObjectClass, field_name))
+
+            # A case sensitive, or case INsensitive, condition
+            value = bindparam('value%d' % i)
+            conditions.append(field.ilike(value) if ilike else field==value)
+
+        # NB: the bakery identifies each step by the code of its function and by its arguments: pass the key
+        if snapshot_fields:
+            # Select the columns of ``snapshot_fields`` only, as rows keyed by field name
+            columns = self._get_projection(ObjectClass, snapshot_fields)[0]
+            baked_query = self._bakery(lambda session: session.query(*columns), key)
+        else:
+            baked_query = self._bakery(lambda session: session.query(ObjectClass), key)
+        if any_of and len(conditions) > 1:
+            # Prefer the objects matching the first filters
+            order = case([(condition, i) for i, condition in enumerate(conditions)])
+            baked_query.add_criteria(lambda query: query.filter(or_(*conditions)).order_by(order), key)
+        elif conditions:
+            baked_query.add_criteria(lambda query: query.filter(*conditions), key)
+        return baked_query
+
+    def _get_projection(self, ObjectClass, field_names):
+        # Returns the column attributes of ``ObjectClass`` named in ``field_names``,
+        # and its relationships named in ``field_names`` (such as ``roles``), loaded as rows (see ``_load_related_rows()``)
+        from sqlalchemy import inspect
+
+        key = (ObjectClass, tuple(field_names))
+        projection = self._projections.get(key)
+        if projection is None:
+            # Unknown names are left out
+            mapper = inspect(ObjectClass)
+            column_names = set(column_attribute.key for column_attribute in mapper.column_attrs)
+            columns = [getattr(ObjectClass, field_name) for field_name in field_names if field_name in column_names]
+            relationships = [mapper.relationships[field_name] for field_name in field_names if field_name in mapper.relationships]
+            projection = self._projections[key] = (columns, relationships)
+        return projection
+
+    # Read replicas
+    # -------------
+
+    def _get_read_replica(self):
+        # Returns the ('replica:<bind key>', engine) pair of the replica serving the reads of the current request,
+        # or None to read from the primary database
+        if not self.replica_binds or not has_request_context() or g.get('_auth_read_primary'):
+            return None
+        # Read your writes: the client has written recently
+        try:
+            read_primary = float(request.cookies.get(self.sticky_cookie_name, 0)) > time()
+        except ValueError:
+            read_primary = False
+        if read_primary:
+            g._auth_read_primary = True
+            return None
+        # The same replica serves all the reads of a request
+        bind_key = g.get('_auth_replica_bind')
+        if bind_key is None:
+            bind_key = g._auth_replica_bind = random.choice(self.replica_binds)
+        engine = self._replica_engines.get(bind_key)
+        if engine is None:
+            engine = self._replica_engines[bind_key] = self.db.get_engine(self.app, bind=bind_key)
+        return 'replica:' + bind_key, engine
+
+    def _read_from_replica(self, engine, query, params):
+        # Run the SELECT of ``query`` on ``engine``, and load the rows into the objects of the current session:
+        # objects read from a replica are saved and committed like any other
+        with engine.connect() as connection:
+            return list(query.instances(connection.execute(query.statement, params)))
+
+    def _read_from_primary(self, committed=False):
+        # A write: read from the primary for the rest of the request,
+        # and, once committed, for AUTH_SQL_REPLICA_STICKINESS seconds on the client side
+        if self.replica_binds and has_request_context():
+            g._auth_read_primary = True
+            if committed:
+                g._auth_committed = True
+
+    def _set_sticky_cookie(self, response):
+        # Flask after_request handler: keep clients that have just committed a write on the primary database
+        stickiness = self.auth.AUTH_SQL_REPLICA_STICKINESS
+        if stickiness and g.get('_auth_committed'):
+            response.set_cookie(
+                self.sticky_cookie_name, str(int(time()) + stickiness),
+                max_age=stickiness, httponly=True, samesite='Lax')
+        return response
+
+    def bulk_add_user_roles(self, UserClass, user_ids, roles):
+        """ Associate ``roles`` (Role objects) with all the users of ``user_ids``.
+
+        Rows are inserted into the association table of ``UserClass.roles`` with a single ``executemany``.
+        """
+        self._read_from_primary()
+        relationship = UserClass.roles.property
+        association_table = relationship.secondary
+        # users.id -> user_roles.user_id and roles.id -> user_roles.role_id
+        (user_key, user_column), = [(local.key, remote) for local, remote in relationship.synchronize_pairs]
+        (role_key, role_column), = [(local.key, remote) for local, remote in relationship.secondary_synchronize_pairs]
+
+        # Skip the existing associations
+        role_ids = [getattr(role, role_key) for role in roles]
+        existing_pairs = set(tuple(row) for row in self.db.session.execute(
+            association_table.select()
+            .with_only_columns([user_column, role_column])
+            .where(user_column.in_(user_ids))
+            .where(role_column.in_(role_ids))).fetchall())
+        rows = [{user_column.key: user_id, role_column.key: role_id}
+            for user_id in user_ids for role_id in role_ids
+            if (user_id, role_id) not in existing_pairs]
+        if rows:
+            self.db.session.execute(association_table.insert(), rows)
+
+        # Users of the current session must reload their roles
+        user_ids = set(user_ids)
+        for object in list(self.db.session.identity_map.values()):
+            if isinstance(object, UserClass) and getattr(object, user_key) in user_ids:
+                self.db.session.expire(object, ['roles'])
+
+    def bulk_set_bits(self, ObjectClass, ids, field_name, bits):
+        """ Set ``bits`` in the integer field ``field_name`` of the objects of ``ids``, with a single UPDATE.
+
+        NULL fields are left untouched.
+        """
+        self._read_from_primary()
+        field = getattr(ObjectClass, field_name)
+        self.db.session.execute(
+            ObjectClass.__table__.update()
+            .where(ObjectClass.id.in_(ids))
+            .where(field.isnot(None))
+            .values({field.key: field.op('|')(bits)}))
+
+    def make_cacheable_object(self, object):
+        """ Returns a detached copy of ``object`` that can be kept across sessions and threads.
+
+        Only the column attributes are copied. Use ``merge_cached_object()`` to attach it to the current session.
+        """
+        from sqlalchemy import inspect
+        from sqlalchemy.orm import make_transient_to_detached
+
+        mapper = inspect(type(object))
+        copy = mapper.class_manager.new_instance()
+        for column_attribute in mapper.column_attrs:
+            setattr(copy, column_attribute.key, getattr(object, column_attribute.key))
+        make_transient_to_detached(copy)
+        return copy
+
+    def get_or_add_object(self, ObjectClass, **kwargs):
+        """ Returns the object of type ``ObjectClass`` matching ``**kwargs`` (unique field values),
+        adding and flushing a new one if there is none.
+
+        The new object is inserted in a SAVEPOINT: if a concurrent transaction inserted the same values first,
+        the IntegrityError only rolls back the SAVEPOINT, and the object of the other transaction is returned.
+        """
+        from sqlalchemy.exc import IntegrityError
+
+        self._read_from_primary()
+        object = self.find_first_object(ObjectClass, **kwargs)
+        if object is not None:
+            return object
+        object = ObjectClass(**kwargs)
+        try:
+            with self.db.session.begin_nested():
+                self.db.session.add(object)
+        except IntegrityError:
+            object = self.find_first_object(ObjectClass, **kwargs)
+            if object is None:
+                raise
+        return object
+
+    def merge_cached_object(self, object):
+        """ Returns the instance of the current session for an object returned by ``make_cacheable_object()``,
+        without querying the database.
+        """
+        return self.db.session.merge(object, load=False)
 
-            # Add a case sensitive filter to the query
-            query = query.filter(field.ilike(field_value))  # case INsensitive!!
+    def iter_objects_in_batches(self, ObjectClass, batch_size=1000):
+        """ Iterate over all objects of type ``ObjectClass``, in lists of at most ``batch_size`` objects.
 
-        # Execute query
-        return query.first()
+        Uses keyset pagination on the ``id`` column, so that each batch is an index range scan
+        and the objects of a batch can be committed before fetching the next one.
+        """
+        last_id = None
+        while True:
+            query = self.db.session.query(ObjectClass).order_by(ObjectClass.id)
+            if last_id is not None:
+                query = query.filter(ObjectClass.id > last_id)
+            objects = query.limit(batch_size).all()
+            if not objects:
+                return
+            last_id = objects[-1].id
+            yield objects
 
     def save_object(self, object):
         """ Save object to database.
@@ -144,12 +436,24 @@ class SQLDbAdapter(DbAdapterInterface):
         | Session-based ODMs would do nothing.
         | Object-based ODMs would do something like object.save().
         """
-        pass
+        self._read_from_primary()
 
     def delete_object(self, object):
         """ Delete object from database.
+
+        An object that was never flushed is removed from the session,
+        and one discarded by a rollback has nothing to delete.
         """
-        self.db.session.delete(object)
+        from sqlalchemy import inspect
+        from ..user_snapshot import unwrap_snapshot
+
+        self._read_from_primary()
+        object = unwrap_snapshot(object)
+        state = inspect(object)
+        if state.persistent:
+            self.db.session.delete(object)
+        elif state.pending:
+            self.db.session.expunge(object)
 
     def commit(self):
         """Save all modified session objects to the database.
@@ -157,8 +461,46 @@ class SQLDbAdapter(DbAdapterInterface):
         | Session-based ODMs would call something like ``db.session.commit()``.
         | Object-based ODMs would do nothing.
         """
-        self.db.session.commit()
-
+        self._read_from_primary(committed=True)
+        with self._unique_constraint_errors():
+            self.db.session.commit()
+
+    def flush(self):
+        """Write the pending changes of the session objects to the database, without committing them."""
+        self._read_from_primary()
+        with self._unique_constraint_errors():
+            self.db.session.flush()
+
+    def rollback(self):
+        """Discard the changes of the session objects that were not committed."""
+        self.db.session.rollback()
+
+
+    @contextmanager
+    def _unique_constraint_errors(self):
+        # Turn an IntegrityError raised by the writes of the ``with`` block into a UniqueConstraintError,
+        # when a new or changed User holds a username or email address that another user has.
+        # The session is rolled back, as after any failed flush.
+        from sqlalchemy import inspect
+        from sqlalchemy.exc import IntegrityError
+
+        session = self.db.session
+        UserClass = self.auth.db_manager.UserClass
+        # Only the loaded values: unloaded (deferred) fields cannot have been changed
+        unique_values = []
+        for object in chain(session.new, session.dirty):
+            if isinstance(object, UserClass):
+                loaded_values = inspect(object).dict
+                values = {field_name: loaded_values.get(field_name) for field_name in uniqueness_guards.guarded_fields(self.auth)}
+                unique_values.append((type(object), loaded_values.get('id'), values))
+        try:
+            yield
+        except IntegrityError:
+            session.rollback()
+            error = self.get_unique_constraint_error(unique_values)
+            if error is None:
+                raise
+            raise error
 
     # Database management methods
     # ---------------------------
@@ -0,0 +1,47 @@
+"""This module implements the uniqueness guard items shared by the DynamoDB adapters.
+
+DynamoDB has no unique secondary indexes. Each unique User field value is reserved by a guard item
+whose hash key is '<FIELD>#<canonical value>' (for example 'EMAIL#myname@example.com'),
+written in the same transaction as the User item, or with a conditional put.
+Availability checks are then a single GetItem on the guard table.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+from .canonical_fields import canonicalize
+
+# Name of the attribute that remembers the guard keys of a loaded User object
+GUARD_KEYS_ATTRIBUTE = '_auth_guard_keys'
+
+def guarded_fields(auth):
+    """Returns the unique User fields guarded with the current settings."""
+    fields = []
+    if auth.AUTH_ENABLE_USERNAME:
+        fields.append('username')
+    if auth.AUTH_ENABLE_EMAIL:
+        fields.append('email')
+    return fields
+
+def guard_key(field_name, value):
+    """Returns the hash key of the guard item of ``value``.
+    Values that only differ by case, Unicode normalization or surrounding spaces share a guard item."""
+    return '%s#%s' % (field_name.upper(), canonicalize(value))
+
+def current_guard_keys(auth, object):
+    """Returns a {field name: guard key} dict of the unique values of ``object``."""
+    keys = {}
+    for field_name in guarded_fields(auth):
+        value = getattr(object, field_name, None)
+        if value:
+            keys[field_name] = guard_key(field_name, value)
+    return keys
+
+def remember_guard_keys(auth, object):
+    """Remember the guard keys of a loaded ``object``, to release them when its values change."""
+    object.__dict__[GUARD_KEYS_ATTRIBUTE] = current_guard_keys(auth, object)
+    return object
+
+def remembered_guard_keys(object):
+    """Returns the guard keys held by ``object`` when it was loaded or last saved."""
+    return object.__dict__.get(GUARD_KEYS_ATTRIBUTE, {})
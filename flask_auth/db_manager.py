@@ -3,8 +3,17 @@
 # Author: Alejandro Alvarez <jandrikus@gmail.com>
 # Copyright (c) 2019 Alejandro Alvarez
 
-from .db_adapters import PynamoDbAdapter, DynamoDbAdapter, MongoDbAdapter, SQLDbAdapter
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from time import monotonic
+
+from flask import g, has_app_context, has_request_context
+
+from . import db_adapters
+from .db_adapters import get_db_adapter_class
+from .db_adapters.canonical_fields import canonical_fields, canonical_value, set_canonical_fields
 from . import current_user, ConfigError
+from .user_snapshot import UserSnapshot, unwrap_snapshot
 
 class DBManager(object):
 	"""Manage DB objects."""
@@ -24,98 +33,296 @@ class DBManager(object):
 		self.RoleClass = RoleClass
 
 		self.auth = app.auth
-		self.db_adapter = None
-
-		# Check if db is a SQLAlchemy instance
-		if self.db_adapter is None:
-			try:
-				from flask_sqlalchemy import SQLAlchemy
-
-				if isinstance(db, SQLAlchemy):
-					self.db_adapter = SQLDbAdapter(app, db)
-			except ImportError:
-				pass  # Ignore ImportErrors
-
-		# Check if db is a MongoEngine instance
-		if self.db_adapter is None:
-			try:
-				from flask_mongoengine import MongoEngine
-
-				if isinstance(db, MongoEngine):
-					self.db_adapter = MongoDbAdapter(app, db)
-			except ImportError:
-				pass  # Ignore ImportErrors
-
-		# Check if db is a Flywheel instance
-		if self.db_adapter is None: # pragma: no cover
-			try:
-				from flask_flywheel import Flywheel
-
-				if isinstance(db, Flywheel):
-					self.db_adapter = DynamoDbAdapter(app, db)
-			except ImportError:
-				pass  # Ignore ImportErrors
-
-		# Check if the UserClass is a Pynamo Model
-		if self.db_adapter is None:
-			try:
-				from pynamodb.models import Model
-
-				if issubclass(UserClass, Model):
-					self.db_adapter = PynamoDbAdapter(app)
-			except ImportError:
-				pass # Ignore ImportErrors
-
-		# Check self.db_adapter
-		if self.db_adapter is None:
+
+		# Use the DbAdapter named by AUTH_DB_ADAPTER,
+		# or detect it from the ``db`` and ``UserClass`` types without importing unrelated ORMs
+		DbAdapterClass = get_db_adapter_class(self.auth.AUTH_DB_ADAPTER, db, UserClass)
+
+		# Check DbAdapterClass
+		if DbAdapterClass is None:
+			if self.auth.AUTH_DB_ADAPTER:
+				raise ConfigError("AUTH_DB_ADAPTER '%s' is not a registered DbAdapter." % self.auth.AUTH_DB_ADAPTER)
 			raise ConfigError(
 				'No Flask-SQLAlchemy, Flask-MongoEngine or Flask-Flywheel installed and no Pynamo Model in use.'\
 				' You must install one of these Flask extensions.')
-
+		self.db_adapter = DbAdapterClass(app, db)
+
+		# Precompute the transitive closure of the role hierarchy:
+		# role name -> frozenset of the role and all the roles it implies
+		role_hierarchy = dict(getattr(RoleClass, 'role_hierarchy', None) or {})
+		role_hierarchy.update(self.auth.AUTH_ROLE_HIERARCHY)
+		self.implied_roles = self._compute_implied_roles(role_hierarchy)
+
+		# Roles bitmask: the role name -> bit registry is built with the role cache
+		if self.auth.AUTH_ENABLE_ROLES_BITMASK:
+			if not isinstance(self.db_adapter, db_adapters.SQLDbAdapter):
+				raise ConfigError('AUTH_ENABLE_ROLES_BITMASK requires Flask-SQLAlchemy.')
+			if RoleClass is None:
+				raise ConfigError('AUTH_ENABLE_ROLES_BITMASK requires the RoleClass parameter of Auth.')
+		# Role cache (SQL): a _RoleRegistry loaded from the roles table on first use.
+		# It is never changed in place: each reload replaces it with a single assignment.
+		self.role_registry = None
+		self._role_registry_lock = Lock()
+		# Role names missing from the roles table -> time until which they are not looked up again
+		self._missing_role_names = {}
+
+		# Canonical shadow fields: users are found by an exact match on the canonical username and email
+		self.canonical_fields = canonical_fields(self.auth)
+		for field_name in self.canonical_fields:
+			shadow_field_name = field_name + self.auth.AUTH_CANONICAL_FIELD_SUFFIX
+			if not hasattr(UserClass, shadow_field_name):
+				raise ConfigError("AUTH_ENABLE_CANONICAL_FIELDS requires a '%s' field in the User data-model." % shadow_field_name)
+
+		# Optimistic registration: the DynamoDB adapters only enforce uniqueness with guard items
+		if self.auth.AUTH_ENABLE_OPTIMISTIC_REGISTRATION and not self.auth.AUTH_UNIQUENESS_GUARD_TABLE:
+			if isinstance(self.db_adapter, (db_adapters.DynamoDbAdapter, db_adapters.PynamoDbAdapter)):
+				raise ConfigError('AUTH_ENABLE_OPTIMISTIC_REGISTRATION requires AUTH_UNIQUENESS_GUARD_TABLE with DynamoDB.')
+
+		# Unit of work: the objects saved during a request are written when it completes
+		if self.auth.AUTH_ENABLE_UNIT_OF_WORK:
+			app.after_request(self._complete_unit_of_work)
+			app.teardown_request(self._discard_unit_of_work)
+
+		# User snapshots: the fields projected on the authentication paths
+		self.snapshot_fields = None
+		if self.auth.AUTH_ENABLE_USER_SNAPSHOTS:
+			field_names = ['id'] + list(self.auth.AUTH_USER_SNAPSHOT_FIELDS)
+			if self.auth.AUTH_ENABLE_SECURITY_GENERATION:
+				field_names.append(self.auth.AUTH_SECURITY_GENERATION_FIELD)
+			if self.auth.AUTH_ENABLE_ROLES_BITMASK:
+				field_names.append(self.auth.AUTH_ROLES_BITMASK_FIELD)
+			# Saving a snapshot updates the canonical fields: project them with their source fields
+			for field_name in self.canonical_fields:
+				field_names += [field_name, field_name + self.auth.AUTH_CANONICAL_FIELD_SUFFIX]
+			self.snapshot_fields = tuple(dict.fromkeys(field_names))
+		# User snapshot cache: user id -> (security generation, expiry time, snapshot data), least recently used first
+		self.snapshot_cache = OrderedDict()
+		self._snapshot_cache_lock = Lock()
 
 	def add_user_role(self, user, role_name):
 		# Associate a role name with a user.
 
+		# Roles the user already has, directly or through the role hierarchy, are not stored again
+		if role_name in self._expand_roles(self.get_user_roles(user)):
+			return
+		self._forget_effective_roles(user)
+
 		# For SQL: user.roles is list of pointers to Role objects
-		if isinstance(self.db_adapter, SQLDbAdapter):
-			# user.roles is a list of Role IDs
+		if isinstance(self.db_adapter, db_adapters.SQLDbAdapter):
+			# user.roles is a list of Role IDs (read-only rows on a snapshot: load the full User object)
+			user = unwrap_snapshot(user)
 			# Get or add role
-			role = self.db_adapter.find_first_object(self.RoleClass, name=role_name)
-			if not role:
-				role = self.RoleClass(name=role_name)
-				self.db_adapter.add_object(role)
+			role = self._get_or_add_role(role_name)
 			user.roles.append(role)
+			if self.auth.AUTH_ENABLE_ROLES_BITMASK:
+				self._set_roles_mask(user)
 
 		# For others: user.roles is a list of role names
 		else:
-			# user.roles is a list of role names
-			user.roles.append(role_name)
+			# user.roles is a list of role names, changed in place: load the full User object of a snapshot
+			unwrap_snapshot(user).roles.append(role_name)
+
+	def remove_user_role(self, user, role_name):
+		"""
+		Dissociate a role name from a user.
+
+		Roles implied through the role hierarchy cannot be removed:
+		remove the role that implies them instead.
+		"""
+		self._forget_effective_roles(user)
+
+		# For SQL: user.roles is list of pointers to Role objects
+		if isinstance(self.db_adapter, db_adapters.SQLDbAdapter):
+			user = unwrap_snapshot(user)
+			for role in list(user.roles):
+				if role.name == role_name:
+					user.roles.remove(role)
+			if self.auth.AUTH_ENABLE_ROLES_BITMASK:
+				self._set_roles_mask(user)
+
+		# For others: user.roles is a list of role names
+		else:
+			user = unwrap_snapshot(user)
+			while role_name in user.roles:
+				user.roles.remove(role_name)
+
+	def bulk_assign_roles(self, user_ids, role_names, batch_size=1000):
+		"""
+		Associate ``role_names`` with all the users of ``user_ids``, ``batch_size`` users at a time.
+
+		| Meant for provisioning jobs: the users are not loaded one by one,
+			and each batch is written with a single bulk operation, then committed.
+		| Existing associations are left untouched.
+		"""
+		user_ids = list(user_ids)
+		# For SQL: the Role objects are needed for their IDs
+		if isinstance(self.db_adapter, db_adapters.SQLDbAdapter):
+			roles = [self._get_or_add_role(role_name) for role_name in role_names]
+			self.db_adapter.commit()
+		# For others: user.roles is a list of role names
+		else:
+			roles = list(role_names)
+		for start in range(0, len(user_ids), batch_size):
+			batch_user_ids = user_ids[start:start+batch_size]
+			self.db_adapter.bulk_add_user_roles(self.UserClass, batch_user_ids, roles)
+			if self.auth.AUTH_ENABLE_ROLES_BITMASK:
+				role_bits = self._get_role_registry().role_bits
+				bits = 0
+				for role in roles:
+					bits |= role_bits[role.name]
+				self.db_adapter.bulk_set_bits(self.UserClass, batch_user_ids, self.auth.AUTH_ROLES_BITMASK_FIELD, bits)
+			self.db_adapter.commit()
+		if has_app_context():
+			g.pop('_auth_effective_roles', None)
+		with self._snapshot_cache_lock:
+			self.snapshot_cache.clear()
 
 	def add_user(self, **kwargs):
 		# Add a User object, with properties specified in ``**kwargs``.
+		if self.auth.AUTH_ENABLE_ROLES_BITMASK:
+			# New users have no roles yet
+			kwargs.setdefault(self.auth.AUTH_ROLES_BITMASK_FIELD, 0)
 		user = self.UserClass(**kwargs)
+		set_canonical_fields(self.auth, user)
 		self.db_adapter.add_object(user)
 		return user
 
 	def commit(self):
 		# Commit session-based objects to the database.
-		self.db_adapter.commit()
+		# With AUTH_ENABLE_UNIT_OF_WORK, the commit happens when the request completes.
+		if self._get_unit_of_work() is None:
+			self.db_adapter.commit()
+		else:
+			self.db_adapter.flush()
+
+	def flush(self):
+		"""
+		Write the objects saved so far now, so that unique constraint violations are raised to the caller.
+
+		| With AUTH_ENABLE_UNIT_OF_WORK, the objects are written without committing.
+			Document databases write them for good: a failed request cannot undo them.
+		| Otherwise, this is commit().
+		"""
+		unit_of_work = self._get_unit_of_work()
+		if unit_of_work is None:
+			self.db_adapter.commit()
+			return
+		while unit_of_work:
+			self.db_adapter.save_object(unit_of_work.popitem(last=False)[1])
+		self.db_adapter.flush()
+
+	def rollback(self):
+		# Discard the uncommitted changes of session-based objects, and the saves of the request's unit of work.
+		unit_of_work = self._get_unit_of_work()
+		if unit_of_work is not None:
+			unit_of_work.clear()
+		self.db_adapter.rollback()
 
 	def delete_object(self, object):
 		# Delete an object.
+		self._forget_cached_snapshot(object)
+		unit_of_work = self._get_unit_of_work()
+		if unit_of_work is not None:
+			# A deleted object is not written again
+			unit_of_work.pop(id(object), None)
 		self.db_adapter.delete_object(object)
 
-	def get_user_by_id(self, user_id):
-		# Retrieve the User object by ID.
-		return self.db_adapter.get_object(self.UserClass, id=user_id)
+	def is_user_field_available(self, field_name, value):
+		# Check if no User object has ``value`` in its unique field ``field_name``.
+		# Uniqueness guard items (see AUTH_UNIQUENESS_GUARD_TABLE) are authoritative over the canonical fields.
+		if field_name in self.canonical_fields and not self.auth.AUTH_UNIQUENESS_GUARD_TABLE:
+			return self._find_user(field_name, value) is None
+		return self.db_adapter.is_available(self.UserClass, field_name, value)
+
+	def get_user_by_id(self, user_id, generation=None):
+		"""
+		Retrieve the User object by ID -- as a UserSnapshot if AUTH_ENABLE_USER_SNAPSHOTS is True.
+
+		With AUTH_USER_SNAPSHOT_CACHE_SIZE, the snapshot may come from the snapshot cache,
+		where ``generation`` (the security generation of the session) picks the cached snapshot.
+		With AUTH_ENABLE_SECURITY_GENERATION, no cached snapshot matches a None ``generation``.
+		"""
+		if not self.snapshot_fields:
+			return self.db_adapter.get_object(self.UserClass, id=user_id)
+		if not self.auth.AUTH_USER_SNAPSHOT_CACHE_SIZE:
+			return self.db_adapter.get_object_snapshot(self.UserClass, user_id, self.snapshot_fields)
+		data = self._get_cached_snapshot_data(user_id, generation)
+		if data is not None:
+			return self.db_adapter.make_snapshot(self.UserClass, data)
+		user = self.db_adapter.get_object_snapshot(self.UserClass, user_id, self.snapshot_fields)
+		if user is not None:
+			self._cache_snapshot_data(user)
+		return user
+
+	def get_users_by_ids(self, user_ids):
+		# Retrieve the User objects of ``user_ids``, in as few round trips as the DbAdapter allows.
+		return self.db_adapter.get_objects(self.UserClass, user_ids)
+
+	def find_users(self, **kwargs):
+		"""
+		Retrieve the User objects matching the filters in ``**kwargs`` -- case sensitive.
+		Meant for admin listings and reports: the results may be streamed (see the DbAdapters).
+		"""
+		return self.db_adapter.find_objects(self.UserClass, **kwargs)
 
 	def find_user_by_username(self, username):
-		# Find a User object by username.
-		return self.db_adapter.ifind_first_object(self.UserClass, username=username)
+		# Find a User object by username -- as a UserSnapshot if AUTH_ENABLE_USER_SNAPSHOTS is True.
+		return self._find_user('username', username)
 
 	def find_user_by_email(self, email):
-		# Retrieve the User object by email address.
-		return self.db_adapter.ifind_first_object(self.UserClass, email=email)
+		# Retrieve the User object by email address -- as a UserSnapshot if AUTH_ENABLE_USER_SNAPSHOTS is True.
+		return self._find_user('email', email)
+
+	def find_user_by_username_or_email(self, username, email=None):
+		"""
+		Find a User object by username, or else by email address -- case insensitive --
+		with a single query if the DbAdapter supports it.
+
+		``email`` defaults to ``username``: a login name that may be either.
+		Returns a UserSnapshot if AUTH_ENABLE_USER_SNAPSHOTS is True.
+		"""
+		if email is None:
+			email = username
+		fields = [('username', username), ('email', email)]
+		canonical = [field_name in self.canonical_fields for field_name, value in fields]
+		if all(canonical):
+			# Exact match on the canonical shadow fields
+			suffix = self.auth.AUTH_CANONICAL_FIELD_SUFFIX
+			filters = [(field_name + suffix, canonical_value(value)) for field_name, value in fields if value]
+			case_insensitive = False
+		elif not any(canonical):
+			filters = [(field_name, value) for field_name, value in fields if value]
+			case_insensitive = True
+		else:
+			# Only one of the fields has a canonical shadow field
+			return self._find_user('username', username) or self._find_user('email', email)
+		if not filters:
+			return None
+		return self.db_adapter.find_first_object_by_any(self.UserClass, filters, case_insensitive, self.snapshot_fields)
+
+	def user_field_matches(self, user, field_name, value):
+		# Check if the unique field ``field_name`` of ``user`` matches ``value`` -- case insensitive.
+		user_value = getattr(user, field_name, None)
+		if not user_value or not value:
+			return False
+		if field_name in self.canonical_fields:
+			return canonical_value(user_value) == canonical_value(value)
+		return user_value.lower() == value.lower()
+
+	def _find_user(self, field_name, value):
+		# Find a User object by its unique field ``field_name`` -- case insensitive
+		if field_name in self.canonical_fields:
+			# Exact match on the canonical shadow field
+			value = canonical_value(value)
+			if value is None:
+				return None
+			kwargs = {field_name + self.auth.AUTH_CANONICAL_FIELD_SUFFIX: value}
+			if self.snapshot_fields:
+				return self.db_adapter.find_first_object_snapshot(self.UserClass, self.snapshot_fields, **kwargs)
+			return self.db_adapter.find_first_object(self.UserClass, **kwargs)
+		if self.snapshot_fields:
+			return self.db_adapter.ifind_first_object_snapshot(self.UserClass, self.snapshot_fields, **{field_name: value})
+		return self.db_adapter.ifind_first_object(self.UserClass, **{field_name: value})
 
 	def get_user_roles(self, user):
 		"""
@@ -126,7 +333,7 @@ class DBManager(object):
 			Database management methods.
 		"""
 		# For SQL: user.roles is list of pointers to Role objects
-		if isinstance(self.db_adapter, SQLDbAdapter):
+		if isinstance(self.db_adapter, db_adapters.SQLDbAdapter):
 			# user.roles is a list of Role IDs
 			user_roles = [role.name for role in user.roles]
 		# For others: user.roles is a list of role names
@@ -135,13 +342,342 @@ class DBManager(object):
 			user_roles = user.roles
 		return user_roles
 
+	def get_effective_roles(self, user):
+		"""
+		Retrieve the set of role names of ``user``,
+		including the roles implied through the role hierarchy (see AUTH_ROLE_HIERARCHY).
+
+		The result is computed once per request.
+		"""
+		if not has_app_context():
+			return self._expand_roles(self.get_user_roles(user))
+		effective_roles = g.setdefault('_auth_effective_roles', {})
+		# Keep a reference to ``user`` so that its id() cannot be reused during the request
+		cached = effective_roles.get(id(user))
+		if cached is None or cached[0] is not user:
+			cached = effective_roles[id(user)] = (user, self._expand_roles(self.get_user_roles(user)))
+		return cached[1]
+
 	def save_object(self, object):
 		# Save an object to the database.
-		self.db_adapter.save_object(object)
+		# With AUTH_ENABLE_UNIT_OF_WORK, the object is written once, when the request completes.
+		self._forget_cached_snapshot(object)
+		unit_of_work = self._get_unit_of_work()
+		if unit_of_work is None:
+			self.db_adapter.save_object(object)
+		else:
+			unit_of_work[id(object)] = object
 
 	def save_user(self, user):
-		# Save the User object.
-		self.db_adapter.save_object(user)
+		# Save the User object, updating its canonical shadow fields.
+		if self.canonical_fields:
+			self._update_canonical_fields(user)
+		self.save_object(user)
+
+	def call_after_commit(self, callback):
+		"""
+		Call ``callback`` without arguments once the objects saved so far have been committed.
+
+		| With AUTH_ENABLE_UNIT_OF_WORK, it is called after the commit of the request's unit of work,
+			and never if the request rolls back.
+		| Otherwise, it is called right away: ``commit()`` has committed them.
+		"""
+		if self._get_unit_of_work() is None:
+			callback()
+		else:
+			g.setdefault('_auth_after_commit_callbacks', []).append(callback)
+
+	# Unit of work methods
+	# --------------------
+
+	def _get_unit_of_work(self):
+		# Returns the unit of work of the current request: an ordered dict of id(object) -> object saved
+		# during the request, or None if AUTH_ENABLE_UNIT_OF_WORK is False or outside requests.
+		if not self.auth.AUTH_ENABLE_UNIT_OF_WORK or not has_request_context():
+			return None
+		unit_of_work = g.get('_auth_unit_of_work')
+		if unit_of_work is None:
+			unit_of_work = g._auth_unit_of_work = OrderedDict()
+		return unit_of_work
+
+	def _complete_unit_of_work(self, response):
+		# After each request: write the saved objects once and commit, unless the request failed
+		unit_of_work = g.pop('_auth_unit_of_work', None)
+		callbacks = g.pop('_auth_after_commit_callbacks', ())
+		if unit_of_work is None:
+			return response
+		if response.status_code >= 500:
+			self.db_adapter.rollback()
+			return response
+		for object in unit_of_work.values():
+			self.db_adapter.save_object(object)
+		self.db_adapter.commit()
+		# Snapshots cached by concurrent requests before the commit are outdated
+		for object in unit_of_work.values():
+			self._forget_cached_snapshot(object)
+		for callback in callbacks:
+			callback()
+		return response
+
+	def _discard_unit_of_work(self, exception=None):
+		# After a request that raised an exception (the unit of work was not completed): roll back its writes
+		g.pop('_auth_after_commit_callbacks', None)
+		if g.pop('_auth_unit_of_work', None) is not None:
+			self.db_adapter.rollback()
+
+	# Canonical fields methods
+	# ------------------------
+
+	def backfill_canonical_fields(self, batch_size=1000):
+		"""
+		Populate the canonical shadow fields of all existing users, committing every ``batch_size`` users.
+
+		Returns the number of updated users.
+		"""
+		count = 0
+		for users in self.db_adapter.iter_objects_in_batches(self.UserClass, batch_size):
+			for user in users:
+				if self._update_canonical_fields(user):
+					self.db_adapter.save_object(user)
+					count += 1
+			self.db_adapter.commit()
+		return count
+
+	def backfill_lower_fields(self, batch_size=1000):
+		"""
+		Populate the 'field_lower' shadow fields of all existing users (DynamoDB adapters),
+		committing every ``batch_size`` users.
+
+		Returns the number of updated users.
+		"""
+		count = 0
+		for users in self.db_adapter.iter_objects_in_batches(self.UserClass, batch_size):
+			for user in users:
+				if self.db_adapter.update_lower_fields(user):
+					self.db_adapter.save_object(user)
+					count += 1
+			self.db_adapter.commit()
+		return count
+
+	def _update_canonical_fields(self, user):
+		# Update the canonical shadow fields of ``user`` that are outdated. Returns True if any was.
+		suffix = self.auth.AUTH_CANONICAL_FIELD_SUFFIX
+		outdated = any(
+			getattr(user, field_name + suffix, None) != canonical_value(getattr(user, field_name, None))
+			for field_name in self.canonical_fields)
+		if outdated:
+			set_canonical_fields(self.auth, user)
+		return outdated
+
+	# Sharding methods
+	# ----------------
+
+	def rebalance_shards(self, batch_size=1000, retired_binds=()):
+		"""
+		Move the users that are not on the shard of their ID to it, after AUTH_SHARD_BINDS changed
+		(see ShardedDbAdapter.rebalance()). ``retired_binds`` lists the bind keys of removed shards.
+
+		Returns the number of moved users.
+		"""
+		if not isinstance(self.db_adapter, db_adapters.ShardedDbAdapter):
+			raise ConfigError("Rebalancing shards requires AUTH_DB_ADAPTER 'sharded'.")
+		return self.db_adapter.rebalance(self.UserClass, batch_size, retired_binds)
+
+	# Role hierarchy methods
+	# ----------------------
+
+	def _compute_implied_roles(self, role_hierarchy):
+		# Returns the transitive closure of ``role_hierarchy``: role name -> frozenset of role names
+		for role_name, role_names in role_hierarchy.items():
+			if isinstance(role_names, str) or not all(isinstance(name, str) for name in role_names):
+				raise ConfigError("The role hierarchy of '%s' must be a list of role names." % role_name)
+		implied_roles = {}
+		for role_name in role_hierarchy:
+			# Depth-first walk; cycles are harmless, every role is visited once
+			closure = set()
+			pending = [role_name]
+			while pending:
+				name = pending.pop()
+				if name not in closure:
+					closure.add(name)
+					pending.extend(role_hierarchy.get(name, ()))
+			implied_roles[role_name] = frozenset(closure)
+		return implied_roles
+
+	def _expand_roles(self, role_names):
+		# Returns the frozenset of ``role_names`` and all the roles they imply
+		if not self.implied_roles:
+			return frozenset(role_names)
+		effective_roles = set()
+		for role_name in role_names:
+			effective_roles.update(self.implied_roles.get(role_name, (role_name,)))
+		return frozenset(effective_roles)
+
+	def has_roles_mask(self, user, requirements):
+		"""
+		Evaluate ``has_roles()`` requirements against the roles bitmask of ``user``,
+		with one bitwise AND per requirement.
+
+		Returns None if the bitmask of ``user`` has not been populated yet.
+		"""
+		user_mask = getattr(user, self.auth.AUTH_ROLES_BITMASK_FIELD, None)
+		if user_mask is None:
+			return None
+		user_mask = int(user_mask)
+		for requirement in requirements:
+			role_names = requirement if isinstance(requirement, (list, tuple)) else (requirement,)
+			if not user_mask & self.get_roles_mask(role_names):
+				return False
+		return True
+
+	def get_roles_mask(self, role_names):
+		"""
+		Returns the bitmask of the roles that grant at least one of ``role_names``,
+		directly or through the role hierarchy.
+		"""
+		registry = self._get_role_registry()
+		missing_role_names = [role_name for role_name in role_names if role_name not in registry.role_masks]
+		if missing_role_names and self._should_reload_roles(missing_role_names):
+			# Roles may have been added by another process: reload the registry
+			registry = self._load_roles(missing_role_names)
+		mask = 0
+		for role_name in role_names:
+			mask |= registry.role_masks.get(role_name, 0)
+		return mask
+
+	def backfill_roles_masks(self, batch_size=1000):
+		"""
+		Populate the roles bitmask of all existing users, committing every ``batch_size`` users.
+
+		Returns the number of updated users.
+		"""
+		self._load_roles()
+		count = 0
+		for users in self.db_adapter.iter_objects_in_batches(self.UserClass, batch_size):
+			for user in users:
+				self._set_roles_mask(user)
+			self.db_adapter.commit()
+			count += len(users)
+		return count
+
+	# Role cache methods (SQL)
+	# -------------------------
+
+	def _get_or_add_role(self, role_name):
+		# Returns the Role object named ``role_name`` in the current session, creating it if needed
+		cached_role = self._get_role_registry().roles_by_name.get(role_name)
+		if cached_role is None:
+			# Roles may have been added by another process: reload the cache
+			cached_role = self._load_roles().roles_by_name.get(role_name)
+		if cached_role is not None:
+			# Attach the cached role to the current session, without a query
+			return self.db_adapter.merge_cached_object(cached_role)
+		# Another request may be adding the same role: the DbAdapter returns the role that wins
+		role = self.db_adapter.get_or_add_object(self.RoleClass, name=role_name)
+		self._register_role(role)
+		return role
+
+	def _get_role_registry(self):
+		# Returns the role registry, loading it on first use
+		registry = self.role_registry
+		if registry is None:
+			registry = self._load_roles()
+		return registry
+
+	def _load_roles(self, missing_role_names=()):
+		# Load the role cache and the role name -> bit registry from the roles table.
+		# ``missing_role_names`` that the roles table does not have either are not looked up again for a while.
+		roles = self.db_adapter.find_objects(self.RoleClass)
+		with self._role_registry_lock:
+			registry = self.role_registry = self._build_role_registry(roles)
+			now = monotonic()
+			recheck_time = now + self.auth.AUTH_MISSING_ROLES_RECHECK_INTERVAL
+			missing = {role_name: time for role_name, time in self._missing_role_names.items()
+				if time > now and role_name not in registry.role_masks}
+			missing.update((role_name, recheck_time) for role_name in missing_role_names if role_name not in registry.role_masks)
+			self._missing_role_names = missing
+		return registry
+
+	def _should_reload_roles(self, missing_role_names):
+		# Check if one of ``missing_role_names`` has not been looked up in the roles table recently
+		now = monotonic()
+		missing = self._missing_role_names
+		return any(missing.get(role_name, 0) <= now for role_name in missing_role_names)
+
+	def _register_role(self, role):
+		# Add a newly created role to the cache and to the registry
+		self._get_role_registry()
+		with self._role_registry_lock:
+			roles = list(self.role_registry.roles_by_name.values()) + [role]
+			self.role_registry = self._build_role_registry(roles)
+			self._missing_role_names = {role_name: time for role_name, time in self._missing_role_names.items() if role_name != role.name}
+
+	def _build_role_registry(self, roles):
+		# Returns a new _RoleRegistry of ``roles``: built in local dicts, published by the caller
+		roles_by_name = {}
+		role_bits = {}
+		for role in roles:
+			roles_by_name[role.name] = self.db_adapter.make_cacheable_object(role)
+			role_bits[role.name] = 1 << role.id
+		# Role name -> bitmask of the roles that imply it (including itself)
+		role_masks = {}
+		for role_name, bit in role_bits.items():
+			for implied_role_name in self.implied_roles.get(role_name, (role_name,)):
+				role_masks[implied_role_name] = role_masks.get(implied_role_name, 0) | bit
+		return _RoleRegistry(roles_by_name, role_bits, role_masks)
+
+	def _set_roles_mask(self, user):
+		# Recompute the roles bitmask of ``user`` from its roles
+		registry = self._get_role_registry()
+		mask = 0
+		for role in user.roles:
+			if role.name not in registry.role_bits:
+				self._register_role(role)
+				registry = self.role_registry
+			mask |= registry.role_bits[role.name]
+		setattr(user, self.auth.AUTH_ROLES_BITMASK_FIELD, mask)
+
+	def _forget_effective_roles(self, user):
+		# Drop the effective roles of ``user`` computed during this request, and its cached snapshot
+		if has_app_context():
+			g.get('_auth_effective_roles', {}).pop(id(user), None)
+		self._forget_cached_snapshot(user)
+
+	# User snapshot cache methods
+	# ---------------------------
+
+	def _get_cached_snapshot_data(self, user_id, generation):
+		# Returns the cached snapshot data of ``user_id`` at ``generation``, or None if it is not cached or has expired
+		user_id = str(user_id)
+		with self._snapshot_cache_lock:
+			cached = self.snapshot_cache.get(user_id)
+			if cached is None or cached[0] != generation:
+				return None
+			if cached[1] <= monotonic():
+				del self.snapshot_cache[user_id]
+				return None
+			self.snapshot_cache.move_to_end(user_id)
+		return _copy_snapshot_data(cached[2])
+
+	def _cache_snapshot_data(self, user):
+		# Cache the projected fields of a freshly loaded user (a UserSnapshot, or a full object with other DbAdapters)
+		if isinstance(user, UserSnapshot):
+			data = user.get_data()
+		else:
+			data = {field_name: getattr(user, field_name) for field_name in self.snapshot_fields if hasattr(user, field_name)}
+		generation = self.auth.generation_manager.get_generation(user) if self.auth.AUTH_ENABLE_SECURITY_GENERATION else None
+		expiry_time = monotonic() + self.auth.AUTH_USER_SNAPSHOT_CACHE_TTL
+		with self._snapshot_cache_lock:
+			self.snapshot_cache[str(user.id)] = (generation, expiry_time, _copy_snapshot_data(data))
+			while len(self.snapshot_cache) > self.auth.AUTH_USER_SNAPSHOT_CACHE_SIZE:
+				self.snapshot_cache.popitem(last=False)
+
+	def _forget_cached_snapshot(self, object):
+		# Drop the cached snapshot of a User object
+		if not self.snapshot_cache or not isinstance(object, (self.UserClass, UserSnapshot)):
+			return
+		with self._snapshot_cache_lock:
+			self.snapshot_cache.pop(str(object.id), None)
 
 	# Database management methods
 	# ---------------------------
@@ -156,4 +692,12 @@ class DBManager(object):
 
 		.. warning:: ALL DATA WILL BE LOST. Use only for automated testing.
 		"""
-		return self.db_adapter.drop_all_tables()
\ No newline at end of file
+		return self.db_adapter.drop_all_tables()
+
+# The roles table, as cached by the DBManager (SQL):
+# role name -> detached Role object, role name -> bit, and role name -> bitmask of the roles that grant it
+_RoleRegistry = namedtuple('_RoleRegistry', ('roles_by_name', 'role_bits', 'role_masks'))
+
+def _copy_snapshot_data(data):
+	# Copy the snapshot data kept in the cache: list, set and dict values may be changed in place by their users
+	return {name: type(value)(value) if isinstance(value, (list, set, dict)) else value for name, value in data.items()}
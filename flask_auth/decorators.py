@@ -7,9 +7,104 @@ such as @login_required, @roles_accepted and @roles_required and @confirmed_emai
 # Copyright (c) 2019 Alejandro Alvarez
 
 from functools import wraps
-from flask import current_app, g
+from weakref import WeakKeyDictionary
 from flask_login import current_user
 
+try:
+	# Flask >= 2.2: the request context is a context variable
+	from flask.globals import request_ctx as _request_ctx
+
+	def _get_request_ctx():
+		return _request_ctx._get_current_object()
+except ImportError:
+	from flask import _request_ctx_stack
+
+	def _get_request_ctx():
+		return _request_ctx_stack.top
+
+class AccessPolicy(object):
+	"""
+	The authorization policy of a protected view.
+
+	| ``require_confirmed_account``: the user must have a confirmed account
+		(if AUTH_ENABLE_CONFIRM_ACCOUNT is True).
+	| ``role_requirements``: the requirements passed to ``has_roles()``.
+	"""
+	__slots__ = ('require_confirmed_account', 'role_requirements')
+
+	def __init__(self, require_confirmed_account=True, role_requirements=()):
+		self.require_confirmed_account = require_confirmed_account
+		self.role_requirements = tuple(role_requirements)
+
+	def merge(self, inner_policy):
+		# Combine the policies of stacked decorators into a single policy:
+		# any @allow_unconfirmed_account relaxes the confirmed account requirement,
+		# while role requirements add up (AND operation).
+		return AccessPolicy(
+			self.require_confirmed_account and inner_policy.require_confirmed_account,
+			self.role_requirements + inner_policy.role_requirements)
+
+	def compile(self, auth):
+		"""
+		Returns a check function for the settings of ``auth``.
+
+		| ``check(user)`` returns None when ``user`` is allowed,
+			or the name of the Auth view method to call otherwise ('unauthenticated' or 'unauthorized').
+		"""
+		# Resolve the settings once: the confirm-account branch and the role predicate are folded into one function
+		require_verified = self.require_confirmed_account and auth.settings.AUTH_ENABLE_CONFIRM_ACCOUNT
+		role_requirements = self.role_requirements
+		def check(user):
+			# User must be logged in, and verified (if required)
+			if not user.is_authenticated or (require_verified and not user.verified):
+				return 'unauthenticated'
+			# User must have the required roles
+			if role_requirements and not user.has_roles(*role_requirements):
+				return 'unauthorized'
+			return None
+		return check
+
+	def __repr__(self):
+		return 'AccessPolicy(require_confirmed_account=%r, role_requirements=%r)' % (
+			self.require_confirmed_account, self.role_requirements)
+
+# Views protected by _protect(): protected view -> unprotected view function
+_protected_views = WeakKeyDictionary()
+
+def _protect(view_function, policy):
+	# Returns ``view_function`` protected by ``policy``.
+	# Stacked decorators are folded into a single protected view with a merged policy.
+	if view_function in _protected_views:
+		policy = policy.merge(view_function.auth_policy)
+		view_function = _protected_views[view_function]
+	# One compiled check function per app (per Auth instance), compiled at its first request
+	compiled_checks = WeakKeyDictionary()
+
+	@wraps(view_function) # Tells debuggers that is is a function wrapper
+	def decorator(*args, **kwargs):
+		# A single context lookup: the app and the user loaded by Flask-Login live on the request context
+		ctx = _get_request_ctx()
+		auth = ctx.app.auth
+		check = compiled_checks.get(auth)
+		if check is None:
+			check = compiled_checks[auth] = policy.compile(auth)
+		user = getattr(ctx, 'user', None)
+		if user is None:
+			# Let Flask-Login load the user (Flask-Login >= 0.6.2 keeps it on flask.g)
+			user = current_user._get_current_object()
+		denied = check(user)
+		if denied is not None:
+			# Redirect to the unauthenticated or unauthorized page
+			return getattr(auth, denied)()
+		# It's OK to call the view
+		return view_function(*args, **kwargs)
+
+	# Expose the policy for introspection (see Auth.list_protected_endpoints())
+	decorator.auth_policy = policy
+	_protected_views[decorator] = view_function
+	return decorator
+
+
 def login_required(view_function):
 	"""
 	This decorator ensures that the current user is logged in.
@@ -28,24 +123,7 @@ def login_required(view_function):
 		or when the user has not confirmed the account.
 	| Calls the decorated view otherwise.
 	"""
-	@wraps(view_function) # Tells debuggers that is is a function wrapper
-	def decorator(*args, **kwargs):
-		auth = current_app.auth
-		allowed = False
-		# User must be logged in
-		if current_user.is_authenticated:
-			# User must be verified (if required)
-			if auth.AUTH_ENABLE_CONFIRM_ACCOUNT and current_user.verified:
-				allowed=True
-			# User can be not verified (if allowed)
-			elif not auth.AUTH_ENABLE_CONFIRM_ACCOUNT:
-				allowed=True
-		if not allowed:
-			# Redirect to unauthenticated page
-			return auth.unauthenticated()
-		# It's OK to call the view
-		return view_function(*args, **kwargs)
-	return decorator
+	return _protect(view_function, AccessPolicy())
 
 def allow_unconfirmed_account(view_function):
 	"""
@@ -82,19 +160,7 @@ def allow_unconfirmed_account(view_function):
 	| Calls unauthorized() when the user is not logged in.
 	| Calls the decorated view otherwise.
 	"""
-	@wraps(view_function) # Tells debuggers that is is a function wrapper
-	def decorator(*args, **kwargs):
-		auth = current_app.auth
-		allowed = False
-		# User must be logged in (no need to check verified)
-		if current_user.is_authenticated:
-			allowed=True
-		if not allowed:
-			# Redirect to unauthenticated page
-			return auth.unauthenticated()
-		# It's OK to call the view
-		return view_function(*args, **kwargs)
-	return decorator
+	return _protect(view_function, AccessPolicy(require_confirmed_account=False))
 
 def roles_accepted(*role_names):
 	"""
@@ -116,33 +182,10 @@ def roles_accepted(*role_names):
 	# convert the list to a list containing that list.
 	# Because roles_required(a, b) requires A AND B
 	# while roles_required([a, b]) requires A OR B
+	# NB: roles_required would call has_roles(*role_names): ('A', 'B') --> ('A', 'B')
+	# But: roles_accepted must call has_roles(role_names):  ('A', 'B') --< (('A', 'B'),)
 	def wrapper(view_function):
-
-		@wraps(view_function) # Tells debuggers that is is a function wrapper
-		def decorator(*args, **kwargs):
-			auth = current_app.auth
-			# User must be logged in with a confirmed account
-			allowed = False
-			# User must be logged in
-			if current_user.is_authenticated:
-				# User must be verified (if required)
-				if auth.AUTH_ENABLE_CONFIRM_ACCOUNT and current_user.verified:
-					allowed=True
-				# User can be not verified (if allowed)
-				elif not auth.AUTH_ENABLE_CONFIRM_ACCOUNT:
-					allowed=True
-			if not allowed:
-				# Redirect to unauthenticated page
-				return auth.unauthenticated()
-			# User must have the required roles
-			# NB: roles_required would call has_roles(*role_names): ('A', 'B') --> ('A', 'B')
-			# But: roles_accepted must call has_roles(role_names):  ('A', 'B') --< (('A', 'B'),)
-			if not current_user.has_roles(role_names):
-				# Redirect to the unauthorized page
-				return auth.unauthorized()
-			# It's OK to call the view
-			return view_function(*args, **kwargs)
-		return decorator
+		return _protect(view_function, AccessPolicy(role_requirements=(role_names,)))
 	return wrapper
 
 def roles_required(*role_names):
@@ -163,28 +206,5 @@ def roles_required(*role_names):
 	| Calls the decorated view otherwise.
 	"""
 	def wrapper(view_function):
-
-		@wraps(view_function)    # Tells debuggers that is is a function wrapper
-		def decorator(*args, **kwargs):
-			auth = current_app.auth
-			# User must be logged in with a confirmed account
-			allowed = False
-			# User must be logged in
-			if current_user.is_authenticated:
-				# User must be verified (if required)
-				if auth.AUTH_ENABLE_CONFIRM_ACCOUNT and current_user.verified:
-					allowed=True
-				# User can be not verified (if allowed)
-				elif not auth.AUTH_ENABLE_CONFIRM_ACCOUNT:
-					allowed=True
-			if not allowed:
-				# Redirect to unauthenticated page
-				return auth.unauthenticated()
-			# User must have the required roles
-			if not current_user.has_roles(*role_names):
-				# Redirect to the unauthorized page
-				return auth.unauthorized()
-			# It's OK to call the view
-			return view_function(*args, **kwargs)
-		return decorator
+		return _protect(view_function, AccessPolicy(role_requirements=role_names))
 	return wrapper
\ No newline at end of file
@@ -4,7 +4,6 @@
 # Copyright (c) 2019 Alejandro Alvarez
 
 from flask import redirect, url_for, current_app, render_template
-from flask_babel import _
 from datetime import datetime, timedelta
 import smtplib
 from email.message import EmailMessage
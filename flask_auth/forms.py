@@ -55,11 +55,17 @@ def username_validator(form, field):
 
 def unique_username_validator(form, field):
 	""" Ensure that Username is unique. This validator may NOT be customized."""
+	# Left to the database with AUTH_ENABLE_OPTIMISTIC_REGISTRATION (see RegisterForm)
+	if getattr(form, 'skip_unique_validators', False):
+		return
 	if not current_app.auth.username_is_available(field.data):
 		raise ValidationError(_l('This Username is already in use. Please try another one.'))
 
 def unique_email_validator(form, field):
 	""" Email must be unique. This validator may NOT be customized."""
+	# Left to the database with AUTH_ENABLE_OPTIMISTIC_REGISTRATION (see RegisterForm)
+	if getattr(form, 'skip_unique_validators', False):
+		return
 	if not current_app.auth.email_is_available(field.data):
 		raise ValidationError(_l('This Email is already in use. Please try another one.'))
 
@@ -175,19 +181,20 @@ class LoginForm(FlaskForm):
 
 		# Find user by username and/or email
 		user = None
-		if auth.AUTH_ENABLE_LOGIN_BY_USERNAME:
+		if auth.AUTH_ENABLE_LOGIN_BY_USERNAME and auth.AUTH_ENABLE_LOGIN_BY_EMAIL:
+			# Find user by username or email address (username field), in a single query
+			user = auth.db_manager.find_user_by_username_or_email(self.username.data)
+		elif auth.AUTH_ENABLE_LOGIN_BY_USERNAME:
 			# Find user by username
 			user = auth.db_manager.find_user_by_username(self.username.data)
-			# Find user by email address (username field)
-			if not user and auth.AUTH_ENABLE_LOGIN_BY_EMAIL:
-				user = auth.db_manager.find_user_by_email(self.username.data)
-
 		else:
 			# Find user by email address (email field)
 			user = auth.db_manager.find_user_by_email(self.email.data)
 
 		# Handle successful authentication
 		if user and auth.password_manager.verify_password(self.password.data, user.password):
+			# Keep the user for the login view: no need to find it again
+			self.user = user
 			return True   # Successful authentication
 
 		# Handle unsuccessful authentication
@@ -275,6 +282,8 @@ class RegisterForm(FlaskForm):
 			delattr(self, 'last_name')
 		else:
 			delattr(self, 'name')
+		# Duplicates are rejected by the database when the user is inserted: no availability lookups
+		self.skip_unique_validators = auth.AUTH_ENABLE_OPTIMISTIC_REGISTRATION
 
 		if not super(RegisterForm, self).validate():
 			return False
@@ -0,0 +1,131 @@
+"""
+This module implements the GenerationManager for Flask-Auth.
+It keeps track of per-user security generation numbers,
+which are embedded in sessions and tokens to invalidate them all at once.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+class GenerationBackendInterface(object):
+	"""
+	Define the interface of a shared backend (Redis, Memcached, a DB table...)
+	that propagates generation bumps between the workers of an application.
+	"""
+
+	def publish(self, user_id, generation):
+		"""Announce that the security generation of ``user_id`` is now ``generation``."""
+		raise NotImplementedError
+
+	def poll(self):
+		"""
+		Return an iterable of ``(user_id, generation)`` pairs
+		published by any worker since the last call to ``poll()`` of this worker.
+		"""
+		raise NotImplementedError
+
+class GenerationManager(object):
+	"""Bump and verify per-user security generation numbers."""
+	def __init__(self, app, backend=None):
+		"""
+		Args:
+			app(Flask): The Flask application instance.
+			backend(GenerationBackendInterface): Optional shared backend for multi-worker deployments.
+		"""
+		self.app = app
+		self.auth = app.auth
+		self.backend = backend
+		# Compact map: user id -> latest known security generation, least recently used first.
+		# Bounded by AUTH_SECURITY_GENERATION_CACHE_SIZE: forgotten users are read from the database again.
+		self.generations = OrderedDict()
+		self._generations_lock = Lock()
+		self._next_sync = 0
+
+	def get_generation(self, user):
+		# Return the security generation stored on the User object.
+		return int(getattr(user, self.auth.AUTH_SECURITY_GENERATION_FIELD, 0) or 0)
+
+	def bump_generation(self, user):
+		"""
+		Increment the security generation of ``user``.
+		Call ``publish_generation(user)`` once the change has been committed (see ``DBManager.call_after_commit()``).
+		"""
+		setattr(user, self.auth.AUTH_SECURITY_GENERATION_FIELD, self.get_generation(user)+1)
+
+	def publish_generation(self, user):
+		# Record the new generation locally and announce it to the other workers.
+		generation = self.get_generation(user)
+		self._remember(user.id, generation)
+		if self.backend:
+			self.backend.publish(str(user.id), generation)
+
+	def make_session_id(self, user):
+		# Returns the ID stored by Flask-Login in the session and in the remember cookie.
+		return '%s:%d' % (user.id, self.get_generation(user))
+
+	def parse_session_id(self, session_id):
+		"""
+		Split a session ID into ``(user_id, generation)``.
+		``generation`` is None when the session ID does not embed one.
+		"""
+		user_id, separator, generation = str(session_id).rpartition(':')
+		if not separator or not generation.isdigit():
+			return str(session_id), None
+		return user_id, int(generation)
+
+	def is_current(self, user_id, generation):
+		"""
+		Check ``generation`` against the in-memory map, without any DB query.
+
+		| Returns False if ``user_id`` is known to have a newer generation.
+		| Returns True otherwise (the loaded user must then be checked with ``verify()``).
+		"""
+		if self.backend and monotonic() >= self._next_sync:
+			self._sync()
+		if generation is None:
+			return False
+		known_generation = self.get_known_generation(user_id)
+		return known_generation is None or generation >= known_generation
+
+	def get_known_generation(self, user_id):
+		"""
+		Return the latest security generation of ``user_id`` in the in-memory map,
+		or None if the user is not in the map: its generation must then be read from the database.
+		"""
+		user_id = str(user_id)
+		with self._generations_lock:
+			generation = self.generations.get(user_id)
+			if generation is not None:
+				self.generations.move_to_end(user_id)
+		return generation
+
+	def verify(self, user, generation):
+		"""
+		Check ``generation`` against the generation of an already loaded ``user``
+		and remember the latter in the in-memory map.
+		"""
+		current_generation = self.get_generation(user)
+		self._remember(user.id, current_generation)
+		return generation == current_generation
+
+	def _remember(self, user_id, generation, newer_only=False):
+		# Record the generation of ``user_id`` as the most recently used entry of the map,
+		# and forget the least recently used entries beyond AUTH_SECURITY_GENERATION_CACHE_SIZE
+		user_id = str(user_id)
+		with self._generations_lock:
+			if newer_only and generation <= self.generations.get(user_id, -1):
+				return
+			self.generations[user_id] = generation
+			self.generations.move_to_end(user_id)
+			while len(self.generations) > self.auth.AUTH_SECURITY_GENERATION_CACHE_SIZE:
+				self.generations.popitem(last=False)
+
+	def _sync(self):
+		# Apply the generation bumps published by other workers
+		self._next_sync = monotonic() + self.auth.AUTH_SECURITY_GENERATION_SYNC_INTERVAL
+		for user_id, generation in self.backend.poll():
+			self._remember(user_id, generation, newer_only=True)
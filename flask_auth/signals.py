@@ -44,4 +44,9 @@ auth_logged_out = _signals.signal('auth.auth_logged_out')
 auth_registered = _signals.signal('auth.auth_registered')
 
 # Signal sent just after a password was reset
-auth_reset_password = _signals.signal('auth.auth_reset_password')
\ No newline at end of file
+auth_reset_password = _signals.signal('auth.auth_reset_password')
+
+# Sent after each database operation of a DbAdapter, with the operation name, the model class
+# and the duration in seconds. Only timed when the signal has receivers.
+# SQL reads also report the bind that served them: 'primary' or 'replica:<bind key>'.
+auth_db_operation = _signals.signal('auth.auth_db_operation')
@@ -0,0 +1,2 @@
+# Automated tests for Flask-Auth.
+# Run them with: py.test flask_auth/tests
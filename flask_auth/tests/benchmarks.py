@@ -0,0 +1,80 @@
+"""
+Microbenchmarks of the per-request paths of Flask-Auth.
+
+Run them with: python -m flask_auth.tests.benchmarks
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+from __future__ import print_function
+
+import timeit
+
+from flask import request
+from flask_login import login_user
+
+from .. import login_required, roles_required, translation_utils
+from .tst_app import create_app
+
+def _measure(function, number):
+	# Returns the average duration of ``function()`` in seconds, best of 5 runs
+	return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+def _report(name, function, number, baseline=0):
+	# Print the average duration of ``function()`` minus ``baseline``, in nanoseconds
+	print('%-50s %10.0f ns' % (name, (_measure(function, number) - baseline) * 1e9))
+
+def benchmark_locale_selection(app):
+	# Locale selection of anonymous requests: the installed selector,
+	# against listing the translations directory and matching the header on every request
+	select_locale = app.extensions['babel'].locale_selector_func
+	def select_locale_without_caches():
+		return request.accept_languages.best_match(translation_utils.get_language_codes())
+	with app.test_request_context(headers={'Accept-Language': 'fr-CH, fr;q=0.9, es;q=0.8, de;q=0.7'}):
+		_report('locale selection (directory listing)', select_locale_without_caches, 2000)
+		_report('locale selection', select_locale, 20000)
+
+def benchmark_view_decorators(app):
+	# Overhead of the view decorators for a logged in user, on top of the view call
+	def view():
+		return 'view'
+	protected_views = [('login_required', login_required(view)), ('roles_required', roles_required('Admin')(view))]
+	with app.test_request_context():
+		db_manager = app.auth.db_manager
+		user = db_manager.add_user(username='benchmark', email='benchmark@example.com')
+		db_manager.add_user_role(user, 'Admin')
+		db_manager.commit()
+		login_user(user)
+		view_duration = _measure(view, 100000)
+		for name, protected_view in protected_views:
+			_report('%s overhead' % name, protected_view, 100000, baseline=view_duration)
+
+def benchmark_lookups(app, User):
+	# Duration of the login lookups of the SQLDbAdapter against SQLite in memory (baked queries),
+	# against building and compiling the same query on every call
+	adapter = app.auth.db_manager.db_adapter
+	with app.test_request_context():
+		db_manager = app.auth.db_manager
+		for i in range(1000):
+			db_manager.add_user(username='lookup%d' % i, email='lookup%d@example.com' % i)
+		db_manager.commit()
+		def unbaked_lookup():
+			return User.query.filter(User.username == 'lookup500').first()
+		def lookup():
+			return adapter.find_first_object(User, username='lookup500')
+		def lookup_by_any():
+			# Case sensitive: the 'ifind' mode of the test app compares lower() values, which no index serves
+			return adapter.find_first_object_by_any(User, [('username', 'lookup500'), ('email', 'lookup500')])
+		_report('find_first_object (query built on every call)', unbaked_lookup, 2000)
+		_report('find_first_object', lookup, 2000)
+		_report('find_first_object_by_any', lookup_by_any, 2000)
+
+def main():
+	app, db, User, Role = create_app()
+	benchmark_locale_selection(app)
+	benchmark_view_decorators(app)
+	benchmark_lookups(app, User)
+
+if __name__ == '__main__':
+	main()
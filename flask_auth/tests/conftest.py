@@ -0,0 +1,17 @@
+# pytest fixtures shared by the automated tests.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+
+from .tst_app import create_app
+
+@pytest.fixture
+def app():
+	app, db, User, Role = create_app()
+	return app
+
+@pytest.fixture
+def client(app):
+	return app.test_client()
@@ -0,0 +1,89 @@
+# Tests of the AvailabilityManager: the Bloom filter of the values in use, and the rate limit of the checks.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import threading
+from time import monotonic, sleep
+
+from .. import signals
+from .tst_app import create_app
+
+def _create_app(**config):
+	app, db, User, Role = create_app(AUTH_ENABLE_AVAILABILITY_ENDPOINT=True, **config)
+	with app.app_context():
+		for i in range(10):
+			app.auth.db_manager.add_user(username='user%d' % i, email='user%d@example.com' % i)
+		app.auth.db_manager.commit()
+	return app, User
+
+def test_concurrent_first_checks_build_the_filter_once(monkeypatch):
+	app, User = _create_app()
+	manager = app.auth.availability_manager
+	adapter = app.auth.db_manager.db_adapter
+	scans = []
+	iter_objects_in_batches = adapter.iter_objects_in_batches
+	def slow_iter_objects_in_batches(ObjectClass, batch_size=1000):
+		scans.append(ObjectClass)
+		# Let the other requests reach the build
+		sleep(0.1)
+		return iter_objects_in_batches(ObjectClass, batch_size)
+	monkeypatch.setattr(adapter, 'iter_objects_in_batches', slow_iter_objects_in_batches)
+
+	results = []
+	def check(value):
+		with app.app_context():
+			results.append(manager.is_available('username', value))
+	threads = [threading.Thread(target=check, args=('user%d' % i,)) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert len(scans) == 1
+	assert results == [False] * 4
+
+def test_values_taken_during_a_build_are_kept(monkeypatch):
+	app, User = _create_app()
+	manager = app.auth.availability_manager
+	adapter = app.auth.db_manager.db_adapter
+	iter_objects_in_batches = adapter.iter_objects_in_batches
+	def racing_iter_objects_in_batches(ObjectClass, batch_size=1000):
+		# A user registers after the scan has read the users table
+		batches = list(iter_objects_in_batches(ObjectClass, batch_size))
+		signals.auth_registered.send(app, user=User(username='Newbie', email='newbie@example.com'))
+		return batches
+	monkeypatch.setattr(adapter, 'iter_objects_in_batches', racing_iter_objects_in_batches)
+	manager.build()
+	assert manager._key('username', 'NEWBIE') in manager.filter
+	assert manager._key('email', 'newbie@example.com') in manager.filter
+	assert manager._key('username', 'user3') in manager.filter
+
+def test_rate_limit():
+	app, User = _create_app(AUTH_AVAILABILITY_RATE_LIMIT=50)
+	manager = app.auth.availability_manager
+	retry_afters = []
+	window = int(monotonic() // 60)
+	def check():
+		for i in range(25):
+			retry_afters.append(manager.check_rate_limit('10.0.0.1'))
+	threads = [threading.Thread(target=check) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	# Every check is counted: AUTH_AVAILABILITY_RATE_LIMIT of them are allowed in the window
+	allowed = sum(1 for retry_after in retry_afters if not retry_after)
+	assert allowed == 50 or (allowed > 50 and int(monotonic() // 60) != window)
+	assert manager.check_rate_limit('10.0.0.2') == 0
+
+def test_clients_are_identified_by_their_address():
+	app, User = _create_app(AUTH_AVAILABILITY_RATE_LIMIT=2)
+	client = app.test_client()
+	for i in range(2):
+		assert client.get('/auth/availability?username=zed', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code == 200
+	# A forged header does not make a new client
+	response = client.get('/auth/availability?username=zed',
+		environ_base={'REMOTE_ADDR': '10.0.0.1'}, headers={'X-Real-IP': '10.9.9.9'})
+	assert response.status_code == 429
+	assert client.get('/auth/availability?username=user1', environ_base={'REMOTE_ADDR': '10.0.0.2'}).get_json() == dict(
+		field='username', available=False)
@@ -0,0 +1,91 @@
+# Tests of the canonical username and email fields (AUTH_ENABLE_CANONICAL_FIELDS).
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+
+from .tst_app import create_app, login, register
+
+# Variants of existing values that only the canonical form matches:
+# casefold() maps 'ß' to 'ss', NFKC maps the ligature 'ﬁ' to 'fi'
+EXISTING = dict(username='Straße', email='ﬁona@example.com')
+VARIANTS = dict(username='STRASSE', email='FIONA@example.com')
+
+@pytest.fixture
+def canonical_app():
+	app, db, User, Role = create_app(AUTH_ENABLE_CANONICAL_FIELDS=True)
+	with app.app_context():
+		app.auth.db_manager.add_user(**EXISTING)
+		app.auth.db_manager.commit()
+	return app, User
+
+def _in_use(response, field_name):
+	message = 'This %s is already in use.' % dict(username='Username', email='Email')[field_name]
+	return message in response.get_data(as_text=True)
+
+@pytest.mark.parametrize('field_name', ['username', 'email'])
+def test_register_rejects_variants(canonical_app, field_name):
+	app, User = canonical_app
+	values = dict(username='bob', email='bob@example.com')
+	values[field_name] = VARIANTS[field_name]
+	response = register(app.test_client(), **values)
+	assert response.status_code == 200 and _in_use(response, field_name)
+	with app.app_context():
+		assert User.query.count() == 1
+
+def test_change_username_rejects_variants(canonical_app):
+	app, User = canonical_app
+	client = app.test_client()
+	register(client)
+	response = client.post('/auth/change_username/', data=dict(new_username=VARIANTS['username'], password='Password1'))
+	assert response.status_code == 200 and _in_use(response, 'username')
+	with app.app_context():
+		assert app.auth.db_manager.find_user_by_username('ALICE').username == 'alice'
+
+def test_change_email_rejects_variants(canonical_app):
+	app, User = canonical_app
+	client = app.test_client()
+	register(client)
+	response = client.post('/auth/change_email/', data=dict(email=VARIANTS['email']))
+	assert response.status_code == 200 and _in_use(response, 'email')
+	with app.app_context():
+		assert app.auth.db_manager.find_user_by_email('Alice@Example.com').email == 'alice@example.com'
+
+def test_lookups_match_variants(canonical_app):
+	app, User = canonical_app
+	with app.app_context():
+		db_manager = app.auth.db_manager
+		user = db_manager.find_user_by_username(VARIANTS['username'])
+		assert user is not None and user.username_canonical == 'strasse'
+		assert db_manager.find_user_by_email(VARIANTS['email']) is user
+		assert not app.auth.username_is_available(' strasse ')
+		assert not app.auth.email_is_available(VARIANTS['email'])
+	# A user registered through the views logs in with any variant of its username
+	client = app.test_client()
+	register(client)
+	client.get('/auth/logout/')
+	assert login(client, username='ALICE').status_code == 302
+	assert client.get('/members').status_code == 200
+
+def test_backfill_command(tmp_path):
+	# A file database, shared by an app without and an app with canonical fields
+	uri = 'sqlite:///%s' % tmp_path.joinpath('test.db')
+	app, db, User, Role = create_app(SQLALCHEMY_DATABASE_URI=uri)
+	with app.app_context():
+		app.auth.db_manager.add_user(**EXISTING)
+		app.auth.db_manager.add_user(username='bob', email='bob@example.com')
+		app.auth.db_manager.commit()
+		assert [user.username_canonical for user in User.query.all()] == [None, None]
+
+	app, db, User, Role = create_app(SQLALCHEMY_DATABASE_URI=uri, AUTH_ENABLE_CANONICAL_FIELDS=True)
+	result = app.test_cli_runner().invoke(args=['auth', 'backfill-canonical-fields', '--batch-size', '1'])
+	assert result.exit_code == 0 and 'Updated the canonical fields of 2 users.' in result.output
+	with app.app_context():
+		users = User.query.order_by(User.id).all()
+		assert [(user.username_canonical, user.email_canonical) for user in users] == [
+			('strasse', 'fiona@example.com'), ('bob', 'bob@example.com')]
+		assert app.auth.db_manager.find_user_by_email(VARIANTS['email']).id == users[0].id
+	# Up-to-date rows are not written again
+	result = app.test_cli_runner().invoke(args=['auth', 'backfill-canonical-fields'])
+	assert 'Updated the canonical fields of 0 users.' in result.output
@@ -0,0 +1,81 @@
+# Tests of the view decorators and of their access policies (see decorators.py).
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+from .. import allow_unconfirmed_account, login_required, roles_accepted, roles_required
+from ..decorators import AccessPolicy
+from .tst_app import create_app, login, register
+
+def test_login_required(client):
+	assert client.get('/members').status_code == 401
+	register(client)
+	assert client.get('/members').status_code == 200
+	client.get('/auth/logout/')
+	assert client.get('/members').status_code == 401
+	login(client)
+	assert client.get('/members').status_code == 200
+
+def test_roles_required(app, client):
+	register(client)
+	assert client.get('/admin').status_code == 403
+	with app.test_request_context():
+		db_manager = app.auth.db_manager
+		db_manager.add_user_role(db_manager.find_user_by_username('alice'), 'Admin')
+		db_manager.commit()
+	assert client.get('/admin').status_code == 200
+
+def test_confirmed_account_policy():
+	app, db, User, Role = create_app(AUTH_ENABLE_CONFIRM_ACCOUNT=True, AUTH_ALLOW_LOGIN_WITHOUT_CONFIRMED_ACCOUNT=True)
+
+	@app.route('/promotion')
+	@allow_unconfirmed_account
+	def promotion_page():
+		return 'promotion'
+
+	client = app.test_client()
+	with app.test_request_context():
+		password = app.auth.password_manager.hash_password('Password1')
+		app.auth.db_manager.add_user(username='alice', email='alice@example.com', password=password)
+		app.auth.db_manager.commit()
+	login(client)
+	# Unconfirmed accounts are only allowed on @allow_unconfirmed_account views
+	assert client.get('/promotion').status_code == 200
+	assert client.get('/members').status_code == 401
+
+def test_stacked_decorators_are_merged():
+	def view():
+		return 'view'
+	protected_view = allow_unconfirmed_account(roles_accepted('Writer', 'Editor')(roles_required('Agent')(view)))
+	# A single wrapper around the view, with the merged policy
+	assert protected_view.__wrapped__ is view
+	assert not protected_view.auth_policy.require_confirmed_account
+	assert protected_view.auth_policy.role_requirements == (('Writer', 'Editor'), 'Agent')
+
+def test_list_protected_endpoints(app):
+	policies = dict(app.auth.list_protected_endpoints())
+	# The Flask-Auth views that need a logged in user are protected too
+	assert {'admin_page', 'member_page', 'auth.change_password'} <= set(policies)
+	assert policies['member_page'].role_requirements == ()
+	assert policies['admin_page'].role_requirements == ('Admin',)
+	assert policies['admin_page'].require_confirmed_account
+
+def test_compiled_check(app):
+	with app.app_context():
+		check = AccessPolicy(role_requirements=('Admin',)).compile(app.auth)
+
+	class User(object):
+		is_authenticated = True
+		verified = False
+		def __init__(self, roles):
+			self.roles = roles
+		def has_roles(self, *requirements):
+			return all(role in self.roles for role in requirements)
+
+	class AnonymousUser(object):
+		is_authenticated = False
+
+	assert check(AnonymousUser()) == 'unauthenticated'
+	assert check(User([])) == 'unauthorized'
+	# AUTH_ENABLE_CONFIRM_ACCOUNT is False in the test app: unverified users are allowed
+	assert check(User(['Admin'])) is None
@@ -0,0 +1,160 @@
+# Tests of the DynamoDbAdapter (Flywheel), against moto's in-process DynamoDB.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import types
+
+import pytest
+
+pytest.importorskip('flywheel')
+moto = pytest.importorskip('moto')
+
+from flask import Flask
+from .. import Auth, AuthUserMixin
+from ..user_snapshot import UserSnapshot
+from .tst_app import ConfigClass
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+	for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+		monkeypatch.setenv(name, 'testing')
+	with moto.mock_dynamodb():
+		yield
+
+def _create_app(**config):
+	from flywheel import Engine, Field, GlobalIndex, Model
+
+	class User(Model, AuthUserMixin):
+		__metadata__ = {
+			'_name': 'users',
+			'global_indexes': [GlobalIndex.all('username-index', 'username_lower')],
+		}
+		id = Field(hash_key=True)
+		username = Field()
+		username_lower = Field()
+		email = Field()
+		password = Field(default='')
+		language = Field(default='en')
+		verified = Field(data_type=bool, default=True)
+		disabled = Field(data_type=bool, default=False)
+		security_generation = Field(data_type=int, default=0)
+		roles = Field(data_type=list)
+
+	engine = Engine()
+	engine.connect('us-east-1')
+	engine.register(User)
+
+	app = Flask(__name__)
+	app.config.from_object(ConfigClass)
+	app.config.update(config)
+	# Flask-Flywheel is not needed: the adapter only uses the engine of ``db``
+	auth = Auth(app, types.SimpleNamespace(engine=engine), User)
+	auth.db_manager.create_all_tables()
+	return app, User
+
+def _add_users(app, count):
+	db_manager = app.auth.db_manager
+	for i in range(count):
+		db_manager.add_user(id=str(i), username='User%d' % i, email='user%d@example.com' % i)
+	db_manager.commit()
+
+def test_cached_snapshots_are_saved_and_deleted(dynamodb):
+	app, User = _create_app(AUTH_DB_ADAPTER='flywheel', AUTH_IFIND_MODE='ifind',
+		AUTH_ENABLE_USER_SNAPSHOTS=True, AUTH_USER_SNAPSHOT_CACHE_SIZE=10)
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		_add_users(app, 2)
+		# The first load caches the user, the second one is a cache hit: a UserSnapshot
+		assert not isinstance(db_manager.get_user_by_id('0'), UserSnapshot)
+		user = db_manager.get_user_by_id('0')
+		assert isinstance(user, UserSnapshot)
+
+		user.username = 'Renamed'
+		db_manager.save_user(user)
+		db_manager.commit()
+		renamed = db_manager.db_adapter.find_first_object(User, username_lower='renamed')
+		assert renamed is not None and renamed.id == '0'
+
+		db_manager.get_user_by_id('1')
+		user = db_manager.get_user_by_id('1')
+		assert isinstance(user, UserSnapshot)
+		db_manager.delete_object(user)
+		db_manager.commit()
+		assert db_manager.get_user_by_id('1') is None
+		assert db_manager.get_user_by_id('0').username == 'Renamed'
+
+def _spy_on_calls(app, monkeypatch):
+	# Record the DynamoDB API calls of the engine
+	calls = []
+	connection = app.auth.db_manager.db_adapter.db.engine.dynamo
+	call = connection.call
+	def spy(command, **kwargs):
+		calls.append(command)
+		return call(command, **kwargs)
+	monkeypatch.setattr(connection, 'call', spy)
+	return calls
+
+def test_get_objects_is_a_single_batch_get(dynamodb, monkeypatch):
+	app, User = _create_app(AUTH_DB_ADAPTER='flywheel')
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		_add_users(app, 5)
+		calls = _spy_on_calls(app, monkeypatch)
+		users = db_manager.get_users_by_ids(['0', '2', '4', 'missing'])
+		assert calls == ['batch_get_item']
+		assert sorted(user.username for user in users) == ['User0', 'User2', 'User4']
+
+def test_ifind_queries_the_lowercase_index(dynamodb, monkeypatch):
+	app, User = _create_app(AUTH_DB_ADAPTER='flywheel', AUTH_IFIND_MODE='ifind')
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		_add_users(app, 3)
+		# The adapter maintains the lowercase field on save
+		assert db_manager.get_user_by_id('1').username_lower == 'user1'
+		calls = _spy_on_calls(app, monkeypatch)
+		assert db_manager.find_user_by_username('USER1').id == '1'
+		assert calls == ['query']
+		assert db_manager.find_user_by_username('nobody') is None
+
+def test_ifind_scans_without_a_lowercase_field(dynamodb, monkeypatch):
+	app, User = _create_app(AUTH_DB_ADAPTER='flywheel', AUTH_IFIND_MODE='ifind')
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		_add_users(app, 3)
+		calls = _spy_on_calls(app, monkeypatch)
+		# No 'email_lower' field: a Scan, compared in Python
+		assert db_manager.find_user_by_email('USER2@Example.com').id == '2'
+		assert set(calls) == {'scan'}
+		assert db_manager.find_user_by_email('nobody@example.com') is None
+
+def test_delete_object(dynamodb):
+	app, User = _create_app(AUTH_DB_ADAPTER='flywheel')
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		_add_users(app, 2)
+		db_manager.delete_object(db_manager.get_user_by_id('0'))
+		db_manager.commit()
+		assert db_manager.get_user_by_id('0') is None
+		assert [user.id for user in db_manager.get_users_by_ids(['0', '1'])] == ['1']
+
+def test_operations_send_the_db_operation_signal(dynamodb):
+	from ..signals import auth_db_operation
+
+	app, User = _create_app(AUTH_DB_ADAPTER='flywheel', AUTH_IFIND_MODE='ifind')
+	db_manager = app.auth.db_manager
+	operations = []
+	def receiver(sender, **kwargs):
+		operations.append(dict(kwargs, sender=sender))
+	with app.app_context():
+		_add_users(app, 1)
+		with auth_db_operation.connected_to(receiver, app):
+			user = db_manager.get_user_by_id('0')
+			db_manager.find_user_by_username('user0')
+			db_manager.delete_object(user)
+	assert [operation['operation'] for operation in operations] == ['get_object', 'ifind_first_object', 'delete_object']
+	for operation in operations:
+		assert operation['sender'] is app
+		assert operation['adapter'] is db_manager.db_adapter
+		assert operation['model'] is User
+		assert operation['duration'] >= 0
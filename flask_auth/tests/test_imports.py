@@ -0,0 +1,66 @@
+# Tests of the import cost of Flask-Auth: the package and the DbAdapters are imported lazily.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from .. import ConfigError
+from ..db_adapters import get_db_adapter_class
+
+# The directory that contains the flask_auth package
+_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Top-level packages of the supported ORMs
+_orm_packages = ('sqlalchemy', 'flask_sqlalchemy', 'mongoengine', 'flask_mongoengine', 'pynamodb', 'flywheel', 'flask_flywheel')
+
+def _run(code, *options):
+	# Run ``code`` in a fresh interpreter, returns its (stdout, stderr)
+	process = subprocess.run(
+		[sys.executable] + list(options) + ['-c', code],
+		cwd=_root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+	return process.stdout, process.stderr
+
+def _imported_orm_packages(code):
+	stdout, stderr = _run(code + '\nimport sys\nprint(" ".join(sorted(set(name.split(".")[0] for name in sys.modules))))')
+	return set(stdout.split()).intersection(_orm_packages)
+
+def test_package_import_time():
+	# 'python -X importtime' reports the cumulative import time of each module, in microseconds
+	stdout, stderr = _run('import flask_auth', '-X', 'importtime')
+	cumulative_times = {}
+	for line in stderr.splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		self_time, cumulative_time, module_name = line[len('import time:'):].split('|')
+		cumulative_times[module_name.strip()] = int(cumulative_time)
+	print('import flask_auth: %d us' % cumulative_times['flask_auth'])
+	# Neither Flask nor any ORM is imported by the package itself
+	assert not set(name.split('.')[0] for name in cumulative_times).intersection(_orm_packages + ('flask',))
+
+def test_unrelated_orms_are_not_imported():
+	code = 'from flask_auth.tests.tst_app import create_app\ncreate_app()'
+	assert _imported_orm_packages(code) == {'sqlalchemy', 'flask_sqlalchemy'}
+
+def test_adapter_registry(app):
+	from flask_sqlalchemy import SQLAlchemy
+	from ..db_adapters import SQLDbAdapter, ShardedDbAdapter
+
+	db = app.auth.db_manager.db
+	User = app.auth.db_manager.UserClass
+	assert type(app.auth.db_manager.db_adapter) is SQLDbAdapter
+	# Detected from the ``db`` type, or named by AUTH_DB_ADAPTER
+	assert get_db_adapter_class('', db, User) is SQLDbAdapter
+	assert get_db_adapter_class('sharded', db, User) is ShardedDbAdapter
+	assert get_db_adapter_class(SQLDbAdapter.__module__ + ':SQLDbAdapter', db, User) is SQLDbAdapter
+	assert get_db_adapter_class('unknown', db, User) is None
+	assert get_db_adapter_class('', object(), object) is None
+
+def test_unknown_adapter_name():
+	from .tst_app import create_app
+	with pytest.raises(ConfigError):
+		create_app(AUTH_DB_ADAPTER='unknown')
@@ -0,0 +1,77 @@
+# Tests of the user lookups of the login and forgot_password views:
+# a single query by username or email address, and the email-only configurations.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+from sqlalchemy import event
+
+from .tst_app import create_app, login
+
+def _create_app(**config):
+	app, db, User, Role = create_app(**config)
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		db_manager.add_user(username='alice', email='alice@example.com',
+			password=app.auth.password_manager.hash_password('Password1'))
+		# A username that is also the email address of another user
+		db_manager.add_user(username='alice@example.com', email='other@example.com',
+			password=app.auth.password_manager.hash_password('Password2'))
+		db_manager.commit()
+	# The lookups run on the users table (not the reloads by id of the ORM, after a commit)
+	queries = []
+	def record(connection, cursor, statement, *args):
+		if 'FROM users' in statement and 'WHERE users.id = ?' not in statement:
+			queries.append(statement)
+	with app.app_context():
+		event.listen(db.engine, 'before_cursor_execute', record)
+	return app, queries
+
+def test_username_match_wins_in_a_single_query():
+	app, queries = _create_app()
+	with app.app_context():
+		db_manager = app.auth.db_manager
+		assert db_manager.find_user_by_username_or_email('ALICE@example.com').email == 'other@example.com'
+		assert len(queries) == 1
+		assert db_manager.find_user_by_username_or_email('Alice').email == 'alice@example.com'
+		assert db_manager.find_user_by_username_or_email('other@example.com').username == 'alice@example.com'
+		assert db_manager.find_user_by_username_or_email('nobody') is None
+		assert len(queries) == 4
+
+@pytest.mark.parametrize('name, password, status_code', [
+	('alice', 'Password1', 302), ('other@example.com', 'Password2', 302), ('alice', 'Wrong', 200)])
+def test_login_runs_a_single_query(name, password, status_code):
+	app, queries = _create_app()
+	client = app.test_client()
+	del queries[:]
+	assert login(client, username=name, password=password).status_code == status_code
+	assert len(queries) == 1
+
+@pytest.mark.parametrize('config', [dict(AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME=False), dict(AUTH_ENABLE_USERNAME=False)])
+def test_forgot_password_by_email_only(monkeypatch, config):
+	app, queries = _create_app(**config)
+	assert not app.auth.AUTH_ENABLE_FORGOT_PASSWORD_BY_USERNAME
+	emails = []
+	monkeypatch.setattr(app.auth.email_manager, 'send_reset_password_email', lambda user: emails.append(user.email))
+	client = app.test_client()
+	response = client.post('/auth/forgot_password/', data=dict(email='Alice@Example.com'))
+	assert response.status_code == 200
+	assert emails == ['alice@example.com']
+	response = client.post('/auth/forgot_password/', data=dict(email='nobody@example.com'))
+	assert response.status_code == 200 and 'This Email does not exist.' in response.get_data(as_text=True)
+	assert emails == ['alice@example.com']
+
+def test_forgot_password_requires_a_matching_username_and_email(monkeypatch):
+	app, queries = _create_app()
+	emails = []
+	monkeypatch.setattr(app.auth.email_manager, 'send_reset_password_email', lambda user: emails.append(user.email))
+	client = app.test_client()
+	# Both fields match users, but not the same one
+	client.post('/auth/forgot_password/', data=dict(username='alice@example.com', email='alice@example.com'))
+	assert emails == []
+	del queries[:]
+	client.post('/auth/forgot_password/', data=dict(username='alice', email='alice@example.com'))
+	assert emails == ['alice@example.com']
+	# A single lookup, after the used_username_validator and used_email_validator lookups of the form
+	assert len(queries) == 3
@@ -0,0 +1,111 @@
+# Tests of the case insensitive lookups of the MongoDbAdapter, against a MongoDB server.
+# The server is MONGODB_URI (default: mongodb://localhost:27017): the tests are skipped if it is not reachable.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import os
+import uuid
+
+import pytest
+
+pymongo = pytest.importorskip('pymongo')
+mongoengine = pytest.importorskip('mongoengine')
+pytest.importorskip('flask_mongoengine')
+
+from flask import Flask
+from pymongo import monitoring
+from .. import Auth, AuthUserMixin
+from .tst_app import ConfigClass
+
+MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017')
+
+class _FindCommandListener(monitoring.CommandListener):
+	# Records the 'find' commands sent to the server
+
+	def __init__(self):
+		self.commands = []
+
+	def started(self, event):
+		if event.command_name == 'find':
+			self.commands.append(event.command)
+
+	def succeeded(self, event):
+		pass
+
+	def failed(self, event):
+		pass
+
+@pytest.fixture
+def mongo_database():
+	client = pymongo.MongoClient(MONGODB_URI, serverSelectionTimeoutMS=500)
+	try:
+		client.admin.command('ping')
+	except pymongo.errors.PyMongoError:
+		pytest.skip('No MongoDB server at %s' % MONGODB_URI)
+	database_name = 'flask_auth_test_%s' % uuid.uuid4().hex
+	yield database_name
+	# MongoEngine keeps its connections: the next test connects to its own database
+	mongoengine.disconnect_all()
+	client.drop_database(database_name)
+	client.close()
+
+def _create_app(database_name, listener, **config):
+	from flask_mongoengine import MongoEngine
+
+	app = Flask(__name__)
+	app.config.from_object(ConfigClass)
+	app.config.update(config)
+	app.config['MONGODB_SETTINGS'] = {'host': MONGODB_URI, 'db': database_name, 'event_listeners': [listener]}
+	db = MongoEngine(app)
+
+	class User(db.Document, AuthUserMixin):
+		meta = {'collection': 'users'}
+		username = mongoengine.StringField()
+		email = mongoengine.StringField()
+		password = mongoengine.StringField(default='')
+		disabled = mongoengine.BooleanField(default=False)
+		verified = mongoengine.BooleanField(default=True)
+		language = mongoengine.StringField(default='en')
+		roles = mongoengine.ListField(mongoengine.StringField(), default=list)
+
+	auth = Auth(app, db, User)
+	auth.db_manager.create_all_tables()
+	return app, User
+
+def _plan_stages(plan):
+	# Returns the stages of a query plan and of all its input stages
+	stages = [plan['stage']] if 'stage' in plan else []
+	for key in ('inputStage', 'queryPlan'):
+		if key in plan:
+			stages += _plan_stages(plan[key])
+	for input_stage in plan.get('inputStages', ()):
+		stages += _plan_stages(input_stage)
+	return stages
+
+def _explain(database, command):
+	# Returns the stages of the winning plan of a recorded 'find' command
+	command = {key: value for key, value in command.items() if key not in ('$db', 'lsid', '$clusterTime', '$readPreference')}
+	explanation = database.command({'explain': command, 'verbosity': 'queryPlanner'})
+	return _plan_stages(explanation['queryPlanner']['winningPlan'])
+
+@pytest.mark.parametrize('snapshots', [False, True])
+def test_login_lookups_are_index_scans(mongo_database, snapshots):
+	listener = _FindCommandListener()
+	app, User = _create_app(mongo_database, listener, AUTH_IFIND_MODE='nocase_collation', AUTH_ENABLE_USER_SNAPSHOTS=snapshots)
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		for i in range(100):
+			db_manager.add_user(username='User%d' % i, email='Mail%d@Example.com' % i)
+		db_manager.commit()
+		del listener.commands[:]
+		assert db_manager.find_user_by_username('USER42').username == 'User42'
+		assert db_manager.find_user_by_email('mail7@example.COM').username == 'User7'
+		assert db_manager.find_user_by_username_or_email('mail9@example.com').username == 'User9'
+		assert db_manager.find_user_by_username('nobody') is None
+
+		database = User._get_db()
+		assert len(listener.commands) == 4
+		for command in listener.commands:
+			stages = _explain(database, command)
+			assert 'IXSCAN' in stages and 'COLLSCAN' not in stages, (command, stages)
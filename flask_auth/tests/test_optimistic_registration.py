@@ -0,0 +1,96 @@
+# Tests of the optimistic registration (AUTH_ENABLE_OPTIMISTIC_REGISTRATION):
+# duplicates are rejected by the unique indexes, not by availability lookups.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+from flask import Flask
+
+from .. import Auth, AuthUserMixin
+from .tst_app import ConfigClass, create_app, register
+
+def _spy_on(app, monkeypatch):
+	# Record the availability lookups and the rollbacks of the DbAdapter
+	calls = []
+	for name in ('username_is_available', 'email_is_available'):
+		def spy(value, name=name, method=getattr(app.auth, name)):
+			calls.append(name)
+			return method(value)
+		monkeypatch.setattr(app.auth, name, spy)
+	adapter = app.auth.db_manager.db_adapter
+	rollback = adapter.rollback
+	def spy_rollback():
+		calls.append('rollback')
+		rollback()
+	monkeypatch.setattr(adapter, 'rollback', spy_rollback)
+	return calls
+
+@pytest.mark.parametrize('field_name', ['username', 'email'])
+def test_duplicates_become_form_errors(monkeypatch, field_name):
+	app, db, User, Role = create_app(AUTH_ENABLE_OPTIMISTIC_REGISTRATION=True)
+	assert register(app.test_client()).status_code == 302
+	calls = _spy_on(app, monkeypatch)
+
+	# The test app's unique indexes are case insensitive (NOCASE collation)
+	duplicate = dict(username='bob', email='bob@example.com')
+	duplicate[field_name] = dict(username='ALICE', email='Alice@Example.com')[field_name]
+	response = register(app.test_client(), **duplicate)
+	assert response.status_code == 200
+	message = 'This %s is already in use.' % dict(username='Username', email='Email')[field_name]
+	assert message in response.get_data(as_text=True)
+	# No availability lookup before the INSERT, and the failed INSERT was rolled back
+	assert calls == ['rollback']
+
+	with app.app_context():
+		assert [user.username for user in User.query.all()] == ['alice']
+	assert register(app.test_client(), username='bob', email='bob@example.com').status_code == 302
+
+def test_availability_lookups_without_optimistic_registration(monkeypatch):
+	app, db, User, Role = create_app()
+	calls = _spy_on(app, monkeypatch)
+	assert register(app.test_client()).status_code == 302
+	assert calls == ['username_is_available', 'email_is_available']
+
+def test_mongo_duplicates_become_form_errors(monkeypatch):
+	mongomock = pytest.importorskip('mongomock')
+	mongoengine = pytest.importorskip('mongoengine')
+	from flask_mongoengine import MongoEngine
+
+	app = Flask(__name__)
+	app.config.from_object(ConfigClass)
+	app.config.update(AUTH_ENABLE_OPTIMISTIC_REGISTRATION=True, AUTH_IFIND_MODE='ifind', AUTH_AUTO_LOGIN_AFTER_REGISTER=False)
+	app.config['MONGODB_SETTINGS'] = {'host': 'mongodb://localhost', 'db': 'flask_auth_test', 'mongo_client_class': mongomock.MongoClient}
+	db = MongoEngine(app)
+
+	# mongomock has no collations: plain unique indexes, declared on the model
+	class User(db.Document, AuthUserMixin):
+		meta = {'collection': 'users'}
+		username = mongoengine.StringField(unique=True, sparse=True)
+		email = mongoengine.StringField(unique=True, sparse=True)
+		password = mongoengine.StringField(default='')
+		first_name = mongoengine.StringField(default='')
+		last_name = mongoengine.StringField(default='')
+		disabled = mongoengine.BooleanField(default=False)
+		verified = mongoengine.BooleanField(default=True)
+		language = mongoengine.StringField(default='en')
+		last_seen_date = mongoengine.DateTimeField()
+		roles = mongoengine.ListField(mongoengine.StringField(), default=list)
+
+	Auth(app, db, User)
+
+	@app.route('/')
+	def home_page():
+		return 'home'
+
+	try:
+		assert register(app.test_client()).status_code == 302
+		calls = _spy_on(app, monkeypatch)
+		response = register(app.test_client(), username='bob', email='alice@example.com')
+		assert response.status_code == 200
+		assert 'This Email is already in use.' in response.get_data(as_text=True)
+		assert calls == ['rollback']
+		# The new user was deleted
+		assert [user.username for user in User.objects] == ['alice']
+	finally:
+		mongoengine.disconnect_all()
@@ -0,0 +1,153 @@
+# Tests of the index-backed lookups of the PynamoDbAdapter, against moto's in-process DynamoDB.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+
+pytest.importorskip('pynamodb')
+moto = pytest.importorskip('moto')
+
+from flask import Flask
+from .. import Auth, AuthUserMixin
+from .tst_app import ConfigClass
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+	for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+		monkeypatch.setenv(name, 'testing')
+	with moto.mock_dynamodb():
+		yield
+
+@pytest.fixture
+def api_calls(monkeypatch):
+	# The DynamoDB operations sent by PynamoDB: (operation name, request parameters)
+	from pynamodb.connection.base import Connection
+
+	calls = []
+	make_api_call = Connection._make_api_call
+	def spy(self, operation_name, operation_kwargs, *args, **kwargs):
+		calls.append((operation_name, operation_kwargs))
+		return make_api_call(self, operation_name, operation_kwargs, *args, **kwargs)
+	monkeypatch.setattr(Connection, '_make_api_call', spy)
+	return calls
+
+def _create_app(**config):
+	from pynamodb.attributes import BooleanAttribute, UnicodeAttribute
+	from pynamodb.indexes import AllProjection, GlobalSecondaryIndex, KeysOnlyProjection
+	from pynamodb.models import Model
+
+	class UsernameIndex(GlobalSecondaryIndex):
+		class Meta:
+			index_name = 'username-index'
+			projection = AllProjection()
+			read_capacity_units = 1
+			write_capacity_units = 1
+		username_lower = UnicodeAttribute(hash_key=True)
+
+	class EmailIndex(GlobalSecondaryIndex):
+		class Meta:
+			index_name = 'email-index'
+			projection = KeysOnlyProjection()
+			read_capacity_units = 1
+			write_capacity_units = 1
+		email_lower = UnicodeAttribute(hash_key=True)
+
+	class User(Model, AuthUserMixin):
+		class Meta:
+			table_name = 'users'
+			region = 'us-east-1'
+		id = UnicodeAttribute(hash_key=True)
+		username = UnicodeAttribute(null=True)
+		username_lower = UnicodeAttribute(null=True)
+		email = UnicodeAttribute(null=True)
+		email_lower = UnicodeAttribute(null=True)
+		password = UnicodeAttribute(null=True)
+		language = UnicodeAttribute(null=True)
+		active = BooleanAttribute(default=True)
+		username_index = UsernameIndex()
+		email_index = EmailIndex()
+
+	app = Flask(__name__)
+	app.config.from_object(ConfigClass)
+	app.config.update(config)
+	auth = Auth(app, None, User)
+	auth.db_manager.create_all_tables()
+	return app, User
+
+def _add_users(app, User, count):
+	adapter = app.auth.db_manager.db_adapter
+	for i in range(count):
+		adapter.add_object(User(id=str(i), username='User%d' % i, email='Mail%d@Example.com' % i, password='hash%d' % i))
+
+def test_lookups_use_the_indexes(dynamodb, api_calls):
+	app, User = _create_app(AUTH_PYNAMO_CONSISTENT_READ=True)
+	_add_users(app, User, 20)
+	adapter = app.auth.db_manager.db_adapter
+	with app.app_context():
+		del api_calls[:]
+		# Index projecting all attributes: a single Query
+		assert adapter.ifind_first_object(User, username='user12').id == '12'
+		assert [(name, params.get('IndexName')) for name, params in api_calls] == [('Query', 'username-index')]
+		del api_calls[:]
+		# Keys-only index: a Query, then a consistent GetItem of the object
+		assert adapter.ifind_first_object(User, email='MAIL7@example.com').id == '7'
+		assert [(name, params.get('IndexName'), params.get('ConsistentRead')) for name, params in api_calls] == [
+			('Query', 'email-index', None), ('GetItem', None, True)]
+		del api_calls[:]
+		# Case sensitive lookups are narrowed down by the shadow attribute index
+		assert adapter.find_first_object(User, username='User3').id == '3'
+		assert adapter.find_first_object(User, username='user3') is None
+		assert 'Scan' not in [name for name, params in api_calls]
+
+def test_snapshots_are_projected(dynamodb, api_calls):
+	app, User = _create_app(AUTH_ENABLE_USER_SNAPSHOTS=True)
+	_add_users(app, User, 5)
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		del api_calls[:]
+		user = db_manager.get_user_by_id('2')
+		assert [name for name, params in api_calls] == ['GetItem']
+		projected_names = set(api_calls[0][1]['ExpressionAttributeNames'].values())
+		assert 'password' in projected_names and 'email' not in projected_names
+		assert user.password == 'hash2'
+		assert not user.is_loaded()
+		# Any other attribute loads the full object
+		assert user.email == 'Mail2@Example.com'
+		assert user.is_loaded()
+		del api_calls[:]
+		user = db_manager.db_adapter.ifind_first_object_snapshot(User, db_manager.snapshot_fields, username='USER4')
+		assert [name for name, params in api_calls] == ['Query']
+		assert 'email' not in api_calls[0][1]['ExpressionAttributeNames'].values()
+		assert (user.id, user.password, user.is_loaded()) == ('4', 'hash4', False)
+
+def test_backfill_lower_fields(dynamodb):
+	# moto ignores the Segment of Scan requests: every segment would return all the users
+	app, User = _create_app(AUTH_PYNAMO_SCAN_SEGMENTS=1)
+	# Users saved before the shadow attributes existed
+	for i in range(3):
+		User(id=str(i), username='User%d' % i, email='Mail%d@Example.com' % i).save()
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		assert db_manager.db_adapter.ifind_first_object(User, username='user1') is None
+		assert db_manager.backfill_lower_fields(batch_size=2) == 3
+		assert db_manager.backfill_lower_fields() == 0
+		assert db_manager.db_adapter.ifind_first_object(User, username='user1').id == '1'
+		assert db_manager.db_adapter.ifind_first_object(User, email='mail2@example.com').id == '2'
+
+def test_uniqueness_guards(dynamodb):
+	from .. import UniqueConstraintError
+
+	app, User = _create_app(AUTH_UNIQUENESS_GUARD_TABLE='auth-guards')
+	adapter = app.auth.db_manager.db_adapter
+	with app.app_context():
+		adapter.add_object(User(id='1', username='Straße', email='alice@example.com'))
+		# The guard keys are canonical: case, Unicode normalization and surrounding spaces do not matter
+		assert not adapter.is_available(User, 'username', ' STRASSE')
+		assert adapter.is_available(User, 'username', 'Strasse2')
+		with pytest.raises(UniqueConstraintError):
+			adapter.add_object(User(id='2', username='strasse', email='bob@example.com'))
+		user = adapter.get_object(User, '1')
+		user.username = 'Alice'
+		adapter.save_object(user)
+		assert adapter.is_available(User, 'username', 'strasse')
@@ -0,0 +1,151 @@
+# Tests of the role management of the DBManager: role cache, roles bitmask and role hierarchy (SQL).
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+
+from .. import ConfigError
+from .tst_app import create_app, register
+
+def _create_app(tmp_path, **config):
+	# A file database, so that a second connection can play a concurrent request
+	return create_app(SQLALCHEMY_DATABASE_URI='sqlite:///%s' % tmp_path.joinpath('test.db'), **config)
+
+def test_roles_bitmask(tmp_path):
+	app, db, User, Role = _create_app(tmp_path, AUTH_ENABLE_ROLES_BITMASK=True)
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		user = db_manager.add_user(username='alice', email='alice@example.com')
+		db_manager.add_user_role(user, 'Admin')
+		db_manager.add_user_role(user, 'Agent')
+		db_manager.commit()
+		admin_bit = 1 << Role.query.filter_by(name='Admin').one().id
+		agent_bit = 1 << Role.query.filter_by(name='Agent').one().id
+		assert user.roles_mask == admin_bit | agent_bit
+		assert user.has_roles('Admin', ('Agent', 'Writer'))
+		assert not user.has_roles('Writer')
+		db_manager.remove_user_role(user, 'Admin')
+		assert user.roles_mask == agent_bit
+
+def test_role_added_concurrently(tmp_path):
+	app, db, User, Role = _create_app(tmp_path)
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		# Load the (empty) role cache
+		user = db_manager.add_user(username='alice', email='alice@example.com')
+		db_manager.commit()
+		db_manager.add_user_role(user, 'Writer')
+		db_manager.commit()
+		# Another request adds the role after the role cache was loaded
+		with db.engine.begin() as connection:
+			connection.execute(Role.__table__.insert(), dict(name='Admin'))
+		user = db_manager.add_user(username='bob', email='bob@example.com')
+		db_manager.add_user_role(user, 'Admin')
+		db_manager.commit()
+		# No duplicate role, and the pending user was not rolled back
+		assert [role.name for role in Role.query.order_by(Role.id)] == ['Writer', 'Admin']
+		assert [role.name for role in User.query.filter_by(username='bob').one().roles] == ['Admin']
+
+def test_role_inserted_by_a_racing_transaction(tmp_path):
+	app, db, User, Role = _create_app(tmp_path)
+	with app.test_request_context():
+		adapter = app.auth.db_manager.db_adapter
+		# The role does not exist yet when looked up, but is inserted by another transaction before the INSERT
+		find_first_object = adapter.find_first_object
+		def racing_find_first_object(ObjectClass, **kwargs):
+			object = find_first_object(ObjectClass, **kwargs)
+			if object is None and not hasattr(adapter, '_raced'):
+				adapter._raced = True
+				with db.engine.begin() as connection:
+					connection.execute(Role.__table__.insert(), dict(name='Admin'))
+			return object
+		adapter.find_first_object = racing_find_first_object
+		role = adapter.get_or_add_object(Role, name='Admin')
+		adapter.commit()
+		assert role.id == Role.query.filter_by(name='Admin').one().id
+		assert Role.query.count() == 1
+
+def test_unknown_roles_are_not_reloaded_on_every_check(tmp_path):
+	from sqlalchemy import event
+
+	app, db, User, Role = _create_app(tmp_path, AUTH_ENABLE_ROLES_BITMASK=True)
+	db_manager = app.auth.db_manager
+	role_queries = []
+	with app.test_request_context():
+		event.listen(db.engine, 'before_cursor_execute', lambda *args: role_queries.append(args[2]) if 'FROM roles' in args[2] else None)
+		user = db_manager.add_user(username='alice', email='alice@example.com')
+		db_manager.add_user_role(user, 'Admin')
+		db_manager.commit()
+		del role_queries[:]
+		for i in range(10):
+			assert not user.has_roles('Typo')
+		assert len(role_queries) == 1
+		# A role created by this process is known at once
+		db_manager.add_user_role(user, 'Typo')
+		db_manager.commit()
+		assert user.has_roles('Typo')
+
+HIERARCHY = dict(Owner=['Admin'], Admin=['Editor'], Editor=['Writer', 'Viewer'])
+
+def test_role_hierarchy_is_transitive():
+	app, db, User, Role = create_app(AUTH_ROLE_HIERARCHY=HIERARCHY)
+	db_manager = app.auth.db_manager
+	assert db_manager.implied_roles['Owner'] == {'Owner', 'Admin', 'Editor', 'Writer', 'Viewer'}
+	assert db_manager.implied_roles['Editor'] == {'Editor', 'Writer', 'Viewer'}
+	with app.test_request_context():
+		user = db_manager.add_user(username='alice', email='alice@example.com')
+		db_manager.add_user_role(user, 'Admin')
+		db_manager.add_user_role(user, 'Agent')
+		db_manager.commit()
+		assert db_manager.get_effective_roles(user) == {'Admin', 'Editor', 'Writer', 'Viewer', 'Agent'}
+		assert user.has_roles('Writer', ('Owner', 'Viewer'))
+		assert not user.has_roles('Owner')
+
+def test_role_hierarchy_cycles():
+	app, db, User, Role = create_app(AUTH_ROLE_HIERARCHY=dict(Admin=['Editor'], Editor=['Writer'], Writer=['Admin']))
+	implied_roles = app.auth.db_manager.implied_roles
+	assert implied_roles['Admin'] == implied_roles['Editor'] == implied_roles['Writer'] == {'Admin', 'Editor', 'Writer'}
+
+def test_role_hierarchy_of_the_role_class():
+	from ..db_manager import DBManager
+
+	app, db, User, Role = create_app(AUTH_ROLE_HIERARCHY=dict(Editor=['Writer']))
+	Role.role_hierarchy = dict(Admin=['Editor'], Editor=['Viewer'])
+	with app.app_context():
+		db_manager = DBManager(app, db, User, Role)
+	# The setting wins over the RoleClass
+	assert db_manager.implied_roles['Admin'] == {'Admin', 'Editor', 'Writer'}
+
+def test_invalid_role_hierarchy():
+	with pytest.raises(ConfigError):
+		create_app(AUTH_ROLE_HIERARCHY=dict(Admin='Editor'))
+
+def test_roles_required_accepts_implied_roles():
+	app, db, User, Role = create_app(AUTH_ROLE_HIERARCHY=HIERARCHY)
+	client = app.test_client()
+	register(client)
+	with app.test_request_context():
+		db_manager = app.auth.db_manager
+		db_manager.add_user_role(db_manager.find_user_by_username('alice'), 'Editor')
+		db_manager.commit()
+	# Editor does not imply Admin
+	assert client.get('/admin').status_code == 403
+	with app.test_request_context():
+		db_manager.add_user_role(db_manager.find_user_by_username('alice'), 'Owner')
+		db_manager.commit()
+	assert client.get('/admin').status_code == 200
+
+def test_implied_roles_are_not_stored():
+	app, db, User, Role = create_app(AUTH_ROLE_HIERARCHY=HIERARCHY)
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		user = db_manager.add_user(username='alice', email='alice@example.com')
+		db_manager.add_user_role(user, 'Owner')
+		db_manager.commit()
+		for role_name in ('Owner', 'Admin', 'Viewer'):
+			db_manager.add_user_role(user, role_name)
+		db_manager.commit()
+		assert db_manager.get_user_roles(user) == ['Owner']
+		rows = db.session.execute('SELECT COUNT(*) FROM user_roles').scalar()
+		assert rows == 1
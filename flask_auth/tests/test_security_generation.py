@@ -0,0 +1,153 @@
+# Tests of the per-user security generation (AUTH_ENABLE_SECURITY_GENERATION).
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+
+from ..generation_manager import GenerationBackendInterface, GenerationManager
+from .tst_app import create_app, register
+
+class _Backend(GenerationBackendInterface):
+	# A shared backend kept in memory: ``published`` lists the announced bumps, ``pending`` the bumps to poll
+
+	def __init__(self):
+		self.published = []
+		self.pending = []
+
+	def publish(self, user_id, generation):
+		self.published.append((user_id, generation))
+
+	def poll(self):
+		pending, self.pending = self.pending, []
+		return pending
+
+def _create_app(**config):
+	app, db, User, Role = create_app(AUTH_ENABLE_SECURITY_GENERATION=True, **config)
+	backend = _Backend()
+	app.auth.generation_manager = GenerationManager(app, backend)
+	return app, backend
+
+def _change_password(client):
+	return client.post('/auth/change_password/', data=dict(
+		old_password='Password1', new_password='Password2', retype_password='Password2'))
+
+def test_bump_is_published_after_the_commit_of_the_request():
+	app, backend = _create_app(AUTH_ENABLE_UNIT_OF_WORK=True)
+	client = app.test_client()
+	register(client)
+	commits = []
+	adapter = app.auth.db_manager.db_adapter
+	commit = adapter.commit
+	def spy():
+		commits.append(list(backend.published))
+		commit()
+	adapter.commit = spy
+	assert _change_password(client).status_code == 302
+	# The unit of work commits once, then the bump is published
+	assert commits == [[]]
+	assert backend.published == [('1', 1)]
+
+def test_bump_is_not_published_if_the_request_rolls_back():
+	app, backend = _create_app(AUTH_ENABLE_UNIT_OF_WORK=True)
+	client = app.test_client()
+	register(client)
+	def fail(user):
+		raise RuntimeError('The email server is down')
+	app.auth.email_manager.send_password_changed_email = fail
+	with pytest.raises(RuntimeError):
+		_change_password(client)
+	assert backend.published == []
+	with app.app_context():
+		assert app.auth.db_manager.find_user_by_username('alice').security_generation == 0
+
+def test_generation_map_is_bounded():
+	app, backend = _create_app(AUTH_SECURITY_GENERATION_CACHE_SIZE=2)
+	generation_manager = app.auth.generation_manager
+	with app.app_context():
+		users = [app.auth.db_manager.add_user(username='user%d' % i, email='user%d@example.com' % i) for i in range(3)]
+		app.auth.db_manager.commit()
+		generation_manager.verify(users[0], 0)
+		generation_manager.verify(users[1], 0)
+		# A lookup makes user 0 the most recently used: remembering user 2 forgets user 1
+		assert generation_manager.get_known_generation(users[0].id) == 0
+		generation_manager.verify(users[2], 0)
+		assert list(generation_manager.generations) == [str(users[0].id), str(users[2].id)]
+		# A forgotten user is not rejected: its session is checked against the database
+		assert generation_manager.get_known_generation(users[1].id) is None
+		assert generation_manager.is_current(users[1].id, 0)
+
+def _login(app, remember_me=False):
+	client = app.test_client()
+	response = client.post('/auth/login/', data=dict(username='alice', password='Password1', remember_me=remember_me))
+	assert response.status_code == 302
+	return client
+
+def test_other_sessions_are_rejected_after_a_password_change():
+	app, backend = _create_app()
+	client = app.test_client()
+	register(client)
+	other_client = _login(app)
+	remembered_client = _login(app, remember_me=True)
+	# Only the remember cookie is left: the user is loaded from it
+	remembered_client.delete_cookie('localhost', 'session')
+	assert remembered_client.get('/members').status_code == 200
+	remembered_client.delete_cookie('localhost', 'session')
+
+	assert _change_password(client).status_code == 302
+	# The session of the change is refreshed, the others are rejected
+	assert client.get('/members').status_code == 200
+	assert other_client.get('/members').status_code == 401
+	assert remembered_client.get('/members').status_code == 401
+	assert backend.published == [('1', 1)]
+
+def test_other_sessions_are_rejected_after_an_email_change():
+	app, backend = _create_app()
+	client = app.test_client()
+	register(client)
+	other_client = _login(app)
+	assert client.post('/auth/change_email/', data=dict(email='alice2@example.com')).status_code == 302
+	assert client.get('/members').status_code == 200
+	assert other_client.get('/members').status_code == 401
+
+def test_reset_password_token_is_single_use():
+	app, backend = _create_app()
+	register(app.test_client())
+	with app.app_context():
+		token = app.auth.token_manager.generate_reset_password_token(app.auth.db_manager.find_user_by_username('alice'))
+	client = app.test_client()
+	assert client.get('/auth/reset_password/%s' % token).status_code == 200
+	response = client.post('/auth/reset_password/%s' % token, data=dict(new_password='Password2', retype_password='Password2'))
+	assert response.status_code == 302
+	client.get('/auth/logout/')
+	# The reset bumped the generation embedded in the token
+	response = client.get('/auth/reset_password/%s' % token)
+	assert response.status_code == 302 and response.location.endswith('/auth/login/')
+	with app.app_context():
+		assert app.auth.token_manager.verify_reset_password_token(token) is None
+
+def test_confirm_account_token_is_invalidated_by_an_email_change():
+	app, backend = _create_app()
+	client = app.test_client()
+	register(client)
+	with app.app_context():
+		token = app.auth.token_manager.generate_confirm_account_token(app.auth.db_manager.find_user_by_username('alice'))
+		assert app.auth.token_manager.verify_confirm_account_token(token) is not None
+	assert client.post('/auth/change_email/', data=dict(email='alice2@example.com')).status_code == 302
+	with app.app_context():
+		assert app.auth.token_manager.verify_confirm_account_token(token) is None
+
+def test_bumps_of_other_processes_are_synced(monkeypatch):
+	app, backend = _create_app(AUTH_SECURITY_GENERATION_SYNC_INTERVAL=0)
+	client = app.test_client()
+	register(client)
+	assert client.get('/members').status_code == 200
+	db_manager = app.auth.db_manager
+	user_ids = []
+	get_user_by_id = db_manager.get_user_by_id
+	monkeypatch.setattr(db_manager, 'get_user_by_id', lambda user_id, *args: user_ids.append(user_id) or get_user_by_id(user_id, *args))
+	# Another process changed the password: the session is rejected before the user is loaded
+	backend.pending.append(('1', 1))
+	assert client.get('/members').status_code == 401
+	assert user_ids == []
+	assert app.auth.generation_manager.get_known_generation(1) == 1
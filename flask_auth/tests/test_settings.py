@@ -0,0 +1,79 @@
+# Tests of the loading of the 'AUTH_...' settings: validation, dependencies and freezing.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+from .. import Auth, AuthUserMixin, ConfigError
+from ..auth__settings import load_settings
+from .tst_app import ConfigClass, create_app
+
+def _config(**config):
+	settings = {name: getattr(ConfigClass, name) for name in dir(ConfigClass) if name[0:5] == 'AUTH_'}
+	settings.update(config)
+	return settings
+
+def test_invalid_settings_are_reported_at_once():
+	with pytest.raises(ConfigError) as excinfo:
+		load_settings(Auth, _config(AUTH_ENABLE_EMAIL='yes', AUTH_USER_SNAPSHOT_FIELDS='password', AUTH_IFIND_MODE='lower'))
+	message = str(excinfo.value)
+	assert 'AUTH_ENABLE_EMAIL must be of type bool, not str.' in message
+	assert 'AUTH_USER_SNAPSHOT_FIELDS must be of type list, not str.' in message
+	assert 'AUTH_IFIND_MODE must be one of' in message
+
+def test_dependent_features_are_disabled():
+	settings = load_settings(Auth, _config(AUTH_ENABLE_EMAIL=False))
+	assert not settings.AUTH_ENABLE_LOGIN_BY_EMAIL and not settings.AUTH_ENABLE_CHANGE_EMAIL
+	assert settings.AUTH_ENABLE_REGISTER
+
+	# Disabled features have no route
+	app, db, User, Role = create_app(AUTH_ENABLE_EMAIL=False)
+	assert not app.auth.AUTH_ENABLE_CHANGE_EMAIL
+	assert app.test_client().get('/auth/change_email/').status_code == 404
+
+def test_settings_are_frozen():
+	settings = load_settings(Auth, _config(AUTH_ROLE_HIERARCHY={'Admin': ['Agent']}))
+	with pytest.raises(AttributeError):
+		settings.AUTH_ENABLE_EMAIL = False
+	assert settings.AUTH_USER_SNAPSHOT_FIELDS == ('password', 'verified', 'disabled', 'roles', 'language')
+	assert settings.AUTH_ROLE_HIERARCHY['Admin'] == ('Agent',)
+	with pytest.raises(TypeError):
+		settings.AUTH_ROLE_HIERARCHY['Agent'] = ['Member']
+
+def _create_app(AuthClass):
+	app = Flask(__name__)
+	app.config.from_object(ConfigClass)
+	db = SQLAlchemy(app)
+
+	class User(db.Model, AuthUserMixin):
+		__tablename__ = 'users'
+		id = db.Column(db.Integer, primary_key=True)
+		username = db.Column(db.String(63), nullable=False, unique=True)
+		email = db.Column(db.String(255), nullable=False, unique=True)
+		password = db.Column(db.String(255), nullable=False, default='')
+
+	AuthClass(app, db, User)
+	return app
+
+def test_settings_of_customize_are_validated():
+	class CustomAuth(Auth):
+		def customize(self, app):
+			self.AUTH_ENABLE_CHANGE_PASSWORD = 'no'
+
+	with pytest.raises(ConfigError) as excinfo:
+		_create_app(CustomAuth)
+	assert 'AUTH_ENABLE_CHANGE_PASSWORD must be of type bool, not str.' in str(excinfo.value)
+
+def test_settings_of_customize_are_applied():
+	class CustomAuth(Auth):
+		def customize(self, app):
+			self.AUTH_ENABLE_CHANGE_PASSWORD = False
+			self.AUTH_USER_SNAPSHOT_FIELDS = ['password']
+
+	app = _create_app(CustomAuth)
+	assert app.auth.settings.AUTH_ENABLE_CHANGE_PASSWORD is False
+	assert app.auth.AUTH_USER_SNAPSHOT_FIELDS == ('password',)
+	assert app.test_client().get('/auth/change_password/').status_code == 404
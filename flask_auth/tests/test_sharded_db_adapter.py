@@ -0,0 +1,145 @@
+# Tests of the ShardedDbAdapter (AUTH_DB_ADAPTER='sharded'), with SQLite files as the shards and the directory.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import datetime
+
+import pytest
+from flask import Blueprint, Flask
+from flask_babelex import Babel
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.ext.mutable import MutableList
+from sqlalchemy.orm import Session
+
+from .. import Auth, AuthUserMixin, UniqueConstraintError
+from .tst_app import ConfigClass, login, register
+
+def _create_app(tmp_path, shard_binds):
+	app = Flask(__name__)
+	app.config.from_object(ConfigClass)
+	app.config.update(
+		SQLALCHEMY_DATABASE_URI='sqlite:///%s' % tmp_path.joinpath('directory.db'),
+		SQLALCHEMY_BINDS={bind_key: 'sqlite:///%s' % tmp_path.joinpath(bind_key + '.db') for bind_key in ('shard0', 'shard1', 'shard2')},
+		AUTH_DB_ADAPTER='sharded',
+		AUTH_SHARD_BINDS=shard_binds)
+	Babel(app)
+	db = SQLAlchemy(app)
+
+	# Relationships cannot span shards: the roles are a list column
+	class User(db.Model, AuthUserMixin):
+		__tablename__ = 'users'
+		id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+		disabled = db.Column(db.Boolean(), nullable=False, default=False)
+		username = db.Column(db.String(63), nullable=False, unique=True)
+		password = db.Column(db.String(255), nullable=False, default='')
+		email = db.Column(db.String(255), nullable=False, unique=True)
+		verified = db.Column(db.Boolean(), nullable=False, default=False)
+		verified_date = db.Column(db.DateTime())
+		last_seen_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+		language = db.Column(db.String(8), default='en')
+		first_name = db.Column(db.String(127), nullable=False, default='')
+		last_name = db.Column(db.String(127), nullable=False, default='')
+		roles = db.Column(MutableList.as_mutable(db.JSON), nullable=False, default=list)
+
+	Auth(app, db, User)
+
+	@app.route('/')
+	def home_page():
+		return 'home'
+
+	main = Blueprint('main', __name__)
+	@main.route('/index')
+	def index():
+		return 'index'
+	app.register_blueprint(main)
+
+	with app.app_context():
+		app.auth.db_manager.db_adapter.create_all_tables()
+	return app, db, User
+
+def _shard_usernames(app, adapter, User):
+	# The usernames stored in each shard, in AUTH_SHARD_BINDS order
+	with app.app_context():
+		return [sorted(user.username for user in shard.find_objects(User)) for shard in adapter.shards]
+
+def test_users_are_spread_over_the_shards(tmp_path):
+	app, db, User = _create_app(tmp_path, ['shard0', 'shard1'])
+	db_manager = app.auth.db_manager
+	adapter = db_manager.db_adapter
+	with app.app_context():
+		for i in range(10):
+			db_manager.add_user(username='user%d' % i, email='user%d@example.com' % i)
+		db_manager.commit()
+	usernames = _shard_usernames(app, adapter, User)
+	assert all(usernames) and sum(len(shard_usernames) for shard_usernames in usernames) == 10
+
+	with app.app_context():
+		# Lookups by username or email address are routed through the shard directory
+		user = db_manager.find_user_by_username('USER3')
+		assert user.email == 'user3@example.com'
+		assert user.username in usernames[adapter.shards.index(adapter.get_shard(user.id))]
+		assert db_manager.find_user_by_email('user7@EXAMPLE.com').username == 'user7'
+		assert db_manager.find_user_by_username('nobody') is None
+		# Listings run on all the shards and return lists
+		users = adapter.find_objects(User)
+		assert isinstance(users, list) and len(users) == 10
+		assert len(adapter.find_objects(User, first_name='')) == 10
+		assert len(adapter.get_objects(User, [user.id for user in users[:4]])) == 4
+
+def test_shard_directory(tmp_path):
+	app, db, User = _create_app(tmp_path, ['shard0', 'shard1'])
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		db_manager.add_user(username='alice', email='alice@example.com')
+		db_manager.add_user(username='bob', email='bob@example.com')
+		db_manager.commit()
+		# The unique values are claimed in the directory, whatever the shard of the user
+		with pytest.raises(UniqueConstraintError):
+			db_manager.add_user(username='ALICE', email='other@example.com')
+			db_manager.commit()
+		db_manager.db_adapter.rollback()
+		# Changing a username releases the old one
+		alice = db_manager.find_user_by_username('alice')
+		alice.username = 'alicia'
+		db_manager.save_object(alice)
+		db_manager.commit()
+		assert db_manager.find_user_by_username('alice') is None
+		assert db_manager.find_user_by_username('alicia').email == 'alice@example.com'
+		db_manager.add_user(username='alice', email='alice2@example.com')
+		db_manager.commit()
+
+def test_directory_listener_is_scoped_to_the_shard_sessions(tmp_path):
+	app, db, User = _create_app(tmp_path, ['shard0', 'shard1'])
+	adapter = app.auth.db_manager.db_adapter
+	assert not event.contains(Session, 'before_flush', adapter._before_flush)
+	for shard in adapter.shards:
+		assert event.contains(shard.db.session, 'before_flush', adapter._before_flush)
+	# Flushing the default session of the application does not touch the shard directory
+	with app.app_context():
+		db.create_all()
+		db.session.add(User(id=1000, username='outside', email='outside@example.com'))
+		db.session.commit()
+		assert app.auth.db_manager.find_user_by_username('outside') is None
+
+def test_login_and_rebalance(tmp_path):
+	app, db, User = _create_app(tmp_path, ['shard0', 'shard1'])
+	client = app.test_client()
+	for i in range(6):
+		assert register(client, username='user%d' % i, email='user%d@example.com' % i).status_code == 302
+		client.get('/auth/logout/')
+
+	# A third shard is added: the users that are not on the shard of their ID any more are moved
+	app, db, User = _create_app(tmp_path, ['shard0', 'shard1', 'shard2'])
+	adapter = app.auth.db_manager.db_adapter
+	with app.app_context():
+		assert app.auth.db_manager.rebalance_shards(batch_size=2) > 0
+		assert app.auth.db_manager.rebalance_shards() == 0
+		placements = [(shard, user.id) for shard in adapter.shards for user in shard.find_objects(User)]
+	assert len(placements) == 6 and all(adapter.get_shard(id) is shard for shard, id in placements)
+	client = app.test_client()
+	for i in range(6):
+		response = login(client, username='USER%d' % i)
+		assert response.status_code == 302 and response.location.endswith('/')
+		client.get('/auth/logout/')
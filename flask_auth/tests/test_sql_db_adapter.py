@@ -0,0 +1,55 @@
+# Tests of the baked lookups of the SQLDbAdapter.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+from sqlalchemy import event
+
+def _add_users(app, count):
+	db_manager = app.auth.db_manager
+	for i in range(count):
+		db_manager.add_user(username='user%d' % i, email='user%d@example.com' % i)
+	db_manager.commit()
+
+def test_lookups_are_baked_once(app, monkeypatch):
+	adapter = app.auth.db_manager.db_adapter
+	User = app.auth.db_manager.UserClass
+	baked_keys = []
+	bake_lookup = adapter._bake_lookup
+	def spy(key, method_name):
+		baked_keys.append(key)
+		return bake_lookup(key, method_name)
+	monkeypatch.setattr(adapter, '_bake_lookup', spy)
+	statements = []
+	with app.test_request_context():
+		_add_users(app, 3)
+		event.listen(app.extensions['sqlalchemy'].db.engine, 'before_cursor_execute',
+			lambda connection, cursor, statement, parameters, context, executemany: statements.append((statement, parameters)))
+
+		# The filter values are bound parameters: each lookup gets its own result
+		assert adapter.find_first_object(User, username='user0').email == 'user0@example.com'
+		bakery_size = len(adapter._bakery.cache)
+		assert adapter.find_first_object(User, username='user1').email == 'user1@example.com'
+		assert adapter.find_first_object(User, username='nobody') is None
+		assert len(baked_keys) == 1
+		# The compiled statement is reused, with other parameters
+		assert len(adapter._bakery.cache) == bakery_size
+		assert len(set(statement for statement, parameters in statements)) == 1
+		assert [parameters[0] for statement, parameters in statements] == ['user0', 'user1', 'nobody']
+
+		# Another field set, or mode, is another lookup
+		assert adapter.find_first_object(User, email='user2@example.com').username == 'user2'
+		assert adapter.find_first_object_by_any(User, [('username', 'user2@example.com'), ('email', 'user2@example.com')]).username == 'user2'
+		assert adapter.find_first_object_by_any(User, [('username', 'user1'), ('email', 'user1')]).username == 'user1'
+		assert len(baked_keys) == 3
+
+def test_ilike_lookups(app):
+	# The test app uses AUTH_IFIND_MODE 'ifind'
+	adapter = app.auth.db_manager.db_adapter
+	User = app.auth.db_manager.UserClass
+	with app.test_request_context():
+		_add_users(app, 2)
+		assert adapter.ifind_first_object(User, username='USER0').email == 'user0@example.com'
+		assert adapter.ifind_first_object(User, username='User1').email == 'user1@example.com'
+		assert adapter.ifind_first_object(User, username='user2') is None
+		assert len(adapter._baked_lookups) == 1
@@ -0,0 +1,101 @@
+# Tests of the read replica routing of the SQLDbAdapter (AUTH_SQL_REPLICA_BINDS),
+# with two SQLite files standing in for the primary database and its replica.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import time
+
+import pytest
+
+from ..signals import auth_db_operation
+from .tst_app import create_app, register
+
+@pytest.fixture
+def replica_app(tmp_path):
+	app, db, User, Role = create_app(
+		SQLALCHEMY_DATABASE_URI='sqlite:///%s' % tmp_path.joinpath('primary.db'),
+		SQLALCHEMY_BINDS={'replica': 'sqlite:///%s' % tmp_path.joinpath('replica.db')},
+		AUTH_SQL_REPLICA_BINDS=['replica'])
+	with app.app_context():
+		User.__table__.create(db.get_engine(app, bind='replica'))
+	return app, db, User
+
+@pytest.fixture
+def binds(replica_app):
+	# The binds that served the reads: (operation, bind)
+	app, db, User = replica_app
+	binds = []
+	def receiver(sender, operation, bind=None, **extra):
+		binds.append((operation, bind))
+	with auth_db_operation.connected_to(receiver, app):
+		yield binds
+
+def _replicate(app, db, User):
+	# Copy the users of the primary database to the replica
+	with app.app_context():
+		rows = [dict(row) for row in db.engine.execute(User.__table__.select())]
+		with db.get_engine(app, bind='replica').begin() as connection:
+			connection.execute(User.__table__.delete())
+			connection.execute(User.__table__.insert(), rows)
+
+def test_reads_go_to_the_replica(replica_app, binds):
+	app, db, User = replica_app
+	adapter = app.auth.db_manager.db_adapter
+	with app.app_context():
+		app.auth.db_manager.add_user(username='alice', email='alice@example.com', first_name='Alice')
+		app.auth.db_manager.commit()
+	_replicate(app, db, User)
+	with app.app_context():
+		db.engine.execute(User.__table__.update().values(first_name='Alicia'))
+
+	with app.test_request_context():
+		# The replica lags behind the primary
+		assert adapter.find_first_object(User, username='alice').first_name == 'Alice'
+		assert adapter.ifind_first_object(User, email='ALICE@example.com').first_name == 'Alice'
+		assert [bind for operation, bind in binds] == ['replica:replica', 'replica:replica']
+		# After a write, the rest of the request reads from the primary
+		user = adapter.get_object(User, 1)
+		user.last_name = 'Smith'
+		adapter.save_object(user)
+		adapter.commit()
+		del binds[:]
+		assert adapter.find_first_object(User, username='alice').first_name == 'Alicia'
+		assert binds == [('find_first_object', 'primary')]
+
+	# Outside requests, reads go to the primary
+	with app.app_context():
+		assert adapter.find_first_object(User, username='alice').first_name == 'Alicia'
+
+def test_writers_stick_to_the_primary(replica_app, binds):
+	app, db, User = replica_app
+	client = app.test_client()
+	response = register(client)
+	cookie = [header for header in response.headers.getlist('Set-Cookie') if header.startswith('auth_read_primary_until=')]
+	assert cookie and 'HttpOnly' in cookie[0]
+	_replicate(app, db, User)
+
+	# The client has just written: load_user() reads from the primary
+	del binds[:]
+	assert client.get('/members').status_code == 200
+	assert binds and all(bind == 'primary' for operation, bind in binds)
+
+	# Once the stickiness window has expired, reads go to the replica again
+	client.set_cookie('localhost', 'auth_read_primary_until', str(int(time.time()) - 1))
+	del binds[:]
+	assert client.get('/members').status_code == 200
+	assert binds and all(bind == 'replica:replica' for operation, bind in binds)
+
+	# A user who has just changed their password reads from the primary
+	response = client.post('/auth/change_password/', data=dict(
+		old_password='Password1', new_password='Password2', retype_password='Password2'))
+	assert response.status_code == 302
+	del binds[:]
+	assert client.get('/members').status_code == 200
+	assert binds and all(bind == 'primary' for operation, bind in binds)
+
+def test_unknown_replica_bind():
+	from .. import ConfigError
+
+	with pytest.raises(ConfigError):
+		create_app(AUTH_SQL_REPLICA_BINDS=['replica'])
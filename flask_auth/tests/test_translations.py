@@ -0,0 +1,44 @@
+# Tests of the locale selection and of the translation catalogs (see translation_utils.py).
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import os
+
+from flask_login import login_user
+
+from .. import translation_utils
+from .tst_app import create_app
+
+def test_available_languages_are_discovered_once(app, monkeypatch):
+	# Selecting a locale must not touch the filesystem
+	def fail(*args):
+		raise AssertionError('filesystem access during locale selection')
+	monkeypatch.setattr(os, 'listdir', fail)
+	monkeypatch.setattr(os.path, 'isdir', fail)
+	select_locale = app.extensions['babel'].locale_selector_func
+	with app.test_request_context(headers={'Accept-Language': 'es-ES, es;q=0.9, en;q=0.8'}):
+		assert select_locale() == 'es'
+	with app.test_request_context(headers={'Accept-Language': 'xx-XX, xx;q=0.9'}):
+		assert select_locale() is None
+
+def test_explicit_language_list():
+	app, db, User, Role = create_app(AUTH_AVAILABLE_LANGUAGES=['en'])
+	select_locale = app.extensions['babel'].locale_selector_func
+	with app.test_request_context(headers={'Accept-Language': 'es, en;q=0.5'}):
+		assert select_locale() == 'en'
+
+def test_logged_in_users_use_their_language(app):
+	db_manager = app.auth.db_manager
+	select_locale = app.extensions['babel'].locale_selector_func
+	with app.test_request_context(headers={'Accept-Language': 'en'}):
+		user = db_manager.add_user(username='alice', email='alice@example.com', language='es')
+		db_manager.commit()
+		login_user(user)
+		assert select_locale() == 'es'
+
+def test_preloaded_catalogs(app):
+	assert 'es' in translation_utils._catalogs
+	with app.test_request_context(headers={'Accept-Language': 'es'}):
+		assert translation_utils.gettext('Password') == translation_utils.domain_translations.gettext('Password')
+		assert str(translation_utils.lazy_gettext('Password')) == translation_utils.gettext('Password')
@@ -0,0 +1,75 @@
+# Tests of the unit of work of the DBManager (AUTH_ENABLE_UNIT_OF_WORK), with the SQLDbAdapter.
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+
+from .tst_app import create_app
+
+@pytest.fixture
+def uow_app(tmp_path, monkeypatch):
+	# A file database: the committed rows are read back with another connection
+	app, db, User, Role = create_app(
+		SQLALCHEMY_DATABASE_URI='sqlite:///%s' % tmp_path.joinpath('test.db'), AUTH_ENABLE_UNIT_OF_WORK=True)
+	db_manager = app.auth.db_manager
+
+	@app.route('/rename/<name>/<outcome>')
+	def rename(name, outcome):
+		user = db_manager.find_user_by_username('alice')
+		user.first_name = name
+		db_manager.save_user(user)
+		db_manager.commit()
+		user.last_name = name
+		db_manager.save_user(user)
+		db_manager.commit()
+		if outcome == 'exception':
+			raise RuntimeError('The view failed')
+		return 'renamed', 500 if outcome == 'error' else 200
+
+	with app.app_context():
+		db_manager.add_user(username='alice', email='alice@example.com', first_name='Alice', last_name='Smith')
+		db_manager.commit()
+	commits = []
+	commit = db_manager.db_adapter.commit
+	def spy():
+		commits.append(1)
+		commit()
+	monkeypatch.setattr(db_manager.db_adapter, 'commit', spy)
+	return app, db, commits
+
+def _committed_names(app, db):
+	# The names of alice, as committed
+	with app.app_context():
+		with db.engine.connect() as connection:
+			return tuple(connection.execute("SELECT first_name, last_name FROM users WHERE username = 'alice'").first())
+
+def test_request_commits_once(uow_app):
+	app, db, commits = uow_app
+	assert app.test_client().get('/rename/Alicia/ok').status_code == 200
+	assert len(commits) == 1
+	assert _committed_names(app, db) == ('Alicia', 'Alicia')
+
+def test_exception_rolls_back(uow_app):
+	app, db, commits = uow_app
+	with pytest.raises(RuntimeError):
+		app.test_client().get('/rename/Alicia/exception')
+	assert commits == []
+	assert _committed_names(app, db) == ('Alice', 'Smith')
+
+def test_server_error_rolls_back(uow_app):
+	app, db, commits = uow_app
+	assert app.test_client().get('/rename/Alicia/error').status_code == 500
+	assert commits == []
+	assert _committed_names(app, db) == ('Alice', 'Smith')
+
+def test_commits_are_immediate_outside_requests(uow_app):
+	app, db, commits = uow_app
+	db_manager = app.auth.db_manager
+	with app.app_context():
+		user = db_manager.find_user_by_username('alice')
+		user.first_name = 'Alicia'
+		db_manager.save_user(user)
+		db_manager.commit()
+		assert len(commits) == 1
+		assert _committed_names(app, db) == ('Alicia', 'Smith')
@@ -0,0 +1,125 @@
+# Tests of the user snapshots of the SQLDbAdapter and of the snapshot cache of load_user()
+# (AUTH_ENABLE_USER_SNAPSHOTS, AUTH_USER_SNAPSHOT_CACHE_SIZE).
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import pytest
+from sqlalchemy import event
+
+from ..user_snapshot import UserSnapshot
+from .tst_app import create_app, register
+
+def _create_app(**config):
+	config.setdefault('AUTH_USER_SNAPSHOT_CACHE_SIZE', 2)
+	app, db, User, Role = create_app(AUTH_ENABLE_USER_SNAPSHOTS=True, **config)
+	# The SQL statements run
+	queries = []
+	with app.app_context():
+		event.listen(db.engine, 'before_cursor_execute', lambda connection, cursor, statement, *args: queries.append(statement))
+	return app, queries
+
+def _add_users(app, count):
+	db_manager = app.auth.db_manager
+	users = [db_manager.add_user(username='user%d' % i, email='user%d@example.com' % i) for i in range(count)]
+	db_manager.commit()
+	return [user.id for user in users]
+
+def test_load_user_is_served_from_the_cache():
+	app, queries = _create_app()
+	client = app.test_client()
+	register(client)
+	assert client.get('/members').status_code == 200
+	del queries[:]
+	# The snapshot cached by the previous request serves load_user()
+	assert client.get('/members').status_code == 200
+	assert client.get('/members').status_code == 200
+	assert queries == []
+
+def test_writes_evict_the_cached_snapshot():
+	app, queries = _create_app()
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		user_id, = _add_users(app, 1)
+		key = str(user_id)
+		db_manager.get_user_by_id(user_id)
+		assert key in db_manager.snapshot_cache
+
+		user = db_manager.get_user_by_id(user_id)
+		assert isinstance(user, UserSnapshot)
+		user.first_name = 'Alice'
+		db_manager.save_user(user)
+		db_manager.commit()
+		assert key not in db_manager.snapshot_cache
+
+		db_manager.add_user_role(db_manager.get_user_by_id(user_id), 'Admin')
+		db_manager.commit()
+		assert key not in db_manager.snapshot_cache
+
+		db_manager.remove_user_role(db_manager.get_user_by_id(user_id), 'Admin')
+		db_manager.commit()
+		assert key not in db_manager.snapshot_cache
+		# The evicted entry is reloaded with the committed changes
+		user = db_manager.get_user_by_id(user_id)
+		assert user.first_name == 'Alice' and db_manager.get_user_roles(user) == []
+
+def test_generation_mismatch_is_a_miss():
+	app, queries = _create_app(AUTH_ENABLE_SECURITY_GENERATION=True)
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		user_id, = _add_users(app, 1)
+		db_manager.get_user_by_id(user_id, 0)
+		del queries[:]
+		assert db_manager.get_user_by_id(user_id, 0) is not None
+		assert queries == []
+		# A session of another generation does not get the cached snapshot
+		db_manager.get_user_by_id(user_id, 1)
+		assert queries
+
+def test_snapshots_are_immutable():
+	app, queries = _create_app()
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		user_id, = _add_users(app, 1)
+		db_manager.get_user_by_id(user_id)
+		snapshot = db_manager.get_user_by_id(user_id)
+		with pytest.raises(TypeError):
+			snapshot.get_data()['language'] = 'es'
+		# Assignments go to the full User object, not to the snapshot data nor to the cache
+		snapshot.language = 'es'
+		assert snapshot.is_loaded() and snapshot.get_data()['language'] == 'en'
+		assert db_manager.get_user_by_id(user_id).get_data()['language'] == 'en'
+
+def test_cache_is_bounded():
+	app, queries = _create_app()
+	db_manager = app.auth.db_manager
+	with app.test_request_context():
+		user_ids = _add_users(app, 3)
+		db_manager.get_user_by_id(user_ids[0])
+		db_manager.get_user_by_id(user_ids[1])
+		# A hit makes user 0 the most recently used: loading user 2 evicts user 1
+		db_manager.get_user_by_id(user_ids[0])
+		db_manager.get_user_by_id(user_ids[2])
+		assert list(db_manager.snapshot_cache) == [str(user_ids[0]), str(user_ids[2])]
+
+def test_roles_are_projected():
+	app, queries = _create_app(AUTH_USER_SNAPSHOT_CACHE_SIZE=0)
+	client = app.test_client()
+	register(client)
+	with app.test_request_context():
+		db_manager = app.auth.db_manager
+		db_manager.add_user_role(db_manager.find_user_by_username('alice'), 'Admin')
+		db_manager.commit()
+	assert client.get('/admin').status_code == 200
+	del queries[:]
+	# load_user() selects the user row and its role rows: roles_required() needs no other query
+	assert client.get('/admin').status_code == 200
+	assert len(queries) == 2
+	with app.test_request_context():
+		user = db_manager.get_user_by_id(1)
+		assert [role.name for role in user.roles] == ['Admin'] and not user.is_loaded()
+		# Role changes go through the full User object
+		db_manager.add_user_role(user, 'Agent')
+		db_manager.remove_user_role(user, 'Admin')
+		db_manager.commit()
+		assert db_manager.get_user_roles(db_manager.get_user_by_id(1)) == ['Agent']
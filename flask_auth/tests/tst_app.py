@@ -0,0 +1,134 @@
+"""
+This module implements the Flask-SQLAlchemy application used by the automated tests.
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import datetime
+from flask import Blueprint, Flask
+from flask_babelex import Babel
+from flask_sqlalchemy import SQLAlchemy
+from .. import Auth, AuthUserMixin, login_required, roles_required
+
+class ConfigClass(object):
+	""" Flask application config """
+
+	# Flask settings
+	SECRET_KEY = 'This is an INSECURE secret!! DO NOT use this in production!!'
+	TESTING = True
+	WTF_CSRF_ENABLED = False
+
+	# Flask-SQLAlchemy settings
+	SQLALCHEMY_DATABASE_URI = 'sqlite://' # In-memory SQL database
+	SQLALCHEMY_TRACK_MODIFICATIONS = False # Avoids SQLAlchemy warning
+
+	AVAILABLE_LANGUAGES = ['en', 'es']
+	AVAILABLE_LANGUAGES_TUPLE = [
+		('en', 'English'),
+		('es', 'Spanish')
+	]
+
+	# Flask-Auth settings
+	AUTH_EMAIL_SENDER_EMAIL = 'noreply@example.com'
+	AUTH_ENABLE_CONFIRM_ACCOUNT = False
+	AUTH_SEND_WELLCOME_EMAIL = False
+	AUTH_SEND_PASSWORD_CHANGED_EMAIL = False
+	AUTH_SEND_EMAIL_CHANGED_EMAIL = False
+	AUTH_SEND_USERNAME_CHANGED_EMAIL = False
+	AUTH_ENDPOINT_AFTER_LOGIN = 'home_page'
+
+def create_app(**config):
+	"""
+	Flask application factory.
+
+	| ``config`` overrides the settings of ConfigClass.
+	| Returns ``(app, db, User, Role)``.
+	"""
+	app = Flask(__name__)
+	app.config.from_object(__name__+'.ConfigClass')
+	app.config.update(config)
+
+	# Initialize Flask-BabelEx
+	Babel(app)
+
+	# Initialize Flask-SQLAlchemy
+	db = SQLAlchemy(app)
+
+	# Define the User data-model.
+	# The NOCASE collation makes the username and email lookups case insensitive (AUTH_IFIND_MODE='nocase_collation')
+	class User(db.Model, AuthUserMixin):
+		__tablename__ = 'users'
+		id = db.Column(db.Integer, primary_key=True)
+		disabled = db.Column(db.Boolean(), nullable=False, default=False)
+		username = db.Column(db.String(63, collation='NOCASE'), nullable=False, unique=True)
+		password = db.Column(db.String(255), nullable=False, default='')
+		email = db.Column(db.String(255, collation='NOCASE'), nullable=False, unique=True)
+		# Canonical shadow fields (AUTH_ENABLE_CANONICAL_FIELDS)
+		username_canonical = db.Column(db.String(63), unique=True)
+		email_canonical = db.Column(db.String(255), unique=True)
+		verified = db.Column(db.Boolean(), nullable=False, default=False)
+		verified_date = db.Column(db.DateTime())
+		last_seen_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+		language = db.Column(db.String(8), default='en')
+		security_generation = db.Column(db.Integer, nullable=False, default=0)
+		roles_mask = db.Column(db.BigInteger)
+		first_name = db.Column(db.String(127), nullable=False, default='')
+		last_name = db.Column(db.String(127), nullable=False, default='')
+		roles = db.relationship('Role', secondary='user_roles')
+
+		@property
+		def fullname(self):
+			return self.first_name + ' ' + self.last_name
+
+	# Define the Role data-model
+	class Role(db.Model):
+		__tablename__ = 'roles'
+		id = db.Column(db.Integer(), primary_key=True)
+		name = db.Column(db.String(50), unique=True)
+
+	# Define the UserRoles association table
+	class UserRoles(db.Model):
+		__tablename__ = 'user_roles'
+		id = db.Column(db.Integer(), primary_key=True)
+		user_id = db.Column(db.Integer(), db.ForeignKey('users.id', ondelete='CASCADE'))
+		role_id = db.Column(db.Integer(), db.ForeignKey('roles.id', ondelete='CASCADE'))
+
+	# Setup Flask-Auth
+	Auth(app, db, User, RoleClass=Role)
+
+	# The pages of the application
+	@app.route('/')
+	def home_page():
+		return 'home'
+
+	# Flask-Auth redirects to 'main.index' after logout
+	main = Blueprint('main', __name__)
+	@main.route('/index')
+	def index():
+		return 'index'
+	app.register_blueprint(main)
+
+	@app.route('/members')
+	@login_required
+	def member_page():
+		return 'members'
+
+	@app.route('/admin')
+	@roles_required('Admin')
+	def admin_page():
+		return 'admin'
+
+	with app.app_context():
+		db.create_all()
+	return app, db, User, Role
+
+def register(client, username='alice', email='alice@example.com', password='Password1'):
+	# Register (and log in) a user through the register view
+	return client.post('/auth/register', data=dict(
+		username=username, email=email, password=password, retype_password=password,
+		first_name='Alice', last_name='Smith', language='en'))
+
+def login(client, username='alice', password='Password1'):
+	# Log a user in through the login view
+	return client.post('/auth/login/', data=dict(username=username, password=password))
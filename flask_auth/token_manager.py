@@ -35,23 +35,34 @@ class TokenManager(object):
 			print('WARNING: Flask-User TokenManager: SECRET_KEY is shorter than 32 bytes.')
 
 	def generate_reset_password_token(self, user):
-		return jwt.encode(
-			{'reset_password': user.id, 'exp': time() + self.auth.AUTH_RESET_PASSWORD_EXPIRATION},
-			self.app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+		payload = {'reset_password': user.id, 'exp': time() + self.auth.AUTH_RESET_PASSWORD_EXPIRATION}
+		return self._encode(payload, user)
 
 	def verify_reset_password_token(self, token):
-		try:
-			id = jwt.decode(token, self.app.config['SECRET_KEY'], algorithms=['HS256'])['reset_password']
-		except:
-			return
-		return self.auth.db_manager.get_user_by_id(id)
+		return self._decode(token, 'reset_password')
 
 	def generate_confirm_account_token(self, user):
-		return jwt.encode({'verify_account': user.id, 'exp': time() + self.auth.AUTH_CONFIRM_ACCOUNT_EXPIRATION}, self.app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+		payload = {'verify_account': user.id, 'exp': time() + self.auth.AUTH_CONFIRM_ACCOUNT_EXPIRATION}
+		return self._encode(payload, user)
 
 	def verify_confirm_account_token(self, token):
+		return self._decode(token, 'verify_account')
+
+	def _encode(self, payload, user):
+		# Embed the security generation so that bumping it invalidates the token
+		if self.auth.AUTH_ENABLE_SECURITY_GENERATION:
+			payload['gen'] = self.auth.generation_manager.get_generation(user)
+		return jwt.encode(payload, self.app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+
+	def _decode(self, token, purpose):
+		# Returns the User identified by the ``purpose`` claim of ``token``, or None
 		try:
-			id = jwt.decode(token, self.app.config['SECRET_KEY'], algorithms=['HS256'])['verify_account']
+			payload = jwt.decode(token, self.app.config['SECRET_KEY'], algorithms=['HS256'])
+			id = payload[purpose]
 		except:
 			return
-		return self.auth.db_manager.get_user_by_id(id)
\ No newline at end of file
+		user = self.auth.db_manager.get_user_by_id(id)
+		if user and self.auth.AUTH_ENABLE_SECURITY_GENERATION:
+			if payload.get('gen') != self.auth.generation_manager.get_generation(user):
+				return
+		return user
\ No newline at end of file
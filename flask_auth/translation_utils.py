@@ -7,24 +7,74 @@ It uses Flask-BabelEx to manage domain specific translation files.
 # Copyright (c) 2019 Alejandro Alvarez
 
 import os
+from functools import lru_cache
+from gettext import GNUTranslations
+from types import MappingProxyType
 from flask import request
 from flask_login import current_user
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
 
 _translations_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'translations')
 
 # Load Flask-Auth translations, if Flask-BabelEx has been installed
 try:
-	from flask_babelex import Domain
+	from flask_babelex import Domain, get_locale
+	from speaklater import make_lazy_string
 	# Retrieve Flask-Auth translations from the flask_auth/translations directory
 	domain_translations = Domain(_translations_dir, domain='flask_auth')
 except ImportError:
 	domain_translations = None
 
+# Preloaded catalogs: language code -> immutable {msgid: msgstr}.
+# Filled once by load_catalogs() and never modified afterwards.
+_catalogs = MappingProxyType({})
+
 def gettext(string, **variables):
+	# Fast path: look the string up in the preloaded catalog of the current locale
+	if _catalogs:
+		catalog = _get_catalog(get_locale())
+		if catalog is not None:
+			translation = catalog.get(string, string)
+			return translation % variables if variables else translation
 	return domain_translations.gettext(string, **variables) if domain_translations else string % variables
 
 def lazy_gettext(string, **variables):
-	return domain_translations.lazy_gettext(string, **variables) if domain_translations else string % variables
+	# The lazy string is resolved by gettext(), i.e. by a lookup in the catalog of the current locale
+	return make_lazy_string(gettext, string, **variables) if domain_translations else string % variables
+
+@lru_cache(maxsize=64)
+def _get_catalog(locale):
+	# Returns the preloaded catalog for ``locale`` ('es_ES' falls back to 'es'), or None
+	if locale is None:
+		return None
+	catalog = _catalogs.get(str(locale))
+	if catalog is None:
+		catalog = _catalogs.get(locale.language)
+	return catalog
+
+def load_catalogs(language_codes=None):
+	"""Load the catalogs of ``language_codes`` (default: all shipped languages) once."""
+	global _catalogs
+	catalogs = {}
+	for language_code in language_codes or get_language_codes():
+		catalogs[language_code] = MappingProxyType(_read_catalog(language_code))
+	_catalogs = MappingProxyType(catalogs)
+	_get_catalog.cache_clear()
+
+def _read_catalog(language_code):
+	# Read the compiled .mo file, or the .po file if translations have not been compiled
+	locale_dir = os.path.join(_translations_dir, language_code, 'LC_MESSAGES')
+	mo_path = os.path.join(locale_dir, 'flask_auth.mo')
+	if os.path.isfile(mo_path):
+		with open(mo_path, 'rb') as mo_file:
+			messages = GNUTranslations(mo_file)._catalog
+	else:
+		from babel.messages.pofile import read_po
+		with open(os.path.join(locale_dir, 'flask_auth.po'), 'rb') as po_file:
+			messages = {message.id: message.string for message in read_po(po_file) if not message.fuzzy}
+	# Keep singular, translated messages only (skip the header and plural forms)
+	return {msgid: msgstr for msgid, msgstr in messages.items() if isinstance(msgid, str) and msgid and msgstr}
 
 def get_language_codes():
 	language_codes = []
@@ -35,11 +85,21 @@ def get_language_codes():
 		language_codes.append(folder)
 	return language_codes
 
-def init_translations(babel):
+def init_translations(babel, language_codes=None, cache_size=256):
 	if babel:
 		babel._default_domain = domain_translations
+		# Preload the catalogs of all shipped languages
+		if domain_translations:
+			load_catalogs()
 		# Install a language selector if one has not yet been installed
 		if babel.locale_selector_func is None:
+			# Retrieve a list of available language codes once, instead of on every request
+			available_language_codes = tuple(language_codes or get_language_codes())
+			# Memoize the best match of each Accept-Language header string
+			@lru_cache(maxsize=cache_size)
+			def best_match(accept_languages_header):
+				accept_languages = parse_accept_header(accept_languages_header, LanguageAccept)
+				return accept_languages.best_match(available_language_codes)
 			# Define a language selector
 			def get_locale():
 				# if a user is logged in, use the locale from the user settings
@@ -47,9 +107,6 @@ def init_translations(babel):
 					return current_user.language
 				# otherwise try to guess the language from the user accept
 				# header the browser transmits.
-				# Retrieve a list of available language codes
-				available_language_codes = get_language_codes()
-				language_code = request.accept_languages.best_match(available_language_codes)
-				return language_code
+				return best_match(request.headers.get('Accept-Language', ''))
 			# Install the language selector
-			babel.locale_selector_func = get_locale
\ No newline at end of file
+			babel.locale_selector_func = get_locale
@@ -18,6 +18,10 @@ class AuthUserMixin(FlaskLoginUserMixin):
 	"""
 	def get_id(self):
 		# Returns the user ID for Flask-Login to work properly and find user.
+		auth = current_app.auth
+		if auth.AUTH_ENABLE_SECURITY_GENERATION:
+			# Embed the security generation so that bumping it invalidates the session
+			return auth.generation_manager.make_session_id(self)
 		return self.id
 
 	def has_roles(self, *requirements):
@@ -36,10 +40,20 @@ class AuthUserMixin(FlaskLoginUserMixin):
 			For example:
 				has_roles('a', ('b', 'c'), d)
 			Translates to:
-				User has role 'a' AND (role 'b' OR role 'c') AND role 'd'"""
+				User has role 'a' AND (role 'b' OR role 'c') AND role 'd'
 
-		# Translates a list of role objects to a list of role_names
-		role_names = current_app.auth.db_manager.get_user_roles(self)
+			Roles implied through the role hierarchy (see AUTH_ROLE_HIERARCHY) are accepted as well."""
+
+		db_manager = current_app.auth.db_manager
+
+		# Evaluate the requirements against the roles bitmask of the user row: no join needed
+		if db_manager.auth.AUTH_ENABLE_ROLES_BITMASK:
+			authorized = db_manager.has_roles_mask(self, requirements)
+			if authorized is not None:
+				return authorized
+
+		# The set of role names of the user, including the roles implied through the role hierarchy
+		role_names = db_manager.get_effective_roles(self)
 
 		# has_role() accepts a list of requirements
 		for requirement in requirements:
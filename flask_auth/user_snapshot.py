@@ -0,0 +1,141 @@
+"""
+This module implements the UserSnapshot class for Flask-Auth.
+A UserSnapshot stands in for a User object on the authentication paths,
+holding only the fields these paths need (see AUTH_ENABLE_USER_SNAPSHOTS).
+"""
+
+# Author: Alejandro Alvarez <jandrikus@gmail.com>
+# Copyright (c) 2019 Alejandro Alvarez
+
+import types
+
+# Top-level packages of the supported ORMs: their base classes contribute no methods to snapshots
+_ORM_PACKAGES = frozenset(['flask_mongoengine', 'flask_sqlalchemy', 'flywheel', 'mongoengine', 'pynamodb', 'sqlalchemy'])
+
+# Special methods that are borrowed from the User class along with its regular methods
+_BORROWED_SPECIAL_METHODS = frozenset(['__eq__', '__ne__', '__hash__'])
+
+class UserSnapshot(object):
+	"""
+	A lightweight view of a User object, hydrated from a projection of its fields.
+
+	| Reading a projected field needs no database access.
+	| Reading any other attribute loads the full User object once (see get_object()),
+		and from then on all attribute access is delegated to it.
+	| The projected field values are never changed: snapshots can share them, and caches can keep them
+		(see get_data()).
+	| Assignments to projected fields are recorded apart, so that the DbAdapter can save them
+		with a partial update when the full User object has not been loaded.
+		DbAdapters without partial updates build snapshots that make assignments on the full User object instead.
+	| The methods and properties of the User class (``get_id()``, ``has_roles()``, ``is_active``...)
+		are available on the snapshot, and run against it.
+
+	Mutable field values such as ``roles`` must be replaced, or changed on ``get_object()``:
+	in place changes are not recorded.
+	"""
+	__slots__ = ('_data', '_changes', '_object', '_loader', '_records_changes')
+
+	# The User class of the snapshot: set on the subclasses returned by for_class()
+	_snapshot_of = None
+
+	def __init__(self, data, loader, records_changes=True):
+		"""
+		Args:
+			data(dict): Field name -> value of the projected fields. Includes 'id'.
+				The snapshot keeps a read-only view of it: it must not be changed afterwards.
+			loader: Callable without arguments that returns the full User object.
+			records_changes(bool): Record the assignments to projected fields (see pop_changes()).
+				If False, assignments load the full User object and are made on it.
+		"""
+		object.__setattr__(self, '_data', types.MappingProxyType(data))
+		object.__setattr__(self, '_changes', {})
+		object.__setattr__(self, '_object', None)
+		object.__setattr__(self, '_loader', loader)
+		object.__setattr__(self, '_records_changes', records_changes)
+
+	@classmethod
+	def for_class(cls, UserClass):
+		"""
+		Return the UserSnapshot subclass of ``UserClass``, which borrows its methods and properties.
+		The subclass is built once per User class.
+		"""
+		snapshot_class = _snapshot_classes.get(UserClass)
+		if snapshot_class is None:
+			namespace = dict(__slots__=(), _snapshot_of=UserClass)
+			# Walk the MRO from the base classes up, so that overriding methods win
+			for klass in reversed(UserClass.__mro__):
+				if klass is object or klass.__module__.split('.')[0] in _ORM_PACKAGES:
+					continue
+				for name, value in vars(klass).items():
+					if name[:2] == '__' and name not in _BORROWED_SPECIAL_METHODS:
+						continue
+					if hasattr(cls, name) and name not in _BORROWED_SPECIAL_METHODS:
+						continue
+					if value is None or isinstance(value, (types.FunctionType, property, classmethod, staticmethod)):
+						namespace[name] = value
+			snapshot_class = _snapshot_classes[UserClass] = type(UserClass.__name__ + 'Snapshot', (cls,), namespace)
+		return snapshot_class
+
+	def get_object(self):
+		"""
+		Return the full User object, loading it on first use.
+		Recorded assignments are applied to it.
+		"""
+		if self._object is None:
+			object_ = self._loader()
+			for name, value in self._changes.items():
+				setattr(object_, name, value)
+			self._changes.clear()
+			object.__setattr__(self, '_object', object_)
+		return self._object
+
+	def get_data(self):
+		# Return the projected field values as loaded, without the recorded assignments: a read-only mapping.
+		return self._data
+
+	def is_loaded(self):
+		# Check if the full User object has been loaded.
+		return self._object is not None
+
+	def pop_changes(self):
+		# Return the recorded assignments (field name -> value), and forget them.
+		changes = dict(self._changes)
+		self._changes.clear()
+		return changes
+
+	def __getattr__(self, name):
+		# Only called for the attributes that the snapshot does not define itself
+		if name[:2] == '__':
+			# Special attributes (copy and pickle protocols...) are not delegated
+			raise AttributeError(name)
+		if self._object is None:
+			try:
+				return self._changes[name]
+			except KeyError:
+				pass
+			try:
+				return self._data[name]
+			except KeyError:
+				pass
+		return getattr(self.get_object(), name)
+
+	def __setattr__(self, name, value):
+		if self._object is None and self._records_changes and name in self._data:
+			self._changes[name] = value
+		else:
+			setattr(self.get_object(), name, value)
+
+	def __delattr__(self, name):
+		delattr(self.get_object(), name)
+
+	def __repr__(self):
+		return '<%s id=%r%s>' % (type(self).__name__, self._data.get('id'), ' loaded' if self._object is not None else '')
+
+# User class -> UserSnapshot subclass
+_snapshot_classes = {}
+
+def unwrap_snapshot(object):
+	"""Return the full User object of a UserSnapshot, or ``object`` itself if it is not a snapshot."""
+	if isinstance(object, UserSnapshot):
+		return object.get_object()
+	return object